@@ -1,10 +1,14 @@
 import os
+import sys
 import subprocess
 
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tlp"))
+from interpolation import Interpolator, get_weight_schedule
+
 NUM_INTERPOLATIONS  = 20-2
 EXTENSIONS          = ["mp4"]
 BOOMERANG           = True
@@ -121,26 +125,27 @@ dst = cv2.perspectiveTransform(pts,M)
 
 num_total_images = NUM_INTERPOLATIONS + 2
 
-for i in range(0, num_total_images):
+height, width, channels = img1.shape
+img1_warp = cv2.warpPerspective(img1, M, (width, height))
+
+# img2[img1_warp > 0] = 0
 
-    height, width, channels = img1.shape
-    img1_warp = cv2.warpPerspective(img1, M, (width, height))
+# blend img1_warp into img2 wherever the warped image has content
+interpolator = Interpolator(img2, img1_warp, mask=(img1_warp > 0))
 
-    # img2[img1_warp > 0] = 0
+M_inverse = np.linalg.inv(M)
+diff = np.identity(3) - M_inverse 
 
-    tmp = img2.copy().astype(np.float64)
-    tmp[img1_warp > 0] *= 1-(i/(num_total_images-1))
-    tmp = np.add(tmp, img1_warp * (i/(num_total_images-1))).astype(np.uint8)
+for i, weight in enumerate(get_weight_schedule(num_total_images)):
+
+    tmp = interpolator.interpolate(weight)
 
     # tmp = cv2.addWeighted(
     #     img2, 1.0, #1-(i/(num_total_images-1)), 
     #     img1_warp, (i/(num_total_images-1)), 
     #     0.0)
 
-    M_inverse = np.linalg.inv(M)
-    diff = np.identity(3) - M_inverse 
-
-    M_intermediate = np.identity(3) - (i/(num_total_images-1)) * diff
+    M_intermediate = np.identity(3) - weight * diff
 
     height, width, channels = tmp.shape
     tmp_warp = cv2.warpPerspective(tmp, M_intermediate, (width, height))
@@ -1,8 +1,13 @@
+import os
+import sys
 import subprocess
 
 import cv2
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tlp"))
+from interpolation import Interpolator
+
 NUM_INTERPOLATIONS  = 8
 EXTENSIONS          = ["gif"]
 BOOMERANG           = True
@@ -21,11 +26,9 @@ for filename in IMAGES:
 
 num_total_images = NUM_INTERPOLATIONS + 2
 
-for i in range(0, num_total_images):
-    tmp = cv2.addWeighted(
-        img_objects[0], 1-(i/(num_total_images-1)), 
-        img_objects[1],   (i/(num_total_images-1)), 
-        0.0)
+interpolator = Interpolator(img_objects[0], img_objects[1])
+
+for i, tmp in enumerate(interpolator.frames(num_total_images)):
     cv2.imwrite("interpolate_{}.jpg".format(i), tmp)
     
     if BOOMERANG:
@@ -0,0 +1,225 @@
+import os
+import re
+import datetime
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+# directory layouts below the output directory
+LAYOUT_FLAT             = "FLAT"    # OUTPUT_DIR/000123.jpg
+LAYOUT_DATE             = "DATE"    # OUTPUT_DIR/2021-06-01/000123.jpg
+LAYOUT_BLOCK            = "BLOCK"   # OUTPUT_DIR/000/000123.jpg
+
+SEQUENCE_FILE           = ".sequence"
+SEQUENCE_DIGITS         = 6
+SEQUENCE_MAX            = 10 ** SEQUENCE_DIGITS
+DEFAULT_BLOCK_SIZE      = 1000
+DEFAULT_RESERVE         = 100
+SEQUENCE_RESERVED       = "reserved"
+
+FILENAME_PATTERN        = re.compile(r"^(?P<prefix>.*?)(?P<index>\d{6})(_\d+)?\..+$")
+
+
+class FilenameAllocator(object):
+
+    # Hands out capture filenames in O(1): the next free sequence number is kept in a small
+    # counter file next to the images. The directory is only scanned (once, with os.scandir)
+    # if the counter file is missing or unreadable.
+    #
+    # Sequence numbers are reserved in blocks of reserve: the counter file holds the end of
+    # the current block (marked SEQUENCE_RESERVED) and is only written when a block is used
+    # up, not for every capture. close() stores the actual next index. A counter file still
+    # marked SEQUENCE_RESERVED was not closed (crash or power loss), the next index is then
+    # rebuilt by a scan, so no number is handed out twice and no block is skipped.
+    # The counter file is replaced atomically (write tmp, fsync, rename), a torn write
+    # leaves the old value.
+
+    def __init__(self, output_dir, layout=LAYOUT_FLAT, block_size=DEFAULT_BLOCK_SIZE, reserve=DEFAULT_RESERVE):
+        self.output_dir = output_dir
+        self.layout     = layout
+        self.block_size = block_size
+        self.reserve    = reserve
+
+        self.lock       = Lock()
+        self.sequence   = {} # prefix -> next index
+        self.reserved   = {} # prefix -> end of the block reserved in the counter file
+
+    def __repr__(self):
+        return "FilenameAllocator at {} [{}]".format(self.output_dir, self.layout)
+
+    # all extensions are reserved for the returned sequence number, first extension
+    # is returned as file name candidate
+    def allocate(self, extensions, prefix=None): # returns [path, filename.ext]
+
+        if not type(extensions) is list:
+            extensions = [extensions]
+
+        extensions = ["jpg" if ext == "jpeg" else ext for ext in extensions]
+
+        if prefix is None:
+            prefix = ""
+
+        with self.lock:
+            index = self._next_index(prefix)
+
+            # the counter file may be older than the directory contents (e.g. files copied
+            # onto the card by hand), a single stat per candidate is enough to step over those
+            while self._exists(index, prefix, extensions):
+                index += 1
+
+            if index >= SEQUENCE_MAX:
+                raise Exception("no filenames left!")
+
+            self.sequence[prefix] = index + 1
+            self._reserve(prefix)
+
+        directory = self.get_directory(index)
+        os.makedirs(directory, exist_ok=True)
+
+        return [directory, "{}{:0{}d}.{}".format(prefix, index, SEQUENCE_DIGITS, extensions[0])]
+
+    # loads the counter and reserves the first block, the first allocate() does not wait for it
+    def prepare(self, prefix=None):
+
+        if prefix is None:
+            prefix = ""
+
+        with self.lock:
+            self._next_index(prefix)
+            self._reserve(prefix)
+
+    # stores the next index, the unused rest of the reserved block is given back
+    def close(self):
+
+        with self.lock:
+            for prefix in self.reserved.keys():
+                try:
+                    self._write_sequence(prefix, self.sequence[prefix])
+                except Exception as e:
+                    log.error("writing sequence file failed: {}".format(e))
+
+            self.reserved = {}
+
+    def get_directory(self, index):
+
+        if self.layout == LAYOUT_BLOCK:
+            return os.path.join(self.output_dir, "{:03d}".format(index // self.block_size))
+        elif self.layout == LAYOUT_DATE:
+            return os.path.join(self.output_dir, datetime.date.today().isoformat())
+        else:
+            return self.output_dir
+
+    def _exists(self, index, prefix, extensions):
+
+        directory = self.get_directory(index)
+        filename_base = "{}{:0{}d}".format(prefix, index, SEQUENCE_DIGITS)
+
+        for extension in extensions:
+            if os.path.exists(os.path.join(directory, "{}.{}".format(filename_base, extension))):
+                return True
+
+            if os.path.exists(os.path.join(directory, "{}_0.{}".format(filename_base, extension))):
+                return True
+
+        return False
+
+    def _get_sequence_filename(self, prefix):
+        if len(prefix) == 0:
+            return os.path.join(self.output_dir, SEQUENCE_FILE)
+        else:
+            return os.path.join(self.output_dir, "{}_{}".format(SEQUENCE_FILE, prefix))
+
+    def _next_index(self, prefix):
+
+        if prefix in self.sequence:
+            return self.sequence[prefix]
+
+        index = self._read_sequence(prefix)
+
+        if index is None:
+            index = self._rebuild_sequence(prefix)
+
+        self.sequence[prefix] = index
+        return index
+
+    # None if missing, unreadable or not closed (see SEQUENCE_RESERVED)
+    def _read_sequence(self, prefix):
+
+        try:
+            with open(self._get_sequence_filename(prefix), "r") as f:
+                fields = f.read().split()
+        except FileNotFoundError as e:
+            return None
+        except Exception as e:
+            log.warning("reading sequence file failed, rebuilding: {}".format(e))
+            return None
+
+        if SEQUENCE_RESERVED in fields[1:]:
+            log.info("sequence file for prefix '{}' was not closed, rebuilding".format(prefix))
+            return None
+
+        try:
+            return int(fields[0])
+        except Exception as e:
+            log.warning("reading sequence file failed, rebuilding: {}".format(e))
+            return None
+
+    # a new block is written once the current one is used up
+    def _reserve(self, prefix):
+
+        if self.sequence[prefix] < self.reserved.get(prefix, 0):
+            return
+
+        self.reserved[prefix] = self.sequence[prefix] + self.reserve
+        self._write_sequence(prefix, self.reserved[prefix], reserved=True)
+
+    def _write_sequence(self, prefix, index, reserved=False):
+
+        filename = self._get_sequence_filename(prefix)
+        filename_tmp = filename + ".tmp"
+
+        with open(filename_tmp, "w") as f:
+            if reserved:
+                f.write("{} {}\n".format(index, SEQUENCE_RESERVED))
+            else:
+                f.write("{}\n".format(index))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(filename_tmp, filename)
+
+    def _rebuild_sequence(self, prefix):
+
+        # one pass over the output directory and (if sharded) its subdirectories
+
+        highest = -1
+        num_files = 0
+
+        directories = [self.output_dir]
+
+        while len(directories) > 0:
+            directory = directories.pop()
+
+            try:
+                entries = os.scandir(directory)
+            except FileNotFoundError as e:
+                continue
+
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if directory == self.output_dir and not entry.name.startswith("."):
+                            directories.append(entry.path)
+                        continue
+
+                    match = FILENAME_PATTERN.match(entry.name)
+                    if match is None or match.group("prefix") != prefix:
+                        continue
+
+                    num_files += 1
+                    highest = max(highest, int(match.group("index")))
+
+        log.info("rebuilt sequence for prefix '{}' from {} file(s): next index {}".format(prefix, num_files, highest + 1))
+
+        return highest + 1
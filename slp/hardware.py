@@ -0,0 +1,47 @@
+import os
+import subprocess
+import logging
+
+log = logging.getLogger(__name__)
+
+# TLP_BACKEND=sim: fake cameras, buttons and controller (see simulation.py)
+BACKEND_DEVICE          = "device"
+BACKEND_SIM             = "sim"
+
+BACKEND                 = os.environ.get("TLP_BACKEND", BACKEND_DEVICE)
+
+if BACKEND == BACKEND_SIM:
+    import simulation
+    from simulation import GPIO, picamera
+elif BACKEND == BACKEND_DEVICE:
+    import RPi.GPIO as GPIO
+    import picamera
+else:
+    raise Exception("unknown backend: {}".format(BACKEND))
+
+
+def is_simulated():
+    return BACKEND == BACKEND_SIM
+
+
+# TLP_OUTPUT_DIR overrides the output directory with both backends
+def get_output_dir(default):
+    return os.environ.get("TLP_OUTPUT_DIR", default)
+
+
+def get_serial_port(default):
+
+    if is_simulated():
+        return simulation.get_controller_emulator().port
+
+    return default
+
+
+def poweroff():
+
+    # the process ends like the device would, the idle shutdown must not run a second time
+    if is_simulated():
+        log.info("simulated poweroff")
+        raise SystemExit(0)
+
+    subprocess.call(["poweroff"])
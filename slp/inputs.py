@@ -0,0 +1,169 @@
+import time
+import queue
+from threading import Lock, Timer
+import logging
+
+log = logging.getLogger(__name__)
+
+EVENT_PRESS             = "PRESS"       # button pressed (buttons without long press)
+EVENT_SHORT_PRESS       = "SHORT_PRESS" # released before long_press seconds
+EVENT_LONG_PRESS        = "LONG_PRESS"  # held for long_press seconds, still pressed
+EVENT_RELEASE           = "RELEASE"     # released after a long press
+
+DEFAULT_BOUNCETIME      = 20            # ms
+DEFAULT_LONG_PRESS      = 0.5           # s
+
+
+class InputEvent(object):
+
+    def __init__(self, name, event_type, timestamp, duration=None):
+        self.name       = name
+        self.type       = event_type
+        self.timestamp  = timestamp     # time.monotonic() of the edge
+        self.duration   = duration      # seconds the button was held (release events)
+
+    def __repr__(self):
+        return "InputEvent {} [{}]".format(self.name, self.type)
+
+
+class _Button(object):
+
+    def __init__(self, name, pin, active_level, long_press):
+        self.name           = name
+        self.pin            = pin
+        self.active_level   = active_level
+        self.long_press     = long_press
+
+        self.pressed        = False
+        self.time_press     = None
+        self.long_sent      = False
+        self.timer          = None
+
+
+class InputHandler(object):
+
+    # Button input via edge detection instead of polling. The GPIO library calls back
+    # on every (debounced) edge, the handler classifies presses by the timestamps of
+    # the edges and puts InputEvents into a queue. The main thread blocks in get()
+    # until an event arrives or its timeout (e.g. the idle time left) has passed.
+    #
+    # Buttons with a long_press time emit LONG_PRESS as soon as they are held that
+    # long (so a recording can start while the button is still down) and RELEASE
+    # afterwards, or SHORT_PRESS if released earlier. All other buttons emit PRESS.
+
+    def __init__(self, gpio, bouncetime=DEFAULT_BOUNCETIME):
+        self.gpio       = gpio
+        self.bouncetime = bouncetime
+
+        self.lock       = Lock()
+        self.queue      = queue.Queue()
+        self.buttons    = {}            # pin -> _Button
+
+    def __repr__(self):
+        return "InputHandler [{}]".format(", ".join([b.name for b in self.buttons.values()]))
+
+    # active_level: pin level while the button is pressed
+    # (0 for buttons pulling a pin with pull-up resistor to ground)
+    def add_button(self, name, pin, active_level=0, long_press=None):
+
+        button = _Button(name, pin, active_level, long_press)
+
+        with self.lock:
+            self.buttons[pin] = button
+
+        self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self._edge, bouncetime=self.bouncetime)
+
+    # blocks until the next event, None if timeout seconds passed without one
+    def get(self, timeout=None):
+
+        if timeout is not None and timeout < 0:
+            timeout = 0
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty as e:
+            return None
+
+    def is_pressed(self, name):
+        with self.lock:
+            for button in self.buttons.values():
+                if button.name == name:
+                    return button.pressed
+
+        return False
+
+    def close(self):
+
+        with self.lock:
+            for pin, button in self.buttons.items():
+                if button.timer is not None:
+                    button.timer.cancel()
+
+                try:
+                    self.gpio.remove_event_detect(pin)
+                except Exception as e:
+                    log.warning("removing edge detection for {} failed: {}".format(button.name, e))
+
+            self.buttons = {}
+
+    def _put(self, event):
+        log.debug("{}".format(event))
+        self.queue.put(event)
+
+    # GPIO callback thread
+    def _edge(self, pin):
+
+        timestamp = time.monotonic()
+        level = self.gpio.input(pin)
+
+        with self.lock:
+            button = self.buttons.get(pin)
+
+            if button is None:
+                return
+
+            # edges lost in the bounce time may report the same level twice
+            pressed = level == button.active_level
+            if pressed == button.pressed:
+                return
+
+            button.pressed = pressed
+
+            if pressed:
+                button.time_press = timestamp
+                button.long_sent = False
+
+                if button.long_press is None:
+                    self._put(InputEvent(button.name, EVENT_PRESS, timestamp))
+                    return
+
+                button.timer = Timer(button.long_press, self._long_press, args=[button, timestamp])
+                button.timer.daemon = True
+                button.timer.start()
+
+                return
+
+            if button.long_press is None:
+                return
+
+            duration = timestamp - button.time_press
+
+            if button.timer is not None:
+                button.timer.cancel()
+                button.timer = None
+
+            if button.long_sent:
+                self._put(InputEvent(button.name, EVENT_RELEASE, timestamp, duration=duration))
+            else:
+                self._put(InputEvent(button.name, EVENT_SHORT_PRESS, timestamp, duration=duration))
+
+    def _long_press(self, button, time_press):
+
+        with self.lock:
+
+            # released (or pressed again) in the meantime
+            if not button.pressed or button.time_press != time_press:
+                return
+
+            button.long_sent = True
+            self._put(InputEvent(button.name, EVENT_LONG_PRESS, time.monotonic(), duration=button.long_press))
@@ -0,0 +1,161 @@
+import os
+import json
+import math
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+PROFILE_FILE            = ".camera_profiles"
+
+# settings tables list the modes as [preview, still, video], the still
+# mode is probed first (fails first if the sensor is smaller than expected)
+PROBE_MODE              = 1
+
+
+class CameraProfile(object):
+
+    # Capabilities of a single camera: the sensor key of the settings table, the
+    # settings of all modes (verified once on the camera) and the padded size of
+    # an unencoded capture for every mode
+
+    def __init__(self, camera_num, revision, sensor, modes):
+        self.camera_num = camera_num
+        self.revision   = revision
+        self.sensor     = sensor
+        self.modes      = modes
+
+        # unencoded captures are padded by the camera: the horizontal resolution is rounded
+        # up to a multiple of 32 pixels, the vertical resolution to a multiple of 16
+        self.buffer_resolutions = [None if not "resolution" in m else [
+            math.ceil(m["resolution"][0] / 32) * 32,
+            math.ceil(m["resolution"][1] / 16) * 16] for m in modes]
+
+    def __repr__(self):
+        return "CameraProfile {} [{} | sensor: {}]".format(self.camera_num, self.revision, self.sensor)
+
+    def get_resolution(self, mode):
+        return self.modes[mode]["resolution"]
+
+    def to_dict(self):
+        return {
+            "camera_num":           self.camera_num,
+            "revision":             self.revision,
+            "sensor":               self.sensor,
+            "modes":                self.modes,
+            "buffer_resolutions":   self.buffer_resolutions
+        }
+
+    @staticmethod
+    def from_dict(d):
+        return CameraProfile(d["camera_num"], d["revision"], d["sensor"], d["modes"])
+
+
+class CameraProfiles(object):
+
+    # Sensor detection happens once per camera: the settings table is probed (trial
+    # reconfiguration, as the revision string does not always match a table key) and
+    # the result is stored in a small JSON file, keyed by camera number and revision.
+    # On later boots the profile is read from that file, and as long as the settings
+    # table for the sensor has not changed, no probing happens at all.
+    #
+    # Mode switches are a plain table lookup (apply()).
+
+    def __init__(self, filename, settings):
+        self.filename   = filename
+        self.settings   = settings
+
+        self.lock       = Lock()
+        self.profiles   = {}
+
+        self._load()
+
+    def __repr__(self):
+        return "CameraProfiles at {} [{} cached]".format(self.filename, len(self.profiles))
+
+    def get(self, cam, camera_num):
+
+        revision = str(cam.revision).upper()
+        key = "{}:{}".format(camera_num, revision)
+
+        with self.lock:
+            profile = self.profiles.get(key)
+
+            if profile is not None and self.settings.get(profile.sensor) == profile.modes:
+                log.debug("cam {} | cached profile: {}".format(camera_num, profile))
+                return profile
+
+            profile = self._detect(cam, camera_num, revision)
+
+            if profile is None:
+                return None
+
+            self.profiles[key] = profile
+            self._save()
+
+        log.info("cam {} | detected profile: {}".format(camera_num, profile))
+
+        return profile
+
+    # a direct lookup, no state of its own: used without a CameraProfiles instance too
+    @staticmethod
+    def apply(cam, profile, mode):
+
+        log.debug("change mode: {}".format(mode))
+
+        settings = profile.modes[mode]
+        for setting in settings:
+            setattr(cam, setting, settings[setting])
+
+    def _detect(self, cam, camera_num, revision):
+
+        from hardware import picamera
+
+        # the revision is the most likely match, try it first
+        candidates = list(self.settings.keys())
+        if revision in candidates:
+            candidates.remove(revision)
+            candidates.insert(0, revision)
+
+        for sensor in candidates:
+            try:
+                # every mode needs to be accepted by the camera
+                for mode in [PROBE_MODE] + list(range(0, len(self.settings[sensor]))):
+                    for setting in self.settings[sensor][mode]:
+                        setattr(cam, setting, self.settings[sensor][mode][setting])
+
+                return CameraProfile(camera_num, revision, sensor, self.settings[sensor])
+            except picamera.exc.PiCameraValueError as e:
+                log.debug("cam {} | failing setting camera resolution for {}, attempting fallback".format(camera_num, sensor))
+
+        log.error("cam {} | no matching camera settings for revision {}".format(camera_num, revision))
+
+        return None
+
+    def _load(self):
+
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+
+            for key in data:
+                self.profiles[key] = CameraProfile.from_dict(data[key])
+        except FileNotFoundError as e:
+            pass
+        except Exception as e:
+            log.warning("camera profiles unreadable, detecting again: {}".format(e))
+            self.profiles = {}
+
+    def _save(self):
+
+        filename_tmp = self.filename + ".tmp"
+
+        try:
+            with open(filename_tmp, "w") as f:
+                json.dump({key: profile.to_dict() for key, profile in self.profiles.items()}, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(filename_tmp, self.filename)
+        except Exception as e:
+            log.error("writing camera profiles failed: {}".format(e))
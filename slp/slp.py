@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 
 import time
-import datetime
 import os
 import sys
 import subprocess
 from fractions import Fraction
 import logging
 import traceback
+from threading import Thread
 
-import RPi.GPIO as GPIO
-import picamera
+# RPi.GPIO and picamera, or their simulated counterparts (TLP_BACKEND=sim)
+import hardware
+from hardware import GPIO, picamera
 
-from devices import CompressorCameraController
+from devices import CompressorCameraController, ControllerClient
+from allocator import FilenameAllocator, LAYOUT_FLAT, LAYOUT_DATE, LAYOUT_BLOCK
+from profiles import CameraProfiles, PROFILE_FILE
+from inputs import InputHandler, EVENT_SHORT_PRESS, EVENT_LONG_PRESS, EVENT_RELEASE
 
 # import numpy as np
 
@@ -20,22 +24,44 @@ from devices import CompressorCameraController
 BUTTON_SHUTTER          = 27
 PIN_LED                 = 22 
 
-OUTPUT_DIR              = "/media/storage"
+OUTPUT_DIR              = hardware.get_output_dir("/media/storage")
 OUTPUT_DIR_TMP          = "/home/pi/tmp"
 
+# LAYOUT_FLAT | LAYOUT_DATE | LAYOUT_BLOCK (subdirectories of FILENAME_BLOCK_SIZE images)
+FILENAME_LAYOUT         = LAYOUT_FLAT
+FILENAME_BLOCK_SIZE     = 1000
+
+# with TLP_BACKEND=sim the emulator's port is used instead (see hardware.get_serial_port)
 SERIAL_PORT             = "/dev/ttyAMA0"
+# binary frames instead of ASCII lines, if the controller firmware supports them
+# (see CompressorCameraController.BINARY_FRAMING)
+SERIAL_BINARY_FRAMING   = False
 
 IMAGE_FORMAT            = "jpeg"
 CAPTURE_RAW             = False
 SENSOR_MODE             = 0
 EXPOSURE_COMPENSATION   = 0
 
+# fast still: keep the sensor at still resolution (the preview is downscaled by the
+# renderer) so a capture does not need to switch between preview and still settings.
+# Capturing via the video port skips the still port pipeline too, at the expense of
+# slightly noisier images.
+# Off by default: when on, the preview runs at still resolution, with a lower frame rate
+# and more power draw and heat.
+FAST_STILL              = False
+FAST_STILL_VIDEO_PORT   = False
+
+# buttons: a press is long (video) if the shutter is held this long (seconds)
+LONG_PRESS_TIME         = 0.5
+BUTTON_BOUNCETIME       = 20 # ms
+
 # all units in seconds
 RECORDING_TIME_MAX      = 10
 MOUNTING_TIME_MAX       = 10
 
 IDLE_TIME_MAX           = 180
 # IDLE_TIME_MAX           = None
+CONTROLLER_TIMEOUT      = 2
 
 # consts
 MODE_IDLE   = 0
@@ -124,7 +150,17 @@ class Cam(object):
         self.camera_type        = None
         self.camera             = None
         self.timer_start        = None
-        self.last_interaction   = datetime.datetime.now()
+        self.last_interaction   = time.monotonic()
+        self.unmounted          = False
+        self.controller         = None
+        self.controller_thread  = None
+
+        # edge detection, loop() blocks until a button event arrives
+        self.inputs = InputHandler(GPIO, bouncetime=BUTTON_BOUNCETIME)
+        self.inputs.add_button("SHUTTER", BUTTON_SHUTTER, active_level=1, long_press=LONG_PRESS_TIME)
+
+        self.allocator          = FilenameAllocator(OUTPUT_DIR, layout=FILENAME_LAYOUT, block_size=FILENAME_BLOCK_SIZE)
+        self.allocator.prepare()
 
         self.camera = picamera.PiCamera(sensor_mode=SENSOR_MODE) 
 
@@ -133,30 +169,47 @@ class Cam(object):
 
         # self.camera.rotation = 90
 
-        for key in CAMERA_SETTINGS.keys():
-            try:
-                for setting in CAMERA_SETTINGS[key][0]:
+        # sensor detection happens once, the profile is reused on later boots
+        self.camera_profiles = CameraProfiles(os.path.join(OUTPUT_DIR, PROFILE_FILE), CAMERA_SETTINGS)
+        self.camera_profile = self.camera_profiles.get(self.camera, 0)
 
-                    # set to STILL settings to check if it fails
-                    setattr(self.camera, setting, CAMERA_SETTINGS[key][1][setting])
+        if self.camera_profile is None:
+            raise Exception("unknown sensor: {}".format(self.camera.revision))
 
-                    # set to PREVIEW settings if the correct model is known
-                    setattr(self.camera, setting, CAMERA_SETTINGS[key][0][setting])
+        self.camera_type = self.camera_profile.sensor
+        log.debug("camera settings applied: {}".format(self.camera_type))
 
-                log.debug("camera settings applied: {}".format(key))
-                self.camera_type = key
-                break
-            except picamera.exc.PiCameraValueError as e:
-                log.debug("failing setting camera resolution for {}, attempting fallback".format(key))
+        if FAST_STILL:
+            self.change_camera_settings(1)
+        else:
+            self.change_camera_settings(0)
 
         self.camera.start_preview(rotation=270)
 
         log.info("camera ready")
 
-        try:
-            self.controller = CompressorCameraController.find_by_portname(SERIAL_PORT)
+        # the controller is only needed at poweroff, it is probed in the background
+        self.controller_thread = Thread(target=self._init_controller, name="controller probe", daemon=True)
+        self.controller_thread.start()
+
+
+    def _init_controller(self):
 
-            if self.controller is not None:
+        try:
+            # the emulator's pseudo terminal changes with every run, no last known port
+            port_file = None
+            if not hardware.is_simulated():
+                port_file = os.path.join(OUTPUT_DIR, CompressorCameraController.PORT_FILE)
+
+            # last known port first, then SERIAL_PORT and all candidates in parallel
+            controller = CompressorCameraController.discover(
+                hardware.get_serial_port(SERIAL_PORT), 
+                port_file=port_file, 
+                binary_framing=SERIAL_BINARY_FRAMING)
+
+            if controller is not None:
+                # commands and telemetry reads run in the background from now on
+                self.controller = ControllerClient(controller)
                 log.info("controller found")
             else:
                 log.warning("no controller found")
@@ -168,23 +221,27 @@ class Cam(object):
 
         #self.camera.stop_preview()
 
-        settings = CAMERA_SETTINGS[self.camera_type][mode]
-
-        for key in settings:
-            setattr(self.camera, key, settings[key])
+        self.camera_profiles.apply(self.camera, self.camera_profile, mode)
 
         #self.camera.start_preview()
 
 
     def trigger(self):
 
-        self.change_camera_settings(1)
-
         filename = self.get_filename(IMAGE_FORMAT)
-        self.camera.capture(os.path.join(*filename), format=IMAGE_FORMAT, bayer=CAPTURE_RAW)
-        log.info("TRIGGER: {}".format(filename[1]))
-        
-        self.change_camera_settings(0)
+
+        time_start = time.perf_counter()
+
+        if FAST_STILL:
+            self.camera.capture(os.path.join(*filename), format=IMAGE_FORMAT, bayer=CAPTURE_RAW, use_video_port=FAST_STILL_VIDEO_PORT)
+        else:
+            self.change_camera_settings(1)
+            self.camera.capture(os.path.join(*filename), format=IMAGE_FORMAT, bayer=CAPTURE_RAW)
+            self.change_camera_settings(0)
+
+        shutter_lag = time.perf_counter() - time_start
+
+        log.info("TRIGGER: {} | shutter lag: {:.0f}ms".format(filename[1], shutter_lag * 1000))
 
 
     def start_recording(self):
@@ -199,7 +256,7 @@ class Cam(object):
         log.debug("recording file: {}".format(filename))
         self.camera.start_recording(os.path.join(*filename))
 
-        self.timer_start = datetime.datetime.now()
+        self.timer_start = time.monotonic()
 
 
     def stop_recording(self):
@@ -209,7 +266,10 @@ class Cam(object):
         self.mode = MODE_IDLE
         self.camera.stop_recording()
 
-        self.change_camera_settings(0)
+        if FAST_STILL:
+            self.change_camera_settings(1)
+        else:
+            self.change_camera_settings(0)
 
         # self.convert_last_video_to_gif()
 
@@ -218,33 +278,52 @@ class Cam(object):
 
         if self.mode == MODE_IDLE:
 
-            if GPIO.input(BUTTON_SHUTTER) == 1:
-                time.sleep(0.5)
+            # sleeps until the shutter is pressed or the next idle deadline
+            deadlines = []
+            if not self.unmounted:
+                deadlines.append(self.last_interaction + MOUNTING_TIME_MAX)
+            if IDLE_TIME_MAX is not None:
+                deadlines.append(self.last_interaction + IDLE_TIME_MAX)
 
-                self.last_interaction = datetime.datetime.now()
+            timeout = None
+            if len(deadlines) > 0:
+                timeout = min(deadlines) - time.monotonic()
+
+            event = self.inputs.get(timeout=timeout)
+
+            if event is not None:
+                self.last_interaction = time.monotonic()
+                self.unmounted = False
 
                 # single press: photo
-                if GPIO.input(BUTTON_SHUTTER) == 0:
+                if event.type == EVENT_SHORT_PRESS:
                     self.trigger()
-                
+
                 # long press: video
-                if GPIO.input(BUTTON_SHUTTER) == 1:
+                if event.type == EVENT_LONG_PRESS:
                     self.start_recording()
 
-            if (datetime.datetime.now() - self.last_interaction).total_seconds() > MOUNTING_TIME_MAX:
+                return
+
+            if not self.unmounted and time.monotonic() - self.last_interaction > MOUNTING_TIME_MAX:
                 unmount()
+                self.unmounted = True
+
+            if IDLE_TIME_MAX is not None and time.monotonic() - self.last_interaction > IDLE_TIME_MAX:
+
+                self.controller_thread.join(CONTROLLER_TIMEOUT)
 
-            if IDLE_TIME_MAX is not None and (datetime.datetime.now() - self.last_interaction).total_seconds() > IDLE_TIME_MAX:
-                    
                 if self.controller is not None:
                     try:
-                        self.controller.shutdown(delay=15000)
+                        self.controller.shutdown(delay=15000).result(timeout=CONTROLLER_TIMEOUT)
 
                     except Exception as e:
                         log.error("poweroff failed: {}".format(e))
                 else:
                     log.error("poweroff failed: {}".format("no controller found"))
 
+                self.allocator.close()
+
                 log.debug("logging shutdown")
                 logging.shutdown()
 
@@ -254,60 +333,48 @@ class Cam(object):
                 # wait a few sec before poweroff!
                 time.sleep(5)
 
-                subprocess.call(["poweroff"])
+                hardware.poweroff()
  
         elif self.mode == MODE_REC:
 
-            if (datetime.datetime.now() - self.timer_start).total_seconds() > RECORDING_TIME_MAX:
+            # sleeps until the shutter is released or the max recording time is over
+            event = self.inputs.get(timeout=self.timer_start + RECORDING_TIME_MAX - time.monotonic())
+
+            if event is None:
                 log.debug("recording time max exceeded")
                 self.stop_recording()
                 self.mode = MODE_IDLE
 
-            if GPIO.input(BUTTON_SHUTTER) == 0:
+            elif event.type == EVENT_RELEASE:
                 self.stop_recording()
                 self.mode = MODE_IDLE
 
-        # sleep loop
+            else:
+                # raises encoder errors
+                self.camera.wait_recording(0)
 
-        if self.mode == MODE_REC:
-            self.camera.wait_recording(0.1)
-        else:
-            time.sleep(0.1)
+            self.last_interaction = time.monotonic()
 
 
     # all extensions are checked for duplicate filenames, first extension 
     # is returned as file name candidate
     def get_filename(self, extensions, prefix=None): # returns(path, filename.ext)
+        return tuple(self.allocator.allocate(extensions, prefix=prefix))
 
-        if not type(extensions) is list:
-            extensions = [extensions]
-
-        for i in range(0, len(extensions)):
-            if extensions[i] == "jpeg":
-                extensions[i] = "jpg"
-
-        for i in range(0, 100000):
-
-            filename_base = "{:06d}.".format(i)
-            if not prefix is None:
-                filename_base = prefix + filename_base
-            duplicate_found = False
 
-            for extension in extensions:
-                filename = filename_base + extension
-                if os.path.exists(os.path.join(OUTPUT_DIR, filename)):
-                    duplicate_found = True
-                    break
+    def close(self):
 
-            if not duplicate_found:
-                return (OUTPUT_DIR, filename_base + extensions[0])
+        log.info("CLOSE")
 
-        raise Exception("no filenames left!")
+        self.allocator.close()
 
+        self.inputs.close()
 
-    def close(self):
+        if self.controller_thread is not None:
+            self.controller_thread.join(CONTROLLER_TIMEOUT)
 
-        log.info("CLOSE")
+        if self.controller is not None:
+            self.controller.close()
 
         if self.camera is not None:
             self.camera.stop_preview()
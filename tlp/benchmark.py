@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+# benchmarks of the capture and filter pipeline on simulated hardware (see simulation.py),
+# runs on any linux machine with ffmpeg. Results are written as JSON, compared to an
+# earlier result file with --baseline, regressions make the script exit with status 1.
+#
+# usage: python3 benchmark.py [--output benchmark.json] [--baseline old.json] [--quick]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+import logging
+
+# simulated hardware, needs to be set before tlp (or hardware) is imported
+os.environ.setdefault("TLP_BACKEND", "sim")
+
+SHOTS_LATENCY           = 10
+THROUGHPUT_DURATION     = 30        # seconds per filter setting
+FILENAME_COUNTS         = [1000, 10000, 100000]
+FILENAME_REPEAT         = 20        # get_filename calls per measurement
+CONTROLLER_COMMANDS     = 50
+FRAMING_ROUNDS          = 20        # telemetry reads per framing
+
+# relative change of a metric that counts as regression
+DEFAULT_TOLERANCE       = 0.2
+
+DEFAULT_OUTPUT          = "benchmark.json"
+
+# metrics where a higher value is better, all others: lower is better
+HIGHER_IS_BETTER        = ["shots_per_minute"]
+
+
+def _summary(values):
+
+    values = sorted(values)
+
+    return {
+        "n":        len(values),
+        "mean":     statistics.mean(values),
+        "median":   statistics.median(values),
+        "min":      values[0],
+        "max":      values[-1]
+    }
+
+
+def _create_tlcam(output_dir):
+
+    os.environ["TLP_OUTPUT_DIR"] = output_dir
+
+    import tlp
+
+    tlcam = tlp.TLCam()
+    tlcam.wait_ready()
+
+    return tlp, tlcam
+
+
+# --- shutter to file
+
+
+def benchmark_shutter_to_file(tlp, tlcam, num_shots):
+
+    # trigger (wall clock) to the last write of every capture file (mtime),
+    # filters are disabled so they do not compete with the writer
+
+    active_filter = tlcam.active_filter
+    tlcam.active_filter = None
+
+    latencies = {}
+
+    try:
+        for i in range(0, num_shots):
+            time_trigger = time.time()
+
+            tlcam.trigger()
+            tlcam.writer.flush()
+
+            for path in _get_newest_captures(tlcam, 2):
+                camera_num = os.path.splitext(path)[0].split("_")[-1]
+                latency = os.stat(path).st_mtime - time_trigger
+                latencies.setdefault("camera_{}".format(camera_num), []).append(latency * 1000)
+    finally:
+        tlcam.active_filter = active_filter
+
+    return {name: _summary(values) for name, values in latencies.items()}
+
+
+def _get_newest_captures(tlcam, num_cameras):
+
+    entries = [e for e in os.scandir(tlcam.allocator.output_dir) if e.is_file() and e.name.endswith(".jpg") and not e.name.startswith("filter_")]
+    entries = sorted(entries, key=lambda e: e.name)
+
+    return [e.path for e in entries[-num_cameras:]]
+
+
+# --- trigger throughput
+
+
+def benchmark_throughput(tlp, tlcam, duration):
+
+    # back to back triggers for duration seconds, with and without filter.
+    # A shot counts once it is captured, filters continue in the background
+    # (and are drained, so the next run starts idle)
+
+    results = {}
+
+    for filter_type in [None, tlp.DEFAULT_ACTIVE_FILTER]:
+
+        active_filter = tlcam.active_filter
+        tlcam.active_filter = filter_type
+
+        num_shots = 0
+        trigger_times = []
+        time_start = time.perf_counter()
+
+        try:
+            while time.perf_counter() - time_start < duration:
+                time_trigger = time.perf_counter()
+                tlcam.trigger()
+                trigger_times.append((time.perf_counter() - time_trigger) * 1000)
+                num_shots += 1
+
+            elapsed = time.perf_counter() - time_start
+
+            time_drain = time.perf_counter()
+            tlcam.writer.flush()
+            tlcam.scheduler.drain()
+            drain = time.perf_counter() - time_drain
+        finally:
+            tlcam.active_filter = active_filter
+
+        results[str(filter_type).lower()] = {
+            "shots":                num_shots,
+            "shots_per_minute":     num_shots / elapsed * 60,
+            "trigger_ms":           _summary(trigger_times),
+            "drain_s":              drain,
+            "pipeline":             tlcam.pipeline.get_stats()
+        }
+
+    return results
+
+
+# --- boomerang render
+
+
+def _render(extension, resolution, output_dir):
+
+    # runs in a fresh process, peak memory of this process and of its children (ffmpeg)
+
+    import encoder
+    import filters
+    import filter_boomerang
+    from simulation import FakePiCamera
+    from buffers import CaptureBuffer
+
+    # cold palette cache
+    encoder.PALETTE_CACHE_DIR = os.path.join(output_dir, "palettes_{}".format(extension))
+    filter_boomerang.EXTENSIONS = [extension]
+
+    cam = FakePiCamera(camera_num=0)
+    cam.resolution = resolution
+
+    images = []
+    for i in range(0, 2):
+        buffer = CaptureBuffer(resolution)
+        cam.capture(buffer.data, "bgr")
+        images.append(buffer.image)
+
+    cam.close()
+
+    filename = os.path.join(output_dir, "boomerang_{}".format(extension))
+
+    time_start = time.perf_counter()
+    filters.apply_filter(filters.FILTER_BOOMERANG, filename, images)
+    render_time = time.perf_counter() - time_start
+
+    return {
+        "render_s":             render_time,
+        "file_size":            os.path.getsize("{}.{}".format(filename, extension)),
+        "peak_rss_mb":          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_ffmpeg_mb":   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    }
+
+
+def benchmark_boomerang(resolution, output_dir):
+
+    import encoder
+
+    # spawn: the peak memory is not inflated by pages of the benchmark process
+    context = multiprocessing.get_context("spawn")
+
+    results = {}
+
+    for extension in encoder.FORMATS.keys():
+        with context.Pool(1) as pool:
+            results[extension] = pool.apply(_render, (extension, resolution, output_dir))
+
+    return results
+
+
+# --- get_filename
+
+
+def _legacy_get_filename(output_dir, extensions, prefix=None):
+
+    # TLCam.get_filename before the FilenameAllocator: one or two
+    # stats per existing file, starting at index 0
+
+    if not type(extensions) is list:
+        extensions = [extensions]
+
+    for i in range(0, len(extensions)):
+        if extensions[i] == "jpeg":
+            extensions[i] = "jpg"
+
+    for i in range(0, 100000):
+
+        filename_base = "{:06d}.".format(i)
+        if not prefix is None:
+            filename_base = prefix + filename_base
+        duplicate_found = False
+
+        for extension in extensions:
+
+            filename = filename_base + extension
+            if os.path.exists(os.path.join(output_dir, filename)):
+                duplicate_found = True
+                break
+
+            filename = filename_base + "_0" + extension
+            if os.path.exists(os.path.join(output_dir, filename)):
+                duplicate_found = True
+                break
+
+        if not duplicate_found:
+            return [output_dir, filename_base + extensions[0]]
+
+    raise Exception("no filenames left!")
+
+
+def _time_calls(func, repeat):
+
+    timings = []
+    for i in range(0, repeat):
+        time_start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - time_start) * 1000)
+
+    return _summary(timings)
+
+
+def benchmark_get_filename(counts, repeat, output_dir):
+
+    from allocator import FilenameAllocator, SEQUENCE_FILE
+
+    results = {}
+
+    for count in counts:
+
+        directory = os.path.join(output_dir, "filenames_{}".format(count))
+        os.makedirs(directory)
+
+        for i in range(0, count):
+            open(os.path.join(directory, "{:06d}.jpg".format(i)), "w").close()
+
+        result = {}
+
+        try:
+            # the legacy scan does not look at the files it returns, no cleanup needed
+            result["legacy_ms"] = _time_calls(lambda: _legacy_get_filename(directory, "jpeg"), max(1, repeat // 10))
+        except Exception as e:
+            result["legacy_ms"] = {"error": str(e)}
+
+        # no counter file: one directory scan on the first call
+        def cold():
+            sequence = os.path.join(directory, SEQUENCE_FILE)
+            if os.path.exists(sequence):
+                os.remove(sequence)
+            FilenameAllocator(directory).allocate("jpeg")
+
+        result["allocator_cold_ms"] = _time_calls(cold, max(1, repeat // 10))
+
+        allocator = FilenameAllocator(directory)
+        allocator.allocate("jpeg")
+        result["allocator_ms"] = _time_calls(lambda: allocator.allocate("jpeg"), repeat)
+
+        results[str(count)] = result
+
+        shutil.rmtree(directory)
+
+    return results
+
+
+# --- controller
+
+
+def _legacy_send_command(port, cmd):
+
+    # CompressorCameraController._send_command before the persistent session:
+    # port opened for every command, fixed size read (waits for the read timeout)
+
+    import serial
+    from devices import CompressorCameraController
+
+    ser = serial.Serial(port, CompressorCameraController.SERIAL_BAUDRATE, timeout=CompressorCameraController.SERIAL_TIMEOUT_READ, write_timeout=CompressorCameraController.SERIAL_TIMEOUT_WRITE)
+
+    try:
+        ser.write(bytearray(cmd + "\n", "utf-8"))
+        return ser.read(100)
+    finally:
+        ser.close()
+
+
+def benchmark_controller(num_commands):
+
+    # ping round trips to the controller emulator (its response latency included)
+
+    import simulation
+    from devices import CompressorCameraController
+
+    port = simulation.get_controller_emulator().port
+
+    results = {}
+
+    results["legacy_ms"] = _time_calls(lambda: _legacy_send_command(port, CompressorCameraController.CMD_PING), max(1, num_commands // 10))
+
+    controller = CompressorCameraController(port)
+
+    try:
+        # new connection for every command
+        def reconnect():
+            controller.close()
+            controller.ping()
+
+        results["reconnect_ms"] = _time_calls(reconnect, max(1, num_commands // 10))
+
+        controller.ping()
+        results["session_ms"] = _time_calls(controller.ping, num_commands)
+
+        stats = controller.get_stats()
+        results["connects"] = stats["connects"]
+        results["errors"] = stats["errors"]
+    finally:
+        controller.close()
+
+    return results
+
+
+def benchmark_framing(num_rounds):
+
+    # ASCII lines vs binary frames, emulated at the controller's line speed: one 
+    # round reads all telemetry values pipelined (like the ControllerClient does)
+
+    import simulation
+    from devices import CompressorCameraController, ControllerClient
+
+    commands = [(cmd, None) for cmd in ControllerClient.TELEMETRY.values()]
+
+    results = {}
+
+    for name, binary in [("ascii", False), ("binary", True)]:
+
+        emulator = simulation.ControllerEmulator(baudrate=CompressorCameraController.SERIAL_BAUDRATE)
+        controller = CompressorCameraController(emulator.port, binary_framing=binary)
+
+        try:
+            controller.ping()
+
+            stats_start = controller.get_stats()
+            result = {"telemetry_ms": _time_calls(lambda: controller._send_commands(commands), num_rounds)}
+            stats = controller.get_stats()
+
+            result["bytes_sent"] = (stats["bytes_sent"] - stats_start["bytes_sent"]) / num_rounds
+            result["bytes_received"] = (stats["bytes_received"] - stats_start["bytes_received"]) / num_rounds
+            result["errors"] = stats["errors"]
+
+            result["ping_ms"] = _time_calls(controller.ping, num_rounds)
+
+            results[name] = result
+        finally:
+            controller.close()
+            emulator.close()
+
+    return results
+
+
+# --- comparison
+
+
+def _flatten(data, prefix=""):
+
+    values = {}
+
+    for key, value in data.items():
+        name = "{}.{}".format(prefix, key) if len(prefix) > 0 else key
+
+        if type(value) is dict:
+            values.update(_flatten(value, prefix=name))
+        elif type(value) in [int, float] and not type(value) is bool:
+            values[name] = value
+
+    return values
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+
+    # compares the mean (or single value) metrics, returns a list of regressions
+
+    current = _flatten(results["results"])
+    previous = _flatten(baseline["results"])
+
+    regressions = []
+
+    for name, value in sorted(current.items()):
+
+        if not name in previous or previous[name] == 0:
+            continue
+
+        if not (name.endswith(".mean") or name.endswith("_s") or name.endswith("_mb") or name.split(".")[-1] in HIGHER_IS_BETTER):
+            continue
+
+        change = (value - previous[name]) / previous[name]
+
+        if name.split(".")[-1] in HIGHER_IS_BETTER:
+            change = -change
+
+        if change > tolerance:
+            regressions.append({"metric": name, "baseline": previous[name], "current": value, "change": change})
+
+    return regressions
+
+
+def _get_git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception as e:
+        return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="tlp capture and filter pipeline benchmark (simulated hardware)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare with an earlier results file, exit status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="relative change counting as regression")
+    parser.add_argument("--quick", action="store_true", help="fewer shots, shorter runs, no 100k filenames")
+    parser.add_argument("--skip", action="append", default=[], help="skip a benchmark (shutter_to_file, throughput, boomerang, get_filename, controller, framing)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    shots = SHOTS_LATENCY
+    duration = THROUGHPUT_DURATION
+    counts = FILENAME_COUNTS
+    commands = CONTROLLER_COMMANDS
+    rounds = FRAMING_ROUNDS
+
+    if args.quick:
+        shots = 3
+        duration = 5
+        counts = FILENAME_COUNTS[:2]
+        commands = 10
+        rounds = 5
+
+    output_dir = tempfile.mkdtemp(prefix="tlp_benchmark_")
+
+    results = {}
+
+    try:
+        if not "shutter_to_file" in args.skip or not "throughput" in args.skip:
+            tlp, tlcam = _create_tlcam(os.path.join(output_dir, "captures"))
+
+            try:
+                resolution = tlcam.camera_profile[0].get_resolution(tlp.MODE_STILL)
+
+                if not "shutter_to_file" in args.skip:
+                    results["shutter_to_file_ms"] = benchmark_shutter_to_file(tlp, tlcam, shots)
+
+                if not "throughput" in args.skip:
+                    results["throughput"] = benchmark_throughput(tlp, tlcam, duration)
+            finally:
+                tlcam.close()
+        else:
+            from simulation import SENSORS, DEFAULT_SENSOR
+            resolution = SENSORS[os.environ.get("TLP_SIM_SENSOR", DEFAULT_SENSOR).lower()]
+
+        if not "boomerang" in args.skip:
+            results["boomerang"] = benchmark_boomerang(resolution, output_dir)
+
+        if not "get_filename" in args.skip:
+            results["get_filename"] = benchmark_get_filename(counts, FILENAME_REPEAT, output_dir)
+
+        if not "controller" in args.skip:
+            results["controller"] = benchmark_controller(commands)
+
+        if not "framing" in args.skip:
+            results["framing"] = benchmark_framing(rounds)
+
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    report = {
+        "timestamp":    time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision":     _get_git_revision(),
+        "machine":      platform.machine(),
+        "python":       platform.python_version(),
+        "cpu_count":    os.cpu_count(),
+        "resolution":   resolution,
+        "quick":        args.quick,
+        "results":      results
+    }
+
+    exit_code = 0
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            report["regressions"] = compare(report, json.load(f), tolerance=args.tolerance)
+
+        if len(report["regressions"]) > 0:
+            exit_code = 1
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print("results written to {}".format(args.output))
+
+    for regression in report.get("regressions", []):
+        print("regression: {metric} {baseline:.3f} -> {current:.3f} ({change:+.0%})".format(**regression), file=sys.stderr)
+
+    sys.exit(exit_code)
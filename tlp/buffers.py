@@ -0,0 +1,174 @@
+import math
+from multiprocessing import shared_memory
+from threading import Condition
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_COUNT    = 2
+ACQUIRE_TIMEOUT         = 2.0
+
+
+def round_resolution(resolution):
+
+    # unencoded captures are padded by the camera: the horizontal resolution is rounded
+    # up to the nearest multiple of 32 pixels, the vertical resolution to a multiple of 16
+
+    return [
+        math.ceil(resolution[0] / 32) * 32,
+        math.ceil(resolution[1] / 16) * 16
+    ]
+
+
+class CaptureBuffer(object):
+
+    # A padded BGR capture buffer. The buffer is reference counted: everybody who
+    # keeps the image around after the capture (writer, filters) calls retain() and
+    # release() when done. If the count drops to zero the buffer returns to its pool.
+    #
+    # Shared buffers live in shared memory, filter processes attach to them 
+    # by name (see get_shared_descriptor()) instead of receiving a pickled copy.
+
+    def __init__(self, resolution, pool=None, shared=False):
+        self.resolution         = resolution
+        self.resolution_rounded = round_resolution(resolution)
+        self.pool               = pool
+        self.refcount           = 0
+        self.shm                = None
+
+        import numpy as np
+
+        size = self.resolution_rounded[1] * self.resolution_rounded[0] * 3
+
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.data = np.ndarray((size,), dtype=np.uint8, buffer=self.shm.buf)
+        else:
+            self.data = np.empty((size), dtype=np.uint8)
+
+        # view without the padding: rows are cut off at the end of the buffer, columns
+        # at the end of every row. Each row stays contiguous (only the row stride contains
+        # the padding), cv2 accepts this layout without copying.
+        self.image = self.data.reshape([self.resolution_rounded[1], self.resolution_rounded[0], 3])
+        self.image = self.image[:self.resolution[1], :self.resolution[0], :]
+
+    def __repr__(self):
+        return "CaptureBuffer {}x{} [refcount: {}]".format(*self.resolution, self.refcount)
+
+    # (shared memory name, padded resolution, resolution) or None if not shared
+    def get_shared_descriptor(self):
+        if self.shm is None:
+            return None
+
+        return (self.shm.name, self.resolution_rounded, self.resolution)
+
+    def close(self):
+        if self.shm is None:
+            return
+
+        self.data = None
+        self.image = None
+
+        try:
+            self.shm.close()
+        except BufferError as e:
+            log.warning("{} still in use while closing: {}".format(self, e))
+
+        self.shm.unlink()
+        self.shm = None
+
+    def retain(self):
+        if self.pool is not None:
+            self.pool._retain(self)
+        else:
+            self.refcount += 1
+
+        return self
+
+    def release(self):
+        if self.pool is not None:
+            self.pool._release(self)
+        else:
+            self.refcount -= 1
+
+
+class BufferPool(object):
+
+    # Ring of preallocated capture buffers for a single camera. Buffers are handed out
+    # in order and recycled once released. If all of them are in use, extra buffers
+    # (up to max_count buffers in total) are allocated on demand and freed again once
+    # released, so only count buffers stay resident. Beyond max_count a capture waits
+    # for a buffer; if none is free after ACQUIRE_TIMEOUT seconds a temporary buffer is
+    # allocated so a capture never fails because a filter is holding on to its images.
+
+    def __init__(self, resolution, count=DEFAULT_BUFFER_COUNT, max_count=None, shared=False):
+        self.resolution = resolution
+        self.shared     = shared
+        self.max_count  = max(count, max_count) if max_count is not None else count
+        self.condition  = Condition()
+
+        self.buffers    = [CaptureBuffer(resolution, pool=self, shared=shared) for i in range(0, count)]
+        self.extra      = []
+        self.next_index = 0
+
+    def __repr__(self):
+        return "BufferPool {}x{} [{}/{} free | extra: {}]".format(*self.resolution, self.get_num_free(), len(self.buffers), len(self.extra))
+
+    def get_num_free(self):
+        with self.condition:
+            return len([b for b in self.buffers if b.refcount == 0])
+
+    def acquire(self, timeout=ACQUIRE_TIMEOUT):
+
+        with self.condition:
+            buffer = self.condition.wait_for(self._find_free, timeout=timeout)
+
+            if buffer is None:
+                log.warning("{} exhausted, allocating temporary buffer".format(self))
+                buffer = CaptureBuffer(self.resolution)
+
+            buffer.refcount = 1
+            return buffer
+
+    def close(self):
+        with self.condition:
+            for buffer in self.buffers + self.extra:
+                buffer.close()
+
+            self.extra = []
+
+    def _find_free(self):
+
+        for i in range(0, len(self.buffers)):
+            index = (self.next_index + i) % len(self.buffers)
+            if self.buffers[index].refcount == 0:
+                self.next_index = (index + 1) % len(self.buffers)
+                return self.buffers[index]
+
+        if len(self.buffers) + len(self.extra) < self.max_count:
+            buffer = CaptureBuffer(self.resolution, pool=self, shared=self.shared)
+            self.extra.append(buffer)
+            log.debug("{} allocated extra buffer".format(self))
+            return buffer
+
+        return None
+
+    def _retain(self, buffer):
+        with self.condition:
+            buffer.refcount += 1
+
+    def _release(self, buffer):
+        with self.condition:
+            if buffer.refcount <= 0:
+                log.error("{} released too often".format(buffer))
+                return
+
+            buffer.refcount -= 1
+
+            if buffer.refcount == 0:
+                # extra buffers are not kept around
+                if buffer in self.extra:
+                    self.extra.remove(buffer)
+                    buffer.close()
+
+                self.condition.notify()
@@ -5,8 +5,12 @@ import time
 import os
 import subprocess
 import re
+import struct
 import serial.tools.list_ports
-from threading import Lock
+import queue
+import concurrent.futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Thread, Lock
 import logging
 
 try:
@@ -43,50 +47,224 @@ class CompressorCameraController(object):
     SERIAL_BAUDRATE         = 9600
     SERIAL_TIMEOUT_READ     = 0.2
     SERIAL_TIMEOUT_WRITE    = 0.2
+    SERIAL_TERMINATOR       = b"\n"
+    SERIAL_MAX_RESPONSE     = 100
+
+    # Binary framing (off by default), negotiated by ping(): the controller answers a ping with 
+    # FRAMING_REQUEST as parameter with FRAMING_REQUEST if it understands frames 
+    # (older firmware answers K or E and ASCII lines are used). Requests and responses:
+    #
+    #   FRAME_FLAG | payload length, command (response: K or E), payload, checksum
+    #
+    # The first byte has the high bit set (never the case for ASCII), the checksum is the
+    # sum of all preceding bytes (mod 256). Integers are packed little endian into as few
+    # bytes as needed, the battery status as raw ADC reading and mV (2 bytes each), the
+    # temperature in 0.1C (signed). Other parameters and values are sent as ASCII.
+    BINARY_FRAMING          = False
+    FRAMING_REQUEST         = "F1"
+    FRAME_FLAG              = 0x80
+    FRAME_MAX_PAYLOAD       = 0x7F
+
+    FRAME_INT_PARAMS        = [CMD_SHUTDOWN, CMD_LED, "Z"]
+    FRAME_INT_RESPONSES     = [CMD_UPTIME, CMD_DEBUG_REGISTER, CMD_NEXT_INVOCATION]
+
+    # discovery: all candidate ports are probed at the same time, the
+    # last port a controller was found at is stored in PORT_FILE
+    DISCOVERY_TIMEOUT       = 1.0
+    PORT_FILE               = ".controller_port"
+
+    # one lock per port: commands to a port are serialized, different ports are independent
+    locks = {}
+    locks_lock = Lock()
+
+    def __init__(self, port, binary_framing=None):
+        self.port = port
 
-    lock = Lock()
+        if binary_framing is None:
+            binary_framing = self.BINARY_FRAMING
 
-    def __init__(self, port):
-        self.port = port
+        # binary: frames are used once ping() has negotiated them
+        self.binary_framing = binary_framing
+        self.binary         = False
+
+        with self.locks_lock:
+            self.lock = self.locks.setdefault(port, Lock())
+
+        # the serial port is opened with the first command and kept open,
+        # after an error it is closed and reopened with the next command
+        self.serial = None
+
+        self.stats_lock = Lock()
+        self.stats = {
+            "commands":         0,
+            "errors":           0,
+            "connects":         0,
+            "bytes_sent":       0,
+            "bytes_received":   0,
+            "latency_last":     None,
+            "latency_max":      None,
+            "latency_sum":      0
+        }
 
     def __repr__(self):
         return "CompressorCameraController at {}".format(self.port) #self.SERIAL_DEVICE)
 
     @staticmethod
-    def find_all():
-
-        controller_list = []
-        
+    def get_candidate_ports():
         all_ports = list(serial.tools.list_ports.comports())
         log.debug("detecting CompressorCameraController: found {} port(s)".format(len(all_ports)))
-        for port in all_ports:
-            if "zero" in port[1].lower():
-                potential_controller = CompressorCameraController(port[0])
-                try:
-                    potential_controller.ping()
-                    controller_list.append(potential_controller)
-                except Exception as e:
-                    print(e)
+        return [port[0] for port in all_ports if "zero" in port[1].lower()]
+
+    @staticmethod
+    def find_all(timeout=DISCOVERY_TIMEOUT):
+
+        # all controllers answering a ping within timeout seconds
+
+        return CompressorCameraController._probe(CompressorCameraController.get_candidate_ports(), timeout)
+
+    @staticmethod
+    def find_by_portname(portname, timeout=DISCOVERY_TIMEOUT):
+
+        controllers = CompressorCameraController._probe([portname], timeout)
+
+        if len(controllers) > 0:
+            return controllers[0]
+
+        return None
+
+    @staticmethod
+    def discover(default_port=None, port_file=None, timeout=DISCOVERY_TIMEOUT, binary_framing=None):
+
+        # The last known port (read from port_file) is pinged first. If there is no 
+        # controller, default_port and all candidate ports are probed at the same time 
+        # and the first one answering is stored in port_file. Returns None if no 
+        # controller answered within timeout seconds (per attempt). binary_framing: see 
+        # BINARY_FRAMING, the ping negotiates the framing already.
+
+        last_port = CompressorCameraController._read_port(port_file)
+
+        if last_port is not None:
+            controllers = CompressorCameraController._probe([last_port], timeout, binary_framing=binary_framing)
+
+            if len(controllers) > 0:
+                log.debug("controller found at last known port {}".format(last_port))
+                return controllers[0]
+
+        ports = []
+        for port in [default_port] + CompressorCameraController.get_candidate_ports():
+            if port is not None and port != last_port and not port in ports:
+                ports.append(port)
+
+        controllers = CompressorCameraController._probe(ports, timeout, first=True, binary_framing=binary_framing)
+
+        if len(controllers) == 0:
+            return None
 
-            time.sleep(0.1)
+        if port_file is not None:
+            try:
+                CompressorCameraController._write_port(port_file, controllers[0].port)
+            except Exception as e:
+                log.warning("writing port file failed: {}".format(e))
 
-        return controller_list
+        return controllers[0]
 
     @staticmethod
-    def find_by_portname(portname):
+    def _probe(ports, timeout, first=False, binary_framing=None):
+
+        # pings all ports concurrently, returns the controllers that answered 
+        # in time (in order of ports). first: stops at the first answer
+
+        if len(ports) == 0:
+            return []
+
+        controllers = [CompressorCameraController(port, binary_framing=binary_framing) for port in ports]
+
+        executor = ThreadPoolExecutor(len(controllers))
+        futures = {executor.submit(controller.ping): controller for controller in controllers}
+        found = []
+
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=timeout):
+                if future.exception() is None:
+                    found.append(futures[future])
+
+                    if first:
+                        break
+        except concurrent.futures.TimeoutError as e:
+            log.debug("probing {} port(s): no answer within {:.1f}s".format(len(ports) - len(found), timeout))
+        finally:
+            executor.shutdown(wait=False)
+
+        # pings still running are not waited for, their port is closed once they return
+        for future, controller in futures.items():
+            if not controller in found:
+                future.add_done_callback(lambda f, controller=controller: controller.close())
+
+        return [controller for controller in controllers if controller in found]
+
+    @staticmethod
+    def _read_port(filename):
+
+        if filename is None:
+            return None
 
-        potential_controller = CompressorCameraController(portname)
         try:
-            potential_controller.ping()
-            return potential_controller
+            with open(filename, "r") as f:
+                port = f.read().strip()
+                return port if len(port) > 0 else None
+        except FileNotFoundError as e:
+            return None
         except Exception as e:
-            print(e)
+            log.warning("reading port file failed: {}".format(e))
+            return None
 
-        return None
+    @staticmethod
+    def _write_port(filename, port):
+
+        filename_tmp = filename + ".tmp"
+
+        with open(filename_tmp, "w") as f:
+            f.write("{}\n".format(port))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(filename_tmp, filename)
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+
+    # command latency in seconds (write until the terminated response is read)
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+
+        stats["latency_avg"] = None
+        if stats["commands"] > 0:
+            stats["latency_avg"] = stats["latency_sum"] / stats["commands"]
+
+        return stats
 
     def ping(self):
         try:
-            response = self._send_command(self.CMD_PING)
+            if self.binary_framing and not self.binary:
+                try:
+                    response = self._send_command(self.CMD_PING, param=self.FRAMING_REQUEST)
+                    self.binary = response == self.FRAMING_REQUEST
+
+                    # older firmware ignores the parameter, no need to ask again
+                    if not self.binary:
+                        self.binary_framing = False
+                except Exception as e:
+                    # firmware rejecting the parameter: plain ping, stay with ASCII
+                    log.debug("[{}] framing request failed: {}".format(self, e))
+                    response = self._send_command(self.CMD_PING)
+                    self.binary_framing = False
+
+                log.debug("[{}] framing: {}".format(self, "binary" if self.binary else "ASCII"))
+            else:
+                response = self._send_command(self.CMD_PING)
+
             return response
         except Exception as e:
             log.error(e)
@@ -94,21 +272,23 @@ class CompressorCameraController(object):
 
     def get_battery_status(self):
         try:
-            response = self._send_command(self.CMD_BATTERY)
+            return self.parse_battery_status(self._send_command(self.CMD_BATTERY))
+        except Exception as e:
+            log.error(e)
+            raise e
 
-            if len(response) < 2:
-                raise Exception("response too short [{}]".format(response))
+    @staticmethod
+    def parse_battery_status(response):
 
-            response = response.split(" ")
+        if response is None or len(response) < 2:
+            raise Exception("response too short [{}]".format(response))
 
-            if len(response) != 2:
-                raise Exception("response in unexpected format [{}]".format(response))
+        response = response.split(" ")
 
-            return float(response[1])
+        if len(response) != 2:
+            raise Exception("response in unexpected format [{}]".format(response))
 
-        except Exception as e:
-            log.error(e)
-            raise e
+        return float(response[1])
 
     def shutdown(self, delay=None):
         try:
@@ -180,57 +360,123 @@ class CompressorCameraController(object):
             log.debug(e)
             raise e
 
+    def _connect(self):
+
+        if self.serial is None:
+            self.serial = serial.Serial(self.port, self.SERIAL_BAUDRATE, timeout=self.SERIAL_TIMEOUT_READ, write_timeout=self.SERIAL_TIMEOUT_WRITE)
+
+            with self.stats_lock:
+                self.stats["connects"] += 1
+
+            log.debug("[{}] serial port opened".format(self))
+
+        return self.serial
+
+    def _disconnect(self):
+
+        if self.serial is None:
+            return
+
+        try:
+            self.serial.close()
+        except Exception as e:
+            log.debug("[{}] closing serial port failed: {}".format(self, e))
+
+        self.serial = None
+
     def _send_command(self, cmd, param=None):
-        response = ""
-        ser = None
+
+        response = self._send_commands([(cmd, param)])[0]
+
+        if isinstance(response, Exception):
+            raise response
+
+        return response
+
+    # pipelined: all commands are written at once and the responses are read in order,
+    # returns the response (or the exception) of every command. Keep the list short,
+    # the receive buffer of the controller is small
+    def _send_commands(self, commands):
+        responses = []
         lock_acquired = False
 
         try:
-            full_cmd = None
-            if param is None:
-                full_cmd = cmd
-            else:
-                full_cmd = "{} {}".format(cmd, param)
+            full_cmds = []
+            for cmd, param in commands:
+                if param is None:
+                    full_cmds.append(cmd)
+                else:
+                    full_cmds.append("{} {}".format(cmd, param))
 
-            log.debug("[{}] serial send: {}".format(self, full_cmd))
+            log.debug("[{}] serial send: {}".format(self, " | ".join(full_cmds)))
 
             lock_acquired = self.lock.acquire(timeout=1)
 
             if not lock_acquired:
                 raise AccessException("Lock could not be acquired")
 
-            ser = serial.Serial(self.port, self.SERIAL_BAUDRATE, timeout=self.SERIAL_TIMEOUT_READ, write_timeout=self.SERIAL_TIMEOUT_WRITE)
+            time_start = time.perf_counter()
+
+            ser = self._connect()
+
+            # a late response to an earlier command must not be taken for one of these
+            ser.reset_input_buffer()
+
+            binary = self.binary
+
+            if binary:
+                data = b"".join([self._encode_frame(full_cmd) for full_cmd in full_cmds])
+            else:
+                data = bytearray("".join([full_cmd + "\n" for full_cmd in full_cmds]), "utf-8")
+
+            ser.write(data)
 
-            ser.write(bytearray(full_cmd, "utf-8"))
-            ser.write(bytearray("\n", "utf-8"))
+            with self.stats_lock:
+                self.stats["bytes_sent"] += len(data)
 
-            response = ser.read(100)
-            response = response.decode("utf-8") 
+            for full_cmd in full_cmds:
 
-            # remove every non-alphanumeric / non-underscore / non-space / non-decimalpoint character
-            response = re.sub("[^a-zA-Z0-9_ .]", '', response)
+                if self.serial is None:
+                    # an earlier response was incomplete, the remaining ones can not be assigned
+                    responses.append(Exception("response lost [{}]".format(full_cmd)))
+                    continue
 
-            log.debug("[{}] serial receive: {}".format(self, response))
+                # both return as soon as the response is complete, the 
+                # read timeout only expires if the controller does not respond
+                if binary:
+                    response = self._read_frame(ser)
+                    complete = self._is_frame_complete(response)
+                else:
+                    response = ser.read_until(self.SERIAL_TERMINATOR, self.SERIAL_MAX_RESPONSE)
+                    complete = response.endswith(self.SERIAL_TERMINATOR)
 
-            if response is None or len(response) == 0:
-                log.debug("[{}] empty response".format(self))
-                raise Exception("empty response or timeout")
+                latency = time.perf_counter() - time_start
 
-            if response.startswith("E"):
-                log.debug("[{}] serial error: {}".format(self, response))
-                raise Exception("serial error: {}".format(response))
+                with self.stats_lock:
+                    self.stats["bytes_received"] += len(response)
 
-            if not response.startswith("K"):
-                log.debug("[{}] serial error, non K response: {}".format(self, response))
-                raise Exception("serial error, non K response: {}".format(response))
+                if not complete:
+                    # the rest of the response may still arrive, start over with the next 
+                    # command. Frames are negotiated again with the next ping (the
+                    # ControllerClient pings before its next batch)
+                    self._disconnect()
+                    self.binary = False
 
-            if len(response) > 1:
-                return response[2:]
-            else: 
-                return None
+                try:
+                    if binary:
+                        responses.append(self._parse_frame(full_cmd, response, latency))
+                    else:
+                        responses.append(self._parse_response(response, latency))
+                except Exception as e:
+                    log.error("comm failed, unknown exception: {}".format(e))
+                    self._error()
+                    responses.append(e)
+
+            return responses
 
         except serial.serialutil.SerialException as se:
             log.error("comm failed, SerialException: {}".format(se))
+            self._error(reconnect=True)
             raise se
 
         except AccessException as ae:
@@ -239,15 +485,405 @@ class CompressorCameraController(object):
 
         except Exception as e:
             log.error("comm failed, unknown exception: {}".format(e))
+            self._error()
             raise e
 
         finally:
-            if ser is not None:
-                ser.close()
-
             if lock_acquired:
                 self.lock.release()
 
+    def _parse_response(self, response, latency):
+
+        response = response.decode("utf-8") 
+
+        # remove every non-alphanumeric / non-underscore / non-space / non-decimalpoint character
+        response = re.sub("[^a-zA-Z0-9_ .]", '', response)
+
+        log.debug("[{}] serial receive: {} [{:.1f}ms]".format(self, response, latency * 1000))
+
+        if response is None or len(response) == 0:
+            log.debug("[{}] empty response".format(self))
+            raise Exception("empty response or timeout")
+
+        if response.startswith("E"):
+            log.debug("[{}] serial error: {}".format(self, response))
+            raise Exception("serial error: {}".format(response))
+
+        if not response.startswith("K"):
+            log.debug("[{}] serial error, non K response: {}".format(self, response))
+            raise Exception("serial error, non K response: {}".format(response))
+
+        self._record_latency(latency)
+
+        if len(response) > 1:
+            return response[2:]
+        else: 
+            return None
+
+    def _record_latency(self, latency):
+        with self.stats_lock:
+            self.stats["commands"] += 1
+            self.stats["latency_last"] = latency
+            self.stats["latency_sum"] += latency
+            if self.stats["latency_max"] is None or latency > self.stats["latency_max"]:
+                self.stats["latency_max"] = latency
+
+    @staticmethod
+    def _checksum(data):
+        return sum(data) & 0xFF
+
+    def _encode_frame(self, full_cmd):
+
+        parts = full_cmd.split(" ", 1)
+        cmd = parts[0]
+
+        payload = b""
+        if len(parts) > 1:
+            if cmd in self.FRAME_INT_PARAMS:
+                value = int(parts[1])
+                payload = value.to_bytes(max(1, (value.bit_length() + 7) // 8), "little")
+            else:
+                payload = parts[1].encode("utf-8")
+
+        if len(payload) > self.FRAME_MAX_PAYLOAD:
+            raise Exception("parameter too long [{}]".format(full_cmd))
+
+        frame = bytes([self.FRAME_FLAG | len(payload), ord(cmd)]) + payload
+
+        return frame + bytes([self._checksum(frame)])
+
+    def _read_frame(self, ser):
+
+        header = ser.read(1)
+
+        if len(header) < 1 or not header[0] & self.FRAME_FLAG:
+            return header
+
+        return header + ser.read((header[0] & self.FRAME_MAX_PAYLOAD) + 2)
+
+    def _is_frame_complete(self, frame):
+        return len(frame) >= 1 and frame[0] & self.FRAME_FLAG and len(frame) == (frame[0] & self.FRAME_MAX_PAYLOAD) + 3
+
+    def _parse_frame(self, full_cmd, frame, latency):
+
+        # returns the same strings as _parse_response() for the ASCII response
+
+        if len(frame) == 0:
+            log.debug("[{}] empty response".format(self))
+            raise Exception("empty response or timeout")
+
+        if not self._is_frame_complete(frame):
+            raise Exception("incomplete frame [{}]".format(frame.hex()))
+
+        status = chr(frame[1])
+        payload = frame[2:-1]
+
+        log.debug("[{}] serial receive: {} {} [{:.1f}ms]".format(self, status, payload.hex(), latency * 1000))
+
+        if self._checksum(frame[:-1]) != frame[-1]:
+            raise Exception("checksum mismatch [{}]".format(frame.hex()))
+
+        if status == "E":
+            raise Exception("serial error: E {}".format(payload.decode("utf-8", errors="replace")))
+
+        if status != "K":
+            raise Exception("serial error, non K response: {}".format(frame.hex()))
+
+        self._record_latency(latency)
+
+        if len(payload) == 0:
+            return None
+
+        cmd = full_cmd.split(" ", 1)[0]
+
+        if cmd == self.CMD_BATTERY:
+            raw, voltage = struct.unpack("<HH", payload)
+            return "{} {:.2f}".format(raw, voltage / 1000)
+        elif cmd == self.CMD_TEMPERATURE:
+            return "{:.1f}".format(int.from_bytes(payload, "little", signed=True) / 10)
+        elif cmd in self.FRAME_INT_RESPONSES:
+            return str(int.from_bytes(payload, "little"))
+        else:
+            return payload.decode("utf-8", errors="replace")
+
+    # called with the lock held
+    def _error(self, reconnect=False):
+
+        with self.stats_lock:
+            self.stats["errors"] += 1
+
+        if reconnect:
+            self._disconnect()
+
+
+class ControllerClient(object):
+
+    # Runs the commands of a CompressorCameraController in a background thread, callers
+    # never wait on the UART. Commands are queued, up to pipeline_depth of them are sent
+    # in one go over the controller's connection. The methods return a Future.
+    #
+    # Telemetry (read-only values) is cached and refreshed in the background once it is
+    # older than its TTL (seconds). The getters return the cached value right away, None
+    # until the value was read for the first time.
+
+    PIPELINE_DEPTH      = 4
+
+    TELEMETRY_BATTERY           = "battery"
+    TELEMETRY_TEMPERATURE       = "temperature"
+    TELEMETRY_UPTIME            = "uptime"
+    TELEMETRY_NEXT_INVOCATION   = "next_invocation"
+    TELEMETRY_DEBUG_REGISTER    = "debug_register"
+
+    # field: command
+    TELEMETRY = {
+        TELEMETRY_BATTERY:          CompressorCameraController.CMD_BATTERY,
+        TELEMETRY_TEMPERATURE:      CompressorCameraController.CMD_TEMPERATURE,
+        TELEMETRY_UPTIME:           CompressorCameraController.CMD_UPTIME,
+        TELEMETRY_NEXT_INVOCATION:  CompressorCameraController.CMD_NEXT_INVOCATION,
+        TELEMETRY_DEBUG_REGISTER:   CompressorCameraController.CMD_DEBUG_REGISTER
+    }
+
+    TTL = {
+        TELEMETRY_BATTERY:          30,
+        TELEMETRY_TEMPERATURE:      10,
+        TELEMETRY_UPTIME:           5,
+        TELEMETRY_NEXT_INVOCATION:  60,
+        TELEMETRY_DEBUG_REGISTER:   60
+    }
+
+    def __init__(self, controller, ttl=None, pipeline_depth=PIPELINE_DEPTH):
+        self.controller     = controller
+        self.pipeline_depth = pipeline_depth
+
+        self.ttl = dict(self.TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+
+        self.queue          = queue.Queue()
+        self.cache_lock     = Lock()
+        self.cache          = {} # field -> (value, monotonic time of the read)
+        self.refresh_at     = {field: 0 for field in self.TELEMETRY.keys()}
+        self.closed_lock    = Lock()
+        self.closed         = False
+
+        self.thread = Thread(target=self._run, name="ControllerClient", daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return "ControllerClient [{}]".format(self.controller)
+
+    # cmd: a command or a function called (without parameters) in the client's thread
+    def submit(self, cmd, param=None):
+
+        future = Future()
+
+        # nothing is queued once close() has been called, see _fail_pending()
+        with self.closed_lock:
+            if not self.closed:
+                self.queue.put((cmd, param, future))
+                return future
+
+        future.set_exception(Exception("client closed"))
+        return future
+
+    # through the controller's ping(), which negotiates the framing
+    def ping(self):
+        return self.submit(self.controller.ping)
+
+    def shutdown(self, delay=None):
+        return self.submit(CompressorCameraController.CMD_SHUTDOWN, param=delay)
+
+    def turn_zero_on(self, turn_on):
+        if turn_on:
+            return self.submit(CompressorCameraController.CMD_ZERO_ON)
+        else:
+            return self.submit(CompressorCameraController.CMD_ZERO_OFF)
+
+    def set_led(self, r, g, b):
+        return self.submit(CompressorCameraController.CMD_LED, r << 16 | g << 8 | b << 0)
+
+    def reduce_interval(self):
+        return self.submit(CompressorCameraController.CMD_RED_INTERVAL)
+
+    def increase_interval(self):
+        return self.submit(CompressorCameraController.CMD_INC_INTERVAL)
+
+    def get_battery_status(self, max_age=None):
+        return self.get(self.TELEMETRY_BATTERY, max_age=max_age)
+
+    def get_temperature(self, max_age=None):
+        return self.get(self.TELEMETRY_TEMPERATURE, max_age=max_age)
+
+    def get_uptime(self, max_age=None):
+        return self.get(self.TELEMETRY_UPTIME, max_age=max_age)
+
+    def get_next_invocation(self, max_age=None):
+        return self.get(self.TELEMETRY_NEXT_INVOCATION, max_age=max_age)
+
+    def get_debug_register(self, max_age=None):
+        return self.get(self.TELEMETRY_DEBUG_REGISTER, max_age=max_age)
+
+    # cached value, None if not read yet or older than max_age seconds
+    def get(self, field, max_age=None):
+
+        with self.cache_lock:
+            entry = self.cache.get(field)
+
+        if entry is None:
+            return None
+
+        value, time_read = entry
+
+        if max_age is not None and time.monotonic() - time_read > max_age:
+            return None
+
+        return value
+
+    def get_telemetry(self):
+        return {field: self.get(field) for field in self.TELEMETRY.keys()}
+
+    # refresh a field (or all) with the next batch of commands
+    def refresh(self, field=None):
+
+        with self.cache_lock:
+            for key in self.refresh_at.keys():
+                if field is None or key == field:
+                    self.refresh_at[key] = 0
+
+        self.queue.put(None)
+
+    def close(self, timeout=None):
+
+        with self.closed_lock:
+            self.closed = True
+            self.queue.put(None)
+
+        self.thread.join(timeout)
+
+        # the thread fails the pending commands when it exits, unless the join timed out
+        self._fail_pending()
+
+        self.controller.close()
+
+    # fails the given commands and everything still queued
+    def _fail_pending(self, batch=None):
+
+        items = list(batch) if batch is not None else []
+
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty as e:
+                break
+
+        for item in items:
+            if item is not None:
+                item[2].set_exception(Exception("client closed"))
+
+    def _get_stale(self, num):
+
+        now = time.monotonic()
+        stale = []
+
+        with self.cache_lock:
+            for field in sorted(self.refresh_at.keys(), key=lambda field: self.refresh_at[field]):
+                if len(stale) >= num or self.refresh_at[field] > now:
+                    break
+
+                stale.append(field)
+
+                # a failed read is not retried before the TTL is over either
+                self.refresh_at[field] = now + self.ttl[field]
+
+        return stale
+
+    def _run(self):
+
+        batch = []
+
+        while not self.closed:
+
+            with self.cache_lock:
+                timeout = max(0, min(self.refresh_at.values()) - time.monotonic())
+
+            batch = []
+
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is not None:
+                    batch.append(item)
+            except queue.Empty as e:
+                pass
+
+            if self.closed:
+                break
+
+            while len(batch) < self.pipeline_depth:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty as e:
+                    break
+
+                if item is not None:
+                    batch.append(item)
+
+            # functions (ping) are not part of the pipelined batch
+            calls = [item for item in batch if callable(item[0])]
+            batch = [item for item in batch if not callable(item[0])]
+
+            for fn, param, future in calls:
+                try:
+                    future.set_result(fn())
+                except Exception as e:
+                    future.set_exception(e)
+
+            # telemetry fills up the batch, queued commands go first
+            stale = self._get_stale(self.pipeline_depth - len(batch))
+
+            if len(batch) == 0 and len(stale) == 0:
+                continue
+
+            # frames are dropped after an incomplete response, negotiate them again
+            if self.controller.binary_framing and not self.controller.binary:
+                try:
+                    self.controller.ping()
+                except Exception as e:
+                    log.debug("framing negotiation failed: {}".format(e))
+
+            commands = [(cmd, param) for cmd, param, future in batch]
+            commands += [(self.TELEMETRY[field], None) for field in stale]
+
+            try:
+                responses = self.controller._send_commands(commands)
+            except Exception as e:
+                responses = [e] * len(commands)
+
+            for (cmd, param, future), response in zip(batch, responses[:len(batch)]):
+                if isinstance(response, Exception):
+                    future.set_exception(response)
+                else:
+                    future.set_result(response)
+
+            for field, response in zip(stale, responses[len(batch):]):
+                if isinstance(response, Exception):
+                    log.debug("reading {} failed: {}".format(field, response))
+                    continue
+
+                try:
+                    if field == self.TELEMETRY_BATTERY:
+                        response = CompressorCameraController.parse_battery_status(response)
+                except Exception as e:
+                    log.debug("reading {} failed: {}".format(field, e))
+                    continue
+
+                with self.cache_lock:
+                    self.cache[field] = (response, time.monotonic())
+
+            batch = []
+
+        # a batch taken from the queue when close() was called is never sent
+        self._fail_pending(batch)
+
 
 class AccessException(Exception):
     pass
@@ -0,0 +1,213 @@
+import os
+import glob
+import shlex
+import shutil
+import hashlib
+import subprocess
+import tempfile
+
+import cv2
+import numpy as np
+
+import metrics
+
+TMP_DIR                 = "/tmp"
+
+# pipe raw BGR frames into ffmpeg's stdin instead of
+# writing JPEGs to TMP_DIR and decoding them again
+STREAM_FRAMES           = True
+
+# gif palettes are computed once from the source images of a filter (all frames are blends
+# of those) and cached, a re-render of the same capture reuses the palette
+PALETTE_CACHE_DIR       = os.path.join(TMP_DIR, "palettes")
+PALETTE_CACHE_SIZE      = 32
+
+# the second (reversed) half of the boomerang is created by ffmpeg from the frames it
+# already received, frames are neither generated nor transferred twice
+FFMPEG_BOUNCE_OFF       = "split[fwd][bwd];[bwd]reverse[rev];[fwd][rev]concat=n=2:v=1:a=0"
+
+# all formats are encoded by a single ffmpeg process from one decoded input stream.
+# filter: branch of the filter graph for this format, reads from [{input}] and writes
+# to [{output}]. Internal labels are prefixed with {id} to keep them unique.
+# filter_palette (optional): branch used if a precomputed palette is available as [{palette}]
+# params: output options
+FORMATS = {}
+FORMATS["gif"]  = {
+    "filter":           "[{input}]split[{id}s0][{id}s1];[{id}s0]palettegen[{id}p];[{id}s1][{id}p]paletteuse=diff_mode=rectangle[{output}]",
+    "filter_palette":   "[{input}][{palette}]paletteuse=diff_mode=rectangle[{output}]",
+    "params":           "-loop 0 -gifflags +offsetting+transdiff"
+}
+FORMATS["webm"] = {
+    "filter":   "[{input}]null[{output}]",
+    "params":   "-an -c libvpx-vp9 -b:v 0 -crf 41"
+}
+FORMATS["mp4"]  = {
+    "filter":   "[{input}]crop=trunc(iw/2)*2:trunc(ih/2)*2[{output}]",
+    "params":   "-an -b:v 0 -crf 25 -f mp4 -vcodec libx264 -pix_fmt yuv420p"
+}
+
+
+def get_palette(images):
+
+    # palette for the gif encoder, generated from the (downscaled) source images 
+    # of a filter. Palettes are cached in PALETTE_CACHE_DIR by image content.
+
+    key = hashlib.sha1()
+    for img in images:
+        key.update(str(img.shape).encode("utf-8"))
+        key.update(np.ascontiguousarray(img).data)
+
+    filename = os.path.join(PALETTE_CACHE_DIR, "{}.png".format(key.hexdigest()))
+
+    if os.path.exists(filename):
+        return filename
+
+    os.makedirs(PALETTE_CACHE_DIR, exist_ok=True)
+
+    # unique per worker and outside the "*.png" pattern the pruning below looks at
+    fd, filename_tmp = tempfile.mkstemp(suffix=".tmp", dir=PALETTE_CACHE_DIR)
+    os.close(fd)
+
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", 
+        "-f", "rawvideo", "-pix_fmt", "bgr24", 
+        "-s", "{}x{}".format(images[0].shape[1], images[0].shape[0]), 
+        "-i", "-", 
+        "-vf", "palettegen=stats_mode=full", 
+        "-c:v", "png", "-f", "image2", "-update", "1",
+        filename_tmp]
+
+    try:
+        with metrics.span("filter.palette"):
+            subprocess.run(cmd, input=b"".join([img.tobytes() for img in images]), check=True)
+        os.replace(filename_tmp, filename)
+    except Exception as e:
+        os.remove(filename_tmp)
+        raise e
+
+    # keep only the most recent palettes, other workers may be pruning at the same time
+    palettes = []
+    for palette in glob.glob(os.path.join(PALETTE_CACHE_DIR, "*.png")):
+        try:
+            palettes.append((os.path.getmtime(palette), palette))
+        except FileNotFoundError as e:
+            pass
+
+    for mtime, palette in sorted(palettes)[:-PALETTE_CACHE_SIZE]:
+        try:
+            os.remove(palette)
+        except FileNotFoundError as e:
+            pass
+
+    return filename
+
+
+def _get_input_args(palette):
+
+    # the palette (if any) is always the second input, [1:v]
+
+    if palette is None:
+        return []
+
+    return ["-i", palette]
+
+
+def _get_output_args(filename, extensions, framerate, bounce_off, palette=None):
+
+    # [0:v] -> fps (-> bounce) -> split into one branch per format -> encoder per format
+
+    graph = "[0:v]fps={}".format(framerate)
+    if bounce_off:
+        graph += "," + FFMPEG_BOUNCE_OFF
+    graph += ",split={}".format(len(extensions))
+    graph += "".join(["[in_{}]".format(extension) for extension in extensions])
+
+    args = []
+
+    for extension in extensions:
+        branch = FORMATS[extension]["filter"]
+        if palette is not None and "filter_palette" in FORMATS[extension]:
+            branch = FORMATS[extension]["filter_palette"]
+
+        graph += ";" + branch.format(
+            input="in_{}".format(extension), 
+            output="out_{}".format(extension), 
+            palette="1:v",
+            id="{}_".format(extension))
+
+        args += ["-map", "[out_{}]".format(extension)]
+        args += shlex.split(FORMATS[extension]["params"])
+        args += ["{}.{}".format(filename, extension)]
+
+    return ["-filter_complex", graph] + args
+
+
+def encode_stream(frames, filename, extensions, framerate, bounce_off=False, palette=None):
+
+    # frames: iterable of BGR images of identical size
+    # the size of the rawvideo stream is taken from the first frame
+
+    process = None
+
+    # frames are generated (blended) while ffmpeg encodes, the time spent in
+    # either is summed up over all frames
+    blend = metrics.Accumulator("filter.blend")
+    pipe = metrics.Accumulator("filter.ffmpeg_pipe")
+
+    frames = iter(frames)
+
+    try:
+        while True:
+            with blend:
+                frame = next(frames, None)
+
+            if frame is None:
+                break
+
+            if process is None:
+                cmd = ["ffmpeg", "-y", 
+                    "-f", "rawvideo", "-pix_fmt", "bgr24", 
+                    "-s", "{}x{}".format(frame.shape[1], frame.shape[0]), 
+                    "-r", str(framerate), 
+                    "-i", "-"]
+                cmd += _get_input_args(palette)
+                cmd += _get_output_args(filename, extensions, framerate, bounce_off, palette=palette)
+
+                process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+            # rows of the capture views may be padded, tobytes() writes the visible area only
+            with pipe:
+                process.stdin.write(frame.tobytes())
+
+    finally:
+        blend.record()
+        pipe.record()
+
+        if process is not None:
+            with metrics.span("filter.ffmpeg_wait"):
+                process.stdin.close()
+                returncode = process.wait()
+
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, "ffmpeg")
+
+
+def encode_files(frames, filename, extensions, framerate, bounce_off=False, palette=None):
+
+    # frames are written as JPEGs to a directory of their own in TMP_DIR first
+    # (filter workers encode in parallel), only the forward half of a boomerang is written
+
+    tmp_dir = tempfile.mkdtemp(prefix="interpolate_", dir=TMP_DIR)
+
+    try:
+        with metrics.span("filter.tmp_write"):
+            for i, frame in enumerate(frames):
+                cv2.imwrite(os.path.join(tmp_dir, "interpolate_{}.jpg".format(i)), frame)
+
+        cmd = ["ffmpeg", "-y", "-framerate", str(framerate), "-i", os.path.join(tmp_dir, "interpolate_%d.jpg")]
+        cmd += _get_input_args(palette)
+        cmd += _get_output_args(filename, extensions, framerate, bounce_off, palette=palette)
+
+        with metrics.span("filter.ffmpeg"):
+            subprocess.run(cmd, check=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,33 @@
+import encoder
+from interpolation import Interpolator
+
+NUM_INTERPOLATIONS      = 8
+EXTENSIONS              = ["gif"]
+BOUNCE_OFF              = True
+FRAMERATE               = 10
+
+
+# yields the blended frames one by one, so frames can be 
+# consumed by an encoder without keeping the whole sequence in memory.
+# The frame buffer is reused, every frame needs to be consumed before the next one
+def interpolate_frames(images, num_interpolations):
+
+    interpolator = Interpolator(images[0], images[1])
+    return interpolator.frames(num_interpolations + 2)
+
+
+def apply(filename, images):
+
+    palette = None
+    if "gif" in EXTENSIONS:
+        palette = encoder.get_palette(images)
+
+    # all formats are encoded from a single pass over the frames
+    frames = interpolate_frames(images, NUM_INTERPOLATIONS)
+
+    if encoder.STREAM_FRAMES:
+        encoder.encode_stream(frames, filename, EXTENSIONS, FRAMERATE, bounce_off=BOUNCE_OFF, palette=palette)
+    else:
+        encoder.encode_files(frames, filename, EXTENSIONS, FRAMERATE, bounce_off=BOUNCE_OFF, palette=palette)
+
+    print("finished {}".format(filename))
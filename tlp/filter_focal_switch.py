@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+
+import encoder
+from interpolation import Interpolator, get_weight_schedule
+
+NUM_INTERPOLATIONS      = 20-2
+EXTENSIONS              = ["mp4"]
+BOUNCE_OFF              = True
+FRAMERATE               = 25
+
+# the image with the higher focal length (more zoomed in) is warped into the other one
+ZOOMED_INDEX            = 0
+
+NUM_FEATURES            = 1000
+MIN_MATCH_COUNT         = 6
+
+
+def find_homography(img_zoomed, img_wide):
+
+    # ORB instead of SURF: SURF is not part of the default OpenCV builds (nonfree)
+
+    orb = cv2.ORB_create(nfeatures=NUM_FEATURES)
+    kp1, des1 = orb.detectAndCompute(cv2.cvtColor(img_zoomed, cv2.COLOR_BGR2GRAY), None)
+    kp2, des2 = orb.detectAndCompute(cv2.cvtColor(img_wide, cv2.COLOR_BGR2GRAY), None)
+
+    if des1 is None or des2 is None:
+        raise Exception("no keypoints found")
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    matches = matcher.knnMatch(des1, des2, k=2)
+
+    good = []
+    for match in matches:
+        if len(match) == 2:
+            m, n = match
+            if m.distance < 0.7*n.distance:
+                good.append(m)
+
+    if len(good) < MIN_MATCH_COUNT:
+        raise Exception("not enough matches are found - {}/{}".format(len(good), MIN_MATCH_COUNT))
+
+    src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1,1,2)
+    dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1,1,2)
+
+    M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+
+    if M is None:
+        raise Exception("no homography found")
+
+    return M
+
+
+# yields the blended and warped frames one by one, the frame buffer is reused
+def focal_frames(images, num_interpolations):
+
+    img_zoomed = images[ZOOMED_INDEX]
+    img_wide = images[1-ZOOMED_INDEX]
+
+    M = find_homography(img_zoomed, img_wide)
+
+    height, width = img_wide.shape[:2]
+    img_zoomed_warp = cv2.warpPerspective(img_zoomed, M, (width, height))
+
+    # blend the warped image into the wide image wherever the warped image has content
+    interpolator = Interpolator(img_wide, img_zoomed_warp, mask=(img_zoomed_warp > 0))
+
+    diff = np.identity(3) - np.linalg.inv(M)
+    out = np.empty(img_wide.shape, dtype=np.uint8)
+
+    for weight in get_weight_schedule(num_interpolations + 2):
+        M_intermediate = np.identity(3) - weight * diff
+        yield cv2.warpPerspective(interpolator.interpolate(weight), M_intermediate, (width, height), dst=out)
+
+
+def apply(filename, images):
+
+    palette = None
+    if "gif" in EXTENSIONS:
+        palette = encoder.get_palette(images)
+
+    frames = focal_frames(images, NUM_INTERPOLATIONS)
+
+    if encoder.STREAM_FRAMES:
+        encoder.encode_stream(frames, filename, EXTENSIONS, FRAMERATE, bounce_off=BOUNCE_OFF, palette=palette)
+    else:
+        encoder.encode_files(frames, filename, EXTENSIONS, FRAMERATE, bounce_off=BOUNCE_OFF, palette=palette)
+
+    print("finished {}".format(filename))
@@ -1,65 +1,124 @@
-import os
-import subprocess
+import importlib
 
-import cv2
-import numpy as np
+import metrics
 
 FILTER_RESET            = "RESET"
 FILTER_BOOMERANG        = "BOOMERANG"
 FILTER_FOCAL_SWITCH     = "FOCAL_SWITCH"
 
-TMP_DIR                 = "/tmp"
+MB                      = 1024 * 1024
+
+# render filters at capture resolution (explicit opt-in, slow and memory hungry)
+FULL_RESOLUTION         = False
+
+
+class FilterSpec(object):
+
+    # A registered filter. The implementation (module with an apply(filename, images)
+    # function) is imported the first time the filter is applied, so neither the main
+    # process nor the filter workers pay for filters (and their dependencies) not in use.
+    #
+    # output_width: width in pixels the captured images are resized to before any per-frame
+    #               work is done (height keeps the aspect ratio). None: full resolution
+    # memory:       bytes of memory the filter needs while running (at output_width)
+    # cpu:          number of cores the filter keeps busy (ffmpeg encoder threads)
+
+    def __init__(self, name, module, output_width=None, memory=0, cpu=1):
+        self.name           = name
+        self.module         = module
+        self.output_width   = output_width
+        self.memory         = memory
+        self.cpu            = cpu
+
+        self.implementation = None
+
+    def __repr__(self):
+        return "FilterSpec {} [{}]".format(self.name, self.module)
+
+    def load(self):
+        if self.implementation is None:
+            self.implementation = importlib.import_module(self.module)
+
+        return self.implementation
+
+
+FILTERS = {}
+
+def register_filter(spec):
+    FILTERS[spec.name] = spec
+    return spec
+
+register_filter(FilterSpec(FILTER_BOOMERANG,      "filter_boomerang",     output_width=640, memory=48*MB,  cpu=1))
+register_filter(FilterSpec(FILTER_FOCAL_SWITCH,   "filter_focal_switch",  output_width=720, memory=96*MB,  cpu=2))
+
+
+def get_filter_spec(filter_type):
+
+    spec = FILTERS.get(filter_type)
+
+    if spec is None:
+        raise Exception("unknown filter type: {}".format(filter_type))
+
+    return spec
+
 
 def select_filter(payload):
-    if payload == filters.FILTER_RESET:
+
+    # FILTER_RESET, a registered filter type or None if the payload is unknown
+
+    if payload == FILTER_RESET:
         return FILTER_RESET
-    elif payload == filters.FILTER_BOOMERANG:
-        return filters.FILTER_BOOMERANG
-    elif payload == filters.FILTER_FOCAL_SWITCH:
-        return filters.FILTER_FOCAL_SWITCH
+    elif payload in FILTERS:
+        return payload
     else:
         return None
 
 
-def apply_boomerang(filename, images):
-        
-    NUM_INTERPOLATIONS  = 8
-    EXTENSIONS          = ["gif"]
-    BOUNCE_OFF          = True
+def get_output_width(filter_type, full_resolution=None):
+
+    if full_resolution is None:
+        full_resolution = FULL_RESOLUTION
+
+    if full_resolution:
+        return None
+
+    return get_filter_spec(filter_type).output_width
+
+
+def resize_images(images, width):
+
+    import cv2
+
+    # area interpolation: best quality for downscaling, and
+    # cheaper than filtering every blended frame in ffmpeg later
+    resized = []
+
+    for img in images:
+        height, img_width = img.shape[:2]
+
+        if width is None or width >= img_width:
+            resized.append(img)
+            continue
 
-    # IMAGES              = ["1.jpg", "2.jpg"]
+        size = (width, round(height * width / img_width))
+        resized.append(cv2.resize(img, size, interpolation=cv2.INTER_AREA))
 
-    PARAMS = {}
-    PARAMS["gif"]  = "-vf \"fps=10,scale=640:-1:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse\" -loop 0"
-    PARAMS["webm"] = "-vf \"fps=10,scale=640:-1\" -an -c libvpx-vp9 -b:v 0 -crf 41"
-    PARAMS["mp4"]  = "-vf \"fps=10,scale=640:-1,crop=trunc(iw/2)*2:trunc(ih/2)*2\" -an -b:v 0 -crf 25 -f mp4 -vcodec libx264 -pix_fmt yuv420p"
+    return resized
 
-    img_objects = images
-    num_total_images = NUM_INTERPOLATIONS + 2
 
-    for i in range(0, num_total_images):
-        tmp = cv2.addWeighted(
-            img_objects[0], 1-(i/(num_total_images-1)), 
-            img_objects[1],   (i/(num_total_images-1)), 
-            0.0)
-        cv2.imwrite(os.path.join(TMP_DIR, "interpolate_{}.jpg".format(i)), tmp)
-        
-        if BOUNCE_OFF:
-            # cv2.imwrite("interpolate_{}.jpg".format(num_total_images + (num_total_images-2-i)), tmp) # do not double last frame | total number * 2 -1
-            cv2.imwrite("interpolate_{}.jpg".format(num_total_images + (num_total_images-1-i)), tmp) # double last frame | total number * 2
+def apply_filter(filter_type, filename, images, full_resolution=None):
 
-    for extension in EXTENSIONS:
+    spec = get_filter_spec(filter_type)
 
-        cmd = ["ffmpeg", "-i", os.path.join(TMP_DIR, "interpolate_%d.jpg"), PARAMS[extension], "-y", "{}.{}".format(filename, extension)]
+    with metrics.span("filter.load", tag=filter_type):
+        implementation = spec.load()
 
-        cmdstr = ""
-        for item in cmd:
-            cmdstr += item
-            cmdstr += " "
+    with metrics.span("filter.resize", tag=filter_type):
+        images = resize_images(images, get_output_width(filter_type, full_resolution=full_resolution))
 
-        subprocess.run(cmdstr, check=True, shell=True)
+    with metrics.span("filter.total", tag=filter_type):
+        implementation.apply(filename, images)
 
-        print("finished {}".format(filename))
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
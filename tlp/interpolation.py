@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import time
+
+import cv2
+import numpy as np
+
+# a + w*(b-a) with w in [0, 1]
+#
+# KERNEL_OPENCV:        cv2.addWeighted writing into preallocated buffers
+# KERNEL_FIXED_POINT:   int16 difference image (computed once) and weights in Q7 fixed point,
+#                       all intermediate results in preallocated buffers
+#
+# Run this file for a benchmark of both kernels. On x86 the OpenCV kernel is faster,
+# its SIMD code beats the five numpy passes of the fixed point kernel.
+
+KERNEL_OPENCV           = "OPENCV"
+KERNEL_FIXED_POINT      = "FIXED_POINT"
+
+DEFAULT_KERNEL          = KERNEL_OPENCV
+
+# Q7: max. weight * difference (128 * 255) still fits into int16
+WEIGHT_BITS             = 7
+WEIGHT_ONE              = 1 << WEIGHT_BITS
+
+
+def get_weight_schedule(num_frames):
+    return [i / (num_frames-1) for i in range(0, num_frames)]
+
+
+class Interpolator(object):
+
+    # Blends image a into image b. If a mask is given, only masked pixels are blended,
+    # all other pixels keep the value of a. All per-frame work happens in buffers
+    # allocated once, the returned frames are reused (num_buffers) so every frame has
+    # to be consumed (encoded, written) before the next one is requested.
+
+    def __init__(self, a, b, mask=None, kernel=DEFAULT_KERNEL, num_buffers=1):
+
+        if a.shape != b.shape:
+            raise Exception("image size mismatch: {} | {}".format(a.shape, b.shape))
+
+        self.kernel = kernel
+        self.a = a
+        self.b = b
+
+        # outside the mask b is replaced with a once,
+        # so no per-frame masking is required
+        if mask is not None:
+            self.b = np.where(mask, b, a)
+
+        if self.kernel == KERNEL_FIXED_POINT:
+            self.diff = np.subtract(self.b, self.a, dtype=np.int16)
+            self.tmp = np.empty(self.a.shape, dtype=np.int16)
+        elif self.kernel != KERNEL_OPENCV:
+            raise Exception("unknown kernel: {}".format(kernel))
+
+        self.buffers = [np.empty(self.a.shape, dtype=np.uint8) for i in range(0, num_buffers)]
+        self.buffer_index = 0
+
+    def interpolate(self, weight, out=None):
+
+        if out is None:
+            out = self.buffers[self.buffer_index]
+            self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+
+        if self.kernel == KERNEL_OPENCV:
+            return cv2.addWeighted(self.a, 1-weight, self.b, weight, 0.0, dst=out)
+
+        weight_fixed = round(weight * WEIGHT_ONE)
+
+        np.multiply(self.diff, weight_fixed, out=self.tmp)
+        np.add(self.tmp, WEIGHT_ONE >> 1, out=self.tmp) # round to nearest
+        np.right_shift(self.tmp, WEIGHT_BITS, out=self.tmp)
+        np.add(self.tmp, self.a, out=self.tmp)
+        np.copyto(out, self.tmp, casting="unsafe")
+
+        return out
+
+    def frames(self, num_frames):
+        for weight in get_weight_schedule(num_frames):
+            yield self.interpolate(weight)
+
+
+def _benchmark(name, func, num_frames):
+
+    # warm up
+    func(0)
+
+    time_start = time.perf_counter()
+    for i in range(0, num_frames):
+        func(i)
+    duration = time.perf_counter() - time_start
+
+    return num_frames / duration
+
+
+if __name__ == "__main__":
+
+    NUM_FRAMES  = 10
+    RESOLUTIONS = [[640, 480], [4056, 3040]]
+
+    for resolution in RESOLUTIONS:
+
+        a = np.random.randint(0, 256, (resolution[1], resolution[0], 3), dtype=np.uint8)
+        b = np.random.randint(0, 256, (resolution[1], resolution[0], 3), dtype=np.uint8)
+        weights = get_weight_schedule(NUM_FRAMES)
+
+        def baseline(i):
+            w = weights[i % NUM_FRAMES]
+            return cv2.addWeighted(a, 1-w, b, w, 0.0)
+
+        def focal_baseline(i):
+            w = weights[i % NUM_FRAMES]
+            tmp = a.copy().astype(np.float64)
+            tmp[b > 0] *= 1-w
+            return np.add(tmp, b * w).astype(np.uint8)
+
+        interpolator_opencv = Interpolator(a, b, kernel=KERNEL_OPENCV)
+        interpolator_fixed = Interpolator(a, b, kernel=KERNEL_FIXED_POINT)
+        interpolator_masked = Interpolator(a, b, mask=(b > 0), kernel=KERNEL_OPENCV)
+
+        results = [
+            ["addWeighted (per frame alloc)",       baseline],
+            ["kernel opencv",                       lambda i: interpolator_opencv.interpolate(weights[i % NUM_FRAMES])],
+            ["kernel fixed point",                  lambda i: interpolator_fixed.interpolate(weights[i % NUM_FRAMES])],
+            ["focal switch float64 (old)",          focal_baseline],
+            ["focal switch kernel opencv",          lambda i: interpolator_masked.interpolate(weights[i % NUM_FRAMES])],
+        ]
+
+        for name, func in results:
+            num_frames = NUM_FRAMES * 5 if resolution[0] < 1000 else NUM_FRAMES
+            if func is focal_baseline and resolution[0] > 1000:
+                num_frames = 2
+
+            print("{:>4d}x{:<4d} | {:<32s} | {:8.1f} frames/s".format(*resolution, name, _benchmark(name, func, num_frames)))
@@ -0,0 +1,123 @@
+import os
+import json
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+JOB_PENDING             = "PENDING"
+JOB_DONE                = "DONE"
+JOB_FAILED              = "FAILED"
+
+# jobs failing (or being interrupted) this often are not resumed again
+MAX_ATTEMPTS            = 3
+
+
+class FilterJournal(object):
+
+    # Append-only record of filter jobs (one JSON object per line), so jobs interrupted
+    # by a poweroff can be resumed on the next boot. An entry is keyed by its output
+    # filename and lists filter type, source captures, status and number of attempts.
+    # The last line of a key wins. Lines are fsynced when written, a torn last line
+    # (power loss during the write) is ignored when the journal is read.
+    #
+    # On load the journal is compacted to the unfinished jobs.
+
+    def __init__(self, filename):
+        self.filename   = filename
+        self.lock       = Lock()
+        self.entries    = {}
+
+        self._load()
+
+    def __repr__(self):
+        return "FilterJournal at {} [{} unfinished]".format(self.filename, len(self.get_unfinished()))
+
+    def add(self, job):
+
+        with self.lock:
+            entry = self.entries.get(job.filename)
+
+            if entry is not None and entry["status"] == JOB_PENDING:
+                return
+
+            attempts = 0
+            if entry is not None:
+                attempts = entry["attempts"]
+
+            self._append({
+                "output":   job.filename,
+                "filter":   job.filter_type,
+                "sources":  job.sources,
+                "status":   JOB_PENDING,
+                "attempts": attempts
+            })
+
+    def update(self, job, status):
+
+        with self.lock:
+            entry = self.entries.get(job.filename)
+
+            if entry is None:
+                log.warning("{} not in journal".format(job))
+                return
+
+            entry = dict(entry)
+            entry["status"] = status
+
+            self._append(entry)
+
+    # marks the start of another attempt (resume at boot)
+    def retry(self, entry):
+
+        with self.lock:
+            entry = dict(entry)
+            entry["attempts"] += 1
+            self._append(entry)
+
+    def get_unfinished(self):
+        with self.lock:
+            return [dict(e) for e in self.entries.values() if e["status"] == JOB_PENDING]
+
+    def _append(self, entry):
+
+        self.entries[entry["output"]] = entry
+
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _load(self):
+
+        try:
+            with open(self.filename, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["output"]] = entry
+                    except Exception as e:
+                        log.warning("skipping damaged journal line: {}".format(line.strip()))
+        except FileNotFoundError as e:
+            return
+
+        # a job that was pending at poweroff counts as an attempt,
+        # jobs that keep failing are given up
+        for key, entry in list(self.entries.items()):
+            if entry["status"] == JOB_PENDING and entry["attempts"] >= MAX_ATTEMPTS:
+                log.error("giving up filter job {} after {} attempts".format(key, entry["attempts"]))
+                entry["status"] = JOB_FAILED
+
+        self.entries = {k: e for k, e in self.entries.items() if e["status"] == JOB_PENDING}
+
+        # compact
+        filename_tmp = self.filename + ".tmp"
+        with open(filename_tmp, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(filename_tmp, self.filename)
+
+        log.debug("journal loaded: {} unfinished job(s)".format(len(self.entries)))
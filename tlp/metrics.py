@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import statistics
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+# Per-stage timing of the capture and filter pipeline. A span records wall time,
+# CPU time of the calling thread and the RSS change of the process. Records are
+# appended as text lines to a metrics file:
+#
+#   <unix time> <pid> <name> <wall us> <cpu us> <rss delta kB> [<tag>]
+#
+# The file is opened once per process with O_APPEND, every record is a single
+# write() (no fsync), so the main process and the filter workers can share it.
+# Once it grows beyond max_size it is rotated to <file>.1 (the previous .1 is dropped).
+#
+# Run this file to aggregate metrics files: python3 metrics.py .metrics [.metrics.1]
+
+DEFAULT_MAX_SIZE        = 1024 * 1024
+ROTATE_CHECK_INTERVAL   = 64    # records between size checks
+
+PAGE_SIZE_KB            = os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+class _Recorder(object):
+
+    def __init__(self):
+        self.filename   = None
+        self.max_size   = DEFAULT_MAX_SIZE
+        self.fd         = None
+        self.statm      = None
+        self.lock       = Lock()
+        self.counter    = 0
+
+    def configure(self, filename, max_size=DEFAULT_MAX_SIZE):
+
+        with self.lock:
+            self._close()
+
+            self.filename = filename
+            self.max_size = max_size
+
+            if filename is None:
+                return
+
+            try:
+                self._open()
+                self.statm = os.open("/proc/self/statm", os.O_RDONLY)
+            except Exception as e:
+                log.warning("metrics disabled: {}".format(e))
+                self._close()
+                self.filename = None
+
+    def get_rss(self):
+
+        # resident set size in kB, 0 if unknown
+
+        if self.statm is None:
+            return 0
+
+        try:
+            return int(os.pread(self.statm, 128, 0).split()[1]) * PAGE_SIZE_KB
+        except Exception as e:
+            return 0
+
+    def record(self, name, wall, cpu, rss_delta=0, tag=None):
+
+        if self.fd is None:
+            return
+
+        line = "{:.3f} {} {} {:.0f} {:.0f} {}".format(time.time(), os.getpid(), name, wall * 1e6, cpu * 1e6, rss_delta)
+        if tag is not None:
+            line += " {}".format(tag)
+
+        with self.lock:
+            if self.fd is None:
+                return
+
+            try:
+                os.write(self.fd, (line + "\n").encode("utf-8"))
+            except Exception as e:
+                log.warning("writing metrics failed: {}".format(e))
+                return
+
+            self.counter += 1
+            if self.counter % ROTATE_CHECK_INTERVAL == 0:
+                self._rotate()
+
+    def _open(self):
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _close(self):
+
+        for fd in [self.fd, self.statm]:
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except Exception as e:
+                    pass
+
+        self.fd = None
+        self.statm = None
+
+    def _rotate(self):
+
+        try:
+            # another process may have rotated the file already
+            if os.fstat(self.fd).st_ino != os.stat(self.filename).st_ino:
+                os.close(self.fd)
+                self._open()
+                return
+
+            if os.fstat(self.fd).st_size < self.max_size:
+                return
+
+            os.replace(self.filename, self.filename + ".1")
+            os.close(self.fd)
+            self._open()
+        except FileNotFoundError as e:
+            os.close(self.fd)
+            self._open()
+        except Exception as e:
+            log.warning("rotating metrics failed: {}".format(e))
+
+
+_recorder = _Recorder()
+
+
+# filename None: records are dropped (spans still measure)
+def configure(filename, max_size=DEFAULT_MAX_SIZE):
+    _recorder.configure(filename, max_size=max_size)
+
+
+def record(name, wall, cpu, rss_delta=0, tag=None):
+    _recorder.record(name, wall, cpu, rss_delta=rss_delta, tag=tag)
+
+
+def get_rss():
+    return _recorder.get_rss()
+
+
+class Span(object):
+
+    def __init__(self, name, tag=None):
+        self.name   = name
+        self.tag    = tag
+
+        self.wall   = None
+        self.cpu    = None
+
+    def __enter__(self):
+        self.rss_start  = _recorder.get_rss()
+        self.cpu_start  = time.thread_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = time.thread_time() - self.cpu_start
+
+        tag = self.tag
+        if exc_type is not None:
+            tag = "{}!".format(tag if tag is not None else "")
+
+        _recorder.record(self.name, self.wall, self.cpu, _recorder.get_rss() - self.rss_start, tag=tag)
+
+
+# with metrics.span("capture", tag=camera_num):
+#     ...
+def span(name, tag=None):
+    return Span(name, tag=tag)
+
+
+class Accumulator(object):
+
+    # sums up many short intervals (e.g. every frame of a filter)
+    # and records them as a single span
+
+    def __init__(self, name, tag=None):
+        self.name   = name
+        self.tag    = tag
+
+        self.wall   = 0.0
+        self.cpu    = 0.0
+        self.count  = 0
+
+    def __enter__(self):
+        self.cpu_start  = time.thread_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.wall += time.perf_counter() - self.wall_start
+        self.cpu += time.thread_time() - self.cpu_start
+        self.count += 1
+
+    def record(self):
+        if self.count > 0:
+            _recorder.record(self.name, self.wall, self.cpu, tag=self.tag)
+
+
+def read(filenames):
+
+    # {name: {"wall": [...], "cpu": [...], "rss": [...]}}, times in ms
+
+    data = {}
+
+    for filename in filenames:
+        with open(filename, "r") as f:
+            for line in f:
+                parts = line.split()
+
+                if len(parts) < 6:
+                    continue
+
+                try:
+                    entry = data.setdefault(parts[2], {"wall": [], "cpu": [], "rss": []})
+                    entry["wall"].append(int(parts[3]) / 1000)
+                    entry["cpu"].append(int(parts[4]) / 1000)
+                    entry["rss"].append(int(parts[5]))
+                except ValueError as e:
+                    continue
+
+    return data
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("usage: python3 metrics.py <metrics file> [<metrics file> ...]")
+        sys.exit(1)
+
+    data = read(sys.argv[1:])
+
+    print("{:<24s} | {:>6s} | {:>9s} | {:>9s} | {:>9s} | {:>9s} | {:>9s}".format(
+        "span", "n", "wall mean", "wall p50", "wall p95", "cpu mean", "rss kB"))
+
+    for name in sorted(data.keys()):
+        wall = sorted(data[name]["wall"])
+        print("{:<24s} | {:6d} | {:7.1f}ms | {:7.1f}ms | {:7.1f}ms | {:7.1f}ms | {:+9.0f}".format(
+            name,
+            len(wall),
+            statistics.mean(wall),
+            statistics.median(wall),
+            wall[min(len(wall) - 1, int(len(wall) * 0.95))],
+            statistics.mean(data[name]["cpu"]),
+            statistics.mean(data[name]["rss"])))
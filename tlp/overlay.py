@@ -0,0 +1,133 @@
+import os
+from threading import Lock, Timer
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LAYER           = 3
+DEFAULT_ALPHA           = 128
+
+# alpha of a hidden overlay, the layer stays in place
+ALPHA_HIDDEN            = 0
+
+
+class OverlayManager(object):
+
+    # Preview overlays, created once. All assets are decoded and padded (the renderer
+    # expects width and height rounded up to multiples of 32 and 16) at startup and
+    # every asset gets its own overlay layer, hidden until shown. Showing or hiding an
+    # overlay only changes the alpha of an existing layer, the image data is uploaded
+    # again only if it is replaced with update().
+
+    def __init__(self, camera, asset_dir, assets, layer=DEFAULT_LAYER, alpha=DEFAULT_ALPHA):
+
+        # assets: {name: filename in asset_dir}
+
+        self.camera     = camera
+        self.layer      = layer
+        self.alpha      = alpha
+
+        self.lock       = Lock()
+        self.overlays   = {}
+        self.timers     = {}
+
+        for name, filename in assets.items():
+            try:
+                data, size = self._load(os.path.join(asset_dir, filename))
+                self.overlays[name] = self.camera.add_overlay(data, size=size, format="rgba", layer=self.layer, alpha=ALPHA_HIDDEN)
+            except Exception as e:
+                log.error("loading overlay {} failed: {}".format(filename, e))
+
+    def __repr__(self):
+        return "OverlayManager [{}]".format(", ".join(self.overlays.keys()))
+
+    # shows the overlay, hides it again after duration seconds (if not None).
+    # Showing an overlay that is already visible restarts its timer
+    def show(self, name, duration=None, alpha=None):
+
+        if alpha is None:
+            alpha = self.alpha
+
+        with self.lock:
+            overlay = self.overlays.get(name)
+
+            if overlay is None:
+                log.warning("unknown overlay: {}".format(name))
+                return
+
+            self._cancel_timer(name)
+
+            overlay.alpha = alpha
+
+            if duration is not None:
+                timer = Timer(duration, self.hide, args=[name])
+                timer.daemon = True
+                self.timers[name] = timer
+                timer.start()
+
+    def hide(self, name):
+
+        with self.lock:
+            overlay = self.overlays.get(name)
+
+            if overlay is None:
+                return
+
+            self._cancel_timer(name)
+            overlay.alpha = ALPHA_HIDDEN
+
+    # replaces the image of an overlay in place, img: PIL image of the same size
+    def update(self, name, img):
+
+        with self.lock:
+            overlay = self.overlays.get(name)
+
+            if overlay is None:
+                log.warning("unknown overlay: {}".format(name))
+                return
+
+            data, size = self._pad(img)
+            overlay.update(data)
+
+    def close(self):
+
+        with self.lock:
+            for name, overlay in self.overlays.items():
+                self._cancel_timer(name)
+
+                try:
+                    self.camera.remove_overlay(overlay)
+                except Exception as e:
+                    log.warning("removing overlay {} failed: {}".format(name, e))
+
+            self.overlays = {}
+
+    def _cancel_timer(self, name):
+
+        timer = self.timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _load(self, filename):
+
+        from PIL import Image
+
+        with Image.open(filename) as img:
+            return self._pad(img)
+
+    def _pad(self, img):
+
+        from PIL import Image
+
+        img = img.convert("RGBA")
+
+        size = (
+            ((img.size[0] + 31) // 32) * 32,
+            ((img.size[1] + 15) // 16) * 16
+        )
+
+        pad = Image.new("RGBA", size)
+        pad.paste(img, (0, 0))
+
+        # size of the visible area, the padding is not displayed
+        return pad.tobytes(), img.size
@@ -0,0 +1,293 @@
+import time
+import collections
+from threading import Lock, Condition, Thread
+import logging
+
+import filters
+from scheduler import FilterJob, PRIORITY_NORMAL
+
+log = logging.getLogger(__name__)
+
+# shot states
+SHOT_CAPTURING          = "CAPTURING"
+SHOT_CAPTURED           = "CAPTURED"
+SHOT_FILTERING          = "FILTERING"
+SHOT_DEFERRED           = "DEFERRED"    # filter postponed, images are reloaded from disk later
+SHOT_DONE               = "DONE"
+SHOT_DROPPED            = "DROPPED"     # not captured at all
+SHOT_FAILED             = "FAILED"
+
+DEFAULT_MAX_IN_FLIGHT   = 2
+DEFAULT_MIN_MEMORY_CAPTURE  = 64  * 1024 * 1024
+DEFAULT_MIN_MEMORY_FILTER   = 192 * 1024 * 1024
+
+
+def get_memory_available():
+
+    # MemAvailable in bytes, None if unknown (not a linux system)
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except Exception as e:
+        pass
+
+    return None
+
+
+class Shot(object):
+
+    def __init__(self, shot_id, filename, filter_type):
+        self.id                 = shot_id
+        self.filename           = filename
+        self.filter_type        = filter_type
+        self.state              = SHOT_CAPTURING
+        self.captures_data      = None
+        self.filenames          = None
+        self.job                = None
+        self.time_trigger       = time.perf_counter()
+
+    def __repr__(self):
+        return "Shot {} [{}] {}".format(self.id, self.state, self.filename[1])
+
+
+class ShotPipeline(object):
+
+    # Shutter state machine: CAPTURING -> CAPTURED -> FILTERING -> DONE
+    # (CAPTURING -> FAILED if a camera does not deliver its image)
+    #
+    # Capturing is the only stage the main loop waits for, encoding/writing is done by the
+    # ImageWriter and filters run in the FilterScheduler. Up to max_in_flight shots may
+    # be filtering (or waiting for a filter) at the same time, a press while an earlier
+    # shot is still filtering is captured right away.
+    #
+    # Under memory pressure shots are never lost silently:
+    #  * less than min_memory_capture bytes available: the shot is DROPPED before capturing
+    #  * filter limit reached or less than min_memory_filter (or the memory the filter
+    #    declares, if more) available: the filter is DEFERRED, the capture buffers are
+    #    released and the images are reloaded from disk once an earlier filter is done
+    #
+    # event_fn(shot, state) is called after every state change (from the main loop or a scheduler thread)
+    #
+    # A deferred shot is resubmitted from a thread of its own (flush_fn() blocks until the
+    # writer is done), drain() waits for those as well as for the shots filtering.
+
+    def __init__(self, scheduler, flush_fn,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            min_memory_capture=DEFAULT_MIN_MEMORY_CAPTURE,
+            min_memory_filter=DEFAULT_MIN_MEMORY_FILTER,
+            event_fn=None):
+
+        self.scheduler          = scheduler
+        self.flush_fn           = flush_fn      # flush_fn(): all captures are on disk afterwards
+        self.event_fn           = event_fn
+
+        self.max_in_flight      = max_in_flight
+        self.min_memory_capture = min_memory_capture
+        self.min_memory_filter  = min_memory_filter
+
+        self.lock               = Lock()
+        self.condition          = Condition(self.lock)  # notified when a shot leaves in_flight
+        self.shot_counter       = 0
+        self.in_flight          = []
+        self.deferred           = collections.deque()
+
+        self.stats              = {
+            "captured": 0,
+            "filtered": 0,
+            "deferred": 0,
+            "dropped":  0,
+            "failed":   0
+        }
+
+    def __repr__(self):
+        return "ShotPipeline [in flight: {}/{} | deferred: {}]".format(len(self.in_flight), self.max_in_flight, len(self.deferred))
+
+    # returns a new Shot in state CAPTURING or None if the shot had to be dropped
+    def begin(self, filename, filter_type):
+
+        with self.lock:
+            self.shot_counter += 1
+            shot = Shot(self.shot_counter, filename, filter_type)
+
+        self._notify(shot)
+
+        memory_available = get_memory_available()
+        if memory_available is not None and memory_available < self.min_memory_capture:
+            shot.state = SHOT_DROPPED
+            log.warning("{} dropped, memory available: {:.0f}MB".format(shot, memory_available / (1024 * 1024)))
+            with self.lock:
+                self.stats["dropped"] += 1
+            self._notify(shot)
+            return None
+
+        return shot
+
+    # captures data: [[filename0, img0, buffer0], [filename1, img1, buffer1]]
+    # the pipeline takes over the callers reference to the capture buffers
+    def captured(self, shot, captures_data):
+
+        shot.state = SHOT_CAPTURED
+        shot.filenames = [x[0] for x in captures_data]
+
+        with self.lock:
+            self.stats["captured"] += 1
+
+        log.debug("{} captured in {:.0f}ms".format(shot, (time.perf_counter() - shot.time_trigger) * 1000))
+        self._notify(shot)
+
+        if shot.filter_type is None:
+            self._release(captures_data)
+            shot.state = SHOT_DONE
+            self._notify(shot)
+            return
+
+        # filters declaring a larger footprint than min_memory_filter need that much
+        min_memory = max(self.min_memory_filter, filters.get_filter_spec(shot.filter_type).memory)
+
+        with self.lock:
+            memory_available = get_memory_available()
+            memory_low = memory_available is not None and memory_available < min_memory
+            deferred = len(self.in_flight) >= self.max_in_flight or memory_low
+
+            if deferred:
+                self._release(captures_data)
+                shot.state = SHOT_DEFERRED
+
+                # journaled right away, a deferred job survives a poweroff as well
+                shot.job = FilterJob(shot.filter_type, shot.filenames)
+                self.scheduler.record(shot.job)
+
+                self.deferred.append(shot)
+                self.stats["deferred"] += 1
+                log.warning("{} filter deferred [in flight: {} | memory low: {}]".format(shot, len(self.in_flight), memory_low))
+
+            else:
+                self.in_flight.append(shot)
+
+        # the shot may be resumed (FILTERING) already
+        if deferred:
+            self._notify(shot, SHOT_DEFERRED)
+            return
+
+        self._submit(shot, captures_data)
+
+    # capturing failed, the caller has released the capture buffers already
+    def failed(self, shot, exception):
+
+        shot.state = SHOT_FAILED
+
+        with self.lock:
+            self.stats["failed"] += 1
+
+        log.error("{} capture failed: {!r}".format(shot, exception))
+        self._notify(shot)
+
+    def get_num_in_flight(self):
+        with self.lock:
+            return len(self.in_flight) + len(self.deferred)
+
+    # blocks until no shot is filtering or deferred, returns False on timeout
+    def drain(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.in_flight) + len(self.deferred) == 0, timeout=timeout)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self.in_flight)
+            stats["deferred_waiting"] = len(self.deferred)
+
+        return stats
+
+    def _submit(self, shot, captures_data):
+
+        shot.state = SHOT_FILTERING
+        shot.captures_data = captures_data
+
+        log.info("{} applying filter: {}".format(shot, shot.filter_type))
+        self._notify(shot)
+
+        images = None
+        if captures_data is not None:
+            images = [x[2] for x in captures_data]
+        else:
+            # deferred: the worker reads the images from disk
+            self.flush_fn()
+
+        job = shot.job
+        if job is None:
+            job = FilterJob(shot.filter_type, shot.filenames, images=images)
+
+        future = self.scheduler.submit(job, priority=PRIORITY_NORMAL)
+        future.add_done_callback(lambda f: self._done(shot, f))
+
+    def _done(self, shot, future, exception=None):
+
+        self._release(shot.captures_data)
+        shot.captures_data = None
+
+        if future is not None:
+            exception = future.exception()
+
+        with self.lock:
+            self.in_flight.remove(shot)
+
+            if exception is None:
+                shot.state = SHOT_DONE
+                self.stats["filtered"] += 1
+            else:
+                shot.state = SHOT_FAILED
+                self.stats["failed"] += 1
+
+            next_shot = None
+            if len(self.deferred) > 0:
+                next_shot = self.deferred.popleft()
+                self.in_flight.append(next_shot)
+
+            self.condition.notify_all()
+
+        if exception is None:
+            log.debug("{} done in {:.1f}s".format(shot, time.perf_counter() - shot.time_trigger))
+        else:
+            log.error("{} failed: {}".format(shot, exception))
+
+        self._notify(shot)
+
+        # not in the scheduler's callback thread, flush_fn() may take a while
+        if next_shot is not None:
+            Thread(target=self._resume, args=(next_shot,), name="ShotPipeline resume", daemon=True).start()
+
+    def _resume(self, shot):
+
+        log.info("{} resuming deferred filter".format(shot))
+
+        try:
+            self._submit(shot, None)
+        except Exception as e:
+            # the job is journaled already and resumed with the next boot
+            self._done(shot, None, exception=e)
+
+    def _notify(self, shot, state=None):
+
+        if self.event_fn is None:
+            return
+
+        if state is None:
+            state = shot.state
+
+        try:
+            self.event_fn(shot, state)
+        except Exception as e:
+            log.warning("{} event handler failed: {}".format(shot, e))
+
+    def _release(self, captures_data):
+
+        if captures_data is None:
+            return
+
+        for capture in captures_data:
+            if len(capture) > 2 and capture[2] is not None:
+                capture[2].release()
@@ -0,0 +1,386 @@
+import os
+import glob
+import time
+import heapq
+import itertools
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, Future
+from threading import Thread, Condition, Timer
+import logging
+
+import filters
+import metrics
+from journal import JOB_DONE, JOB_FAILED
+
+log = logging.getLogger(__name__)
+
+PRIORITY_HIGH           = 0
+PRIORITY_NORMAL         = 10
+PRIORITY_LOW            = 20
+
+# leave one core for capturing, preview and the image writer
+DEFAULT_WORKERS         = max(1, (os.cpu_count() or 1) - 1)
+
+# worker processes run with lower CPU priority than the capture threads
+WORKER_NICE             = 10
+
+NUM_JOB_STATS           = 32
+
+
+def get_filter_filename(filenames):
+    return os.path.join(filenames[0][0], "filter_" + filenames[0][1])
+
+
+def _init_worker(nice, metrics_file):
+    try:
+        os.nice(nice)
+    except Exception as e:
+        log.warning("setting worker nice level failed: {}".format(e))
+
+    # filter spans are appended to the metrics file of the main process
+    if metrics_file is not None:
+        metrics.configure(metrics_file)
+
+
+def _attach_image(image, shms):
+
+    # image: numpy array (pickled), shared buffer descriptor or None (read from disk)
+
+    if not type(image) is tuple:
+        return image
+
+    name, resolution_rounded, resolution = image
+
+    shm = shared_memory.SharedMemory(name=name)
+    shms.append(shm)
+
+    import numpy as np
+
+    data = np.ndarray((resolution_rounded[1], resolution_rounded[0], 3), dtype=np.uint8, buffer=shm.buf)
+    return data[:resolution[1], :resolution[0], :]
+
+
+# the filter outputs (filename.gif, filename.mp4, ...) are written by ffmpeg, they are
+# fsynced before the job counts as done: the controller cuts the power after a drain
+def _fsync_outputs(filename):
+
+    with metrics.span("filter.fsync"):
+        for output in glob.glob(glob.escape(filename) + ".*"):
+            fd = os.open(output, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        fd = os.open(os.path.dirname(filename) or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# runs in the worker process
+def _run_job(filter_type, filename, sources, images):
+
+    time_start = time.perf_counter()
+    time_start_cpu = time.process_time()
+
+    shms = []
+
+    try:
+        if images is None:
+            import cv2
+            images = [cv2.imread(os.path.join(*source)) for source in sources]
+
+            for source, img in zip(sources, images):
+                if img is None:
+                    raise Exception("reading source image {} failed".format(source[1]))
+        else:
+            images = [_attach_image(image, shms) for image in images]
+
+        filters.apply_filter(filter_type, filename, images)
+
+        _fsync_outputs(filename)
+
+    finally:
+        # views on the shared buffers need to be gone before closing
+        images = None
+
+        for shm in shms:
+            shm.close()
+
+    return (time.perf_counter() - time_start, time.process_time() - time_start_cpu)
+
+
+class FilterJob(object):
+
+    # sources:  capture filenames [[dir, filename], ...]
+    # images:   CaptureBuffers (handed over via shared memory), numpy
+    #           arrays (pickled) or None (read from the sources by the worker)
+
+    id_counter = itertools.count(1)
+
+    def __init__(self, filter_type, sources, images=None, filename=None):
+        self.id             = next(self.id_counter)
+        self.filter_type    = filter_type
+        self.sources        = sources
+        self.images         = images
+        self.filename       = filename
+
+        if self.filename is None:
+            self.filename = get_filter_filename(sources)
+
+        # worker slots the job occupies
+        self.cpu            = filters.get_filter_spec(filter_type).cpu
+
+        self.priority       = PRIORITY_NORMAL
+        self.future         = Future()
+
+        self.time_submit    = None
+        self.time_start     = None
+        self.time_done      = None
+        self.time_run       = None
+        self.time_cpu       = None
+
+    def __repr__(self):
+        return "FilterJob {} [{}] {}".format(self.id, self.filter_type, os.path.basename(self.filename))
+
+    def get_queue_time(self):
+        if self.time_start is None:
+            return None
+        return self.time_start - self.time_submit
+
+    def _get_images_arg(self):
+
+        if self.images is None:
+            return None
+
+        images = []
+        for image in self.images:
+            if hasattr(image, "get_shared_descriptor"):
+                descriptor = image.get_shared_descriptor()
+                images.append(descriptor if descriptor is not None else image.image)
+            else:
+                images.append(image)
+
+        return images
+
+
+class FilterScheduler(object):
+
+    # Runs filter jobs in a process pool, isolated from the capture threads of the main
+    # process (and its GIL). Jobs are started in order of priority. Capture buffers are
+    # handed to the workers via shared memory, only their names are pickled.
+    #
+    # While a capture is in progress (capture() context) no new job is started, and
+    # the workers run niced so a running job does not slow down the capture either.
+    #
+    # A job occupies as many worker slots as its filter declares cores (FilterSpec.cpu),
+    # a job needing more slots than available only starts if no other job is running.
+    #
+    # If a FilterJournal is given, every job is recorded before it is queued and
+    # marked done or failed afterwards. Unfinished jobs are resubmitted by resume().
+    #
+    # metrics_file: the workers record their filter spans there (see metrics.py)
+
+    def __init__(self, workers=DEFAULT_WORKERS, nice=WORKER_NICE, journal=None, metrics_file=None):
+
+        self.workers        = workers
+        self.journal        = journal
+
+        # forkserver: workers are not forked from the main process
+        # and do not inherit its camera and GPIO state
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["filters"])
+
+        self.executor       = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(nice, metrics_file))
+
+        self.condition      = Condition()
+        self.queue          = []
+        self.queue_counter  = itertools.count()
+        self.running        = []
+        self.captures       = 0
+        self.closed         = False
+
+        self.job_stats      = collections.deque(maxlen=NUM_JOB_STATS)
+
+        self.thread = Thread(target=self._dispatch, name="FilterScheduler", daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return "FilterScheduler [queued: {} | running: {}/{}]".format(len(self.queue), len(self.running), self.workers)
+
+    def _get_slots_used(self):
+        return sum([job.cpu for job in self.running])
+
+    def _can_start(self):
+
+        if len(self.queue) == 0 or self.captures > 0:
+            return False
+
+        if len(self.running) == 0:
+            return True
+
+        return self._get_slots_used() + self.queue[0][2].cpu <= self.workers
+
+    # journals a job that is going to be submitted later
+    def record(self, job):
+        if self.journal is not None:
+            self.journal.add(job)
+
+    def submit(self, job, priority=PRIORITY_NORMAL):
+
+        job.priority = priority
+        job.time_submit = time.perf_counter()
+
+        with self.condition:
+            if self.closed:
+                raise Exception("scheduler closed")
+
+        self.record(job)
+
+        with self.condition:
+            heapq.heappush(self.queue, (priority, next(self.queue_counter), job))
+            self.condition.notify_all()
+
+        log.debug("{} queued with priority {} [{}]".format(job, priority, self))
+
+        return job.future
+
+    # resubmits unfinished jobs of the journal with low priority after delay seconds,
+    # their images are read from disk
+    def resume(self, delay=0):
+
+        if self.journal is None:
+            return
+
+        unfinished = self.journal.get_unfinished()
+        if len(unfinished) == 0:
+            return
+
+        log.info("resuming {} unfinished filter job(s) in {}s".format(len(unfinished), delay))
+
+        timer = Timer(delay, self._resume, args=[unfinished])
+        timer.daemon = True
+        timer.start()
+
+    def _resume(self, entries):
+
+        for entry in entries:
+            job = FilterJob(entry["filter"], entry["sources"], filename=entry["output"])
+
+            missing = [source for source in entry["sources"] if not os.path.exists(os.path.join(*source))]
+            if len(missing) > 0:
+                log.error("{} can not be resumed, missing source(s): {}".format(job, missing))
+                self.journal.update(job, JOB_FAILED)
+                continue
+
+            self.journal.retry(entry)
+
+            try:
+                self.submit(job, priority=PRIORITY_LOW)
+            except Exception as e:
+                log.error("resuming {} failed: {}".format(job, e))
+
+    # no new jobs are started while a capture is in progress
+    def capture(self):
+        return _CaptureContext(self)
+
+    def get_num_pending(self):
+        with self.condition:
+            return len(self.queue) + len(self.running)
+
+    # blocks until all queued and running jobs are done, returns False on timeout
+    def drain(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.queue) + len(self.running) == 0, timeout=timeout)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "queued":   len(self.queue),
+                "running":  len(self.running),
+                "jobs":     list(self.job_stats)
+            }
+
+    def close(self, wait=False):
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.executor.shutdown(wait=wait)
+
+    def _dispatch(self):
+
+        while True:
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self._can_start())
+
+                if self.closed:
+                    break
+
+                priority, counter, job = heapq.heappop(self.queue)
+                self.running.append(job)
+
+            job.time_start = time.perf_counter()
+
+            try:
+                future = self.executor.submit(_run_job, job.filter_type, job.filename, job.sources, job._get_images_arg())
+                future.add_done_callback(lambda f, job=job: self._done(job, f))
+            except Exception as e:
+                self._done(job, None, exception=e)
+
+    def _done(self, job, future, exception=None):
+
+        job.time_done = time.perf_counter()
+
+        if future is not None:
+            exception = future.exception()
+
+        if exception is None:
+            job.time_run, job.time_cpu = future.result()
+
+        if self.journal is not None:
+            try:
+                self.journal.update(job, JOB_DONE if exception is None else JOB_FAILED)
+            except Exception as e:
+                log.error("journal update for {} failed: {}".format(job, e))
+
+        with self.condition:
+            self.running.remove(job)
+            self.job_stats.append({
+                "id":           job.id,
+                "filter":       job.filter_type,
+                "priority":     job.priority,
+                "queue_time":   job.get_queue_time(),
+                "run_time":     job.time_run,
+                "cpu_time":     job.time_cpu,
+                "success":      exception is None
+            })
+            self.condition.notify_all()
+
+        if exception is None:
+            log.info("{} done | queued: {:.2f}s | run: {:.2f}s | cpu: {:.2f}s".format(job, job.get_queue_time(), job.time_run, job.time_cpu))
+            job.future.set_result(job)
+        else:
+            log.error("{} failed after {:.2f}s: {}".format(job, job.time_done - job.time_submit, exception))
+            job.future.set_exception(exception)
+
+
+class _CaptureContext(object):
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def __enter__(self):
+        with self.scheduler.condition:
+            self.scheduler.captures += 1
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with self.scheduler.condition:
+            self.scheduler.captures -= 1
+            self.scheduler.condition.notify_all()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# measures the shutter lag (trigger to image in memory) of the regular
+# preview->still->preview path against the FAST_STILL path.
+# Stop the TLP service before running this, the cameras can only be opened once.
+#
+# usage: python3 shutterlag.py [num_captures] [camera_num]
+
+import os
+import sys
+import time
+import logging
+
+from hardware import picamera
+
+import tlp
+from buffers import BufferPool
+from profiles import CameraProfiles, PROFILE_FILE
+
+NUM_CAPTURES_DEFAULT    = 10
+
+
+def measure(cam, profile, fast_still, num_captures):
+
+    if fast_still:
+        tlp._change_camera_settings(cam, profile, tlp.MODE_STILL)
+    else:
+        tlp._change_camera_settings(cam, profile, tlp.MODE_PREVIEW)
+
+    # let auto exposure settle
+    time.sleep(2)
+
+    buffer_pool = BufferPool(profile.get_resolution(tlp.MODE_STILL), count=1)
+
+    timings = []
+    for i in range(0, num_captures):
+        buffer = buffer_pool.acquire()
+        time_start = time.perf_counter()
+        tlp._capture(cam, profile, buffer, fast_still=fast_still)
+        timings.append(time.perf_counter() - time_start)
+        buffer.release()
+
+    return timings
+
+
+def print_timings(name, timings):
+    print("{:<24s} | n: {:3d} | mean: {:6.0f}ms | min: {:6.0f}ms | max: {:6.0f}ms".format(
+        name, 
+        len(timings), 
+        sum(timings) / len(timings) * 1000, 
+        min(timings) * 1000, 
+        max(timings) * 1000))
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    num_captures = NUM_CAPTURES_DEFAULT
+    camera_num = 0
+
+    if len(sys.argv) > 1:
+        num_captures = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        camera_num = int(sys.argv[2])
+
+    cam = picamera.PiCamera(sensor_mode=tlp.SENSOR_MODE, camera_num=camera_num)
+
+    try:
+        camera_profiles = CameraProfiles(os.path.join(tlp.OUTPUT_DIR, PROFILE_FILE), tlp.CAMERA_SETTINGS)
+        profile = camera_profiles.get(cam, camera_num)
+        tlp._change_camera_settings(cam, profile, tlp.MODE_PREVIEW)
+        cam.start_preview()
+
+        timings_regular = measure(cam, profile, False, num_captures)
+        timings_fast = measure(cam, profile, True, num_captures)
+
+        print("camera {} | sensor: {}".format(camera_num, profile.sensor))
+        print_timings("preview/still switch", timings_regular)
+        print_timings("fast still", timings_fast)
+
+        gain = sum(timings_regular) / sum(timings_fast)
+        print("fast still is {:.1f}x faster".format(gain))
+
+    finally:
+        cam.stop_preview()
+        cam.close()
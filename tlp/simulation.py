@@ -0,0 +1,506 @@
+import os
+import pty
+import tty
+import time
+import types
+import struct
+from threading import Thread, Lock, Timer
+import logging
+
+log = logging.getLogger(__name__)
+
+# Stand-ins for picamera, RPi.GPIO and the controller on the serial port, so the
+# capture and filter pipeline can run (and be profiled) on any linux machine.
+# Selected by hardware.py (TLP_BACKEND=sim), configured via environment variables:
+#
+# TLP_SIM_SENSOR            sensor revision of the fake cameras (sets the resolution)
+# TLP_SIM_CAMERAS           number of cameras that can be opened
+# TLP_SIM_LATENCY_STILL     seconds per capture via the still port
+# TLP_SIM_LATENCY_VIDEO     seconds per capture via the video port
+# TLP_SIM_BUTTONS           scripted button presses "time:pin:duration,..." (seconds
+#                           after GPIO.setmode(), a duration >= long press time is a long press)
+# TLP_SIM_BAUDRATE          serial line speed of the controller (transfer time of every byte
+#                           is added to its latency), unset: no transfer time
+
+SENSORS = {
+    "imx477":   [4056, 3040],
+    "imx219":   [3280, 2464],
+    "ov5647":   [2592, 1944]
+}
+
+DEFAULT_SENSOR          = "imx477"
+DEFAULT_CAMERAS         = 2
+DEFAULT_LATENCY_STILL   = 0.25
+DEFAULT_LATENCY_VIDEO   = 0.04
+
+CONTROLLER_LATENCY      = 0.01  # seconds until a response is sent
+CONTROLLER_BATTERY      = 3.92
+CONTROLLER_TEMPERATURE  = 24.5
+
+
+def _get_env(name, default, convert=str):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return convert(value)
+
+
+# --- picamera
+
+
+class PiCameraValueError(ValueError):
+    pass
+
+
+class FakeRenderer(object):
+
+    def __init__(self, source=None, size=None, layer=2, alpha=255, **options):
+        self.source = source
+        self.size   = size
+        self.layer  = layer
+        self.alpha  = alpha
+
+    def update(self, source):
+        self.source = source
+
+    def close(self):
+        pass
+
+
+class FakePiCamera(object):
+
+    # Synthetic frames: a gradient (different for every camera) with a bright square
+    # moving a bit with every capture, so consecutive captures and the images of both
+    # cameras differ like real ones would. Captures block for the configured latency.
+
+    lock = Lock()
+    open_cameras = set()
+
+    def __init__(self, camera_num=0, sensor_mode=0, led_pin=None, **kwargs):
+
+        self.camera_num         = camera_num
+        self.sensor_mode        = sensor_mode
+        self.revision           = _get_env("TLP_SIM_SENSOR", DEFAULT_SENSOR).lower()
+
+        self.latency_still      = _get_env("TLP_SIM_LATENCY_STILL", DEFAULT_LATENCY_STILL, float)
+        self.latency_video      = _get_env("TLP_SIM_LATENCY_VIDEO", DEFAULT_LATENCY_VIDEO, float)
+
+        with self.lock:
+            if camera_num >= _get_env("TLP_SIM_CAMERAS", DEFAULT_CAMERAS, int):
+                raise Exception("Camera is not enabled [camera {}]".format(camera_num))
+
+            if camera_num in self.open_cameras:
+                raise Exception("Camera already in use [camera {}]".format(camera_num))
+
+            self.open_cameras.add(camera_num)
+
+        self.max_resolution     = SENSORS[self.revision]
+        self._resolution        = [1280, 720]
+
+        self.meter_mode             = "average"
+        self.exposure_compensation  = 0
+        self.exif_tags              = {"IFD0.Model": "RP_{}".format(self.revision), "IFD0.Make": "RaspberryPi"}
+
+        self.preview            = None
+        self.overlays           = []
+        self.recording          = None
+        self.frame_counter      = 0
+        self.closed             = False
+
+        self.base_frames        = {}
+
+    def __repr__(self):
+        return "FakePiCamera {} [{}]".format(self.camera_num, self.revision)
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, value):
+        if value[0] > self.max_resolution[0] or value[1] > self.max_resolution[1]:
+            raise PiCameraValueError("Invalid resolution requested: {}".format(value))
+        self._resolution = list(value)
+
+    def start_preview(self, **options):
+        self.preview = FakeRenderer(**options)
+        return self.preview
+
+    def stop_preview(self):
+        self.preview = None
+
+    def add_overlay(self, source, size=None, format=None, **options):
+        renderer = FakeRenderer(source, size=size, **options)
+        self.overlays.append(renderer)
+        return renderer
+
+    def remove_overlay(self, renderer):
+        self.overlays.remove(renderer)
+
+    def capture(self, output, format="jpeg", use_video_port=False, bayer=False, **options):
+
+        time_start = time.perf_counter()
+
+        frame = self._get_frame()
+
+        if type(output) is str:
+            import cv2
+            cv2.imwrite(output, frame)
+        else:
+            # unencoded: padded to multiples of 32 (columns) and 16 (rows)
+            import numpy as np
+            width = (self.resolution[0] + 31) // 32 * 32
+            height = (self.resolution[1] + 15) // 16 * 16
+
+            view = np.frombuffer(output, dtype=np.uint8).reshape([height, width, 3])
+            view[:self.resolution[1], :self.resolution[0], :] = frame
+
+            if format == "rgb":
+                view[:, :, :] = view[:, :, ::-1]
+
+        latency = self.latency_video if use_video_port else self.latency_still
+        time.sleep(max(0, latency - (time.perf_counter() - time_start)))
+
+    def start_recording(self, output, format=None, **options):
+        self.recording = output
+        if type(output) is str:
+            open(output, "wb").close()
+
+    def wait_recording(self, timeout=0):
+        if self.recording is None:
+            raise Exception("not recording")
+        time.sleep(timeout)
+
+    def stop_recording(self):
+        self.recording = None
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        with self.lock:
+            self.open_cameras.discard(self.camera_num)
+
+    def _get_frame(self):
+
+        import numpy as np
+
+        key = tuple(self.resolution)
+        if not key in self.base_frames:
+            width, height = self.resolution
+            gradient_x = np.linspace(0, 255, width, dtype=np.float32)
+            gradient_y = np.linspace(0, 255, height, dtype=np.float32)
+
+            base = np.empty((height, width, 3), dtype=np.uint8)
+            base[:, :, 0] = gradient_x[None, :]
+            base[:, :, 1] = gradient_y[:, None]
+            base[:, :, 2] = 64 + self.camera_num * 128
+
+            self.base_frames[key] = base
+
+        frame = self.base_frames[key].copy()
+
+        size = max(8, self.resolution[1] // 8)
+        x = (self.frame_counter * size // 4) % max(1, self.resolution[0] - size)
+        y = self.resolution[1] // 2 - size // 2
+        frame[y:y+size, x:x+size, :] = 255
+
+        self.frame_counter += 1
+
+        return frame
+
+
+picamera = types.SimpleNamespace(
+    PiCamera            = FakePiCamera,
+    exc                 = types.SimpleNamespace(PiCameraValueError=PiCameraValueError)
+)
+
+
+# --- RPi.GPIO
+
+
+class FakeGPIO(object):
+
+    # Pin levels in memory. Buttons are pressed by press() or by the
+    # TLP_SIM_BUTTONS script, edge callbacks run in a separate thread like
+    # the callbacks of RPi.GPIO do.
+
+    BCM         = 11
+    BOARD       = 10
+    IN          = 1
+    OUT         = 0
+    PUD_OFF     = 20
+    PUD_DOWN    = 21
+    PUD_UP      = 22
+    RISING      = 31
+    FALLING     = 32
+    BOTH        = 33
+    HIGH        = 1
+    LOW         = 0
+
+    def __init__(self):
+        self.lock       = Lock()
+        self.levels     = {}
+        self.idle       = {}    # level of a released button
+        self.callbacks  = {}
+        self.mode       = None
+
+    def setmode(self, mode):
+        self.mode = mode
+
+        script = os.environ.get("TLP_SIM_BUTTONS")
+        if script is not None and len(script) > 0:
+            self.run_script(script)
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        with self.lock:
+            level = 1 if pull_up_down == self.PUD_UP else 0
+            if initial is not None:
+                level = initial
+
+            self.levels[pin] = level
+            self.idle[pin] = level
+
+    def input(self, pin):
+        with self.lock:
+            return self.levels.get(pin, 0)
+
+    def output(self, pin, level):
+        with self.lock:
+            self.levels[pin] = level
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        with self.lock:
+            self.levels = {}
+            self.callbacks = {}
+
+    # presses the button at pin for duration seconds (in the background)
+    def press(self, pin, duration=0.1):
+        self._set(pin, 1 - self.idle.get(pin, 1))
+
+        timer = Timer(duration, self._set, args=[pin, self.idle.get(pin, 1)])
+        timer.daemon = True
+        timer.start()
+
+    # "time:pin:duration,...", times in seconds from now
+    def run_script(self, script):
+
+        presses = []
+        for item in script.split(","):
+            press_time, pin, duration = item.split(":")
+            presses.append((float(press_time), int(pin), float(duration)))
+
+        def run():
+            time_start = time.monotonic()
+            for press_time, pin, duration in sorted(presses):
+                time.sleep(max(0, time_start + press_time - time.monotonic()))
+                log.debug("simulated button press: pin {} for {:.2f}s".format(pin, duration))
+                self.press(pin, duration)
+
+        Thread(target=run, name="FakeGPIO script", daemon=True).start()
+
+    def _set(self, pin, level):
+
+        with self.lock:
+            previous = self.levels.get(pin)
+            self.levels[pin] = level
+            edge, callback = self.callbacks.get(pin, (None, None))
+
+        if callback is None or previous == level:
+            return
+
+        if edge == self.BOTH or (edge == self.RISING and level == 1) or (edge == self.FALLING and level == 0):
+            Thread(target=callback, args=[pin], daemon=True).start()
+
+
+GPIO = FakeGPIO()
+
+
+# --- CompressorCameraController
+
+
+class ControllerEmulator(object):
+
+    # Answers the protocol of the controller on a pseudo terminal, the slave side
+    # (port) can be opened with pyserial like the real serial port. ASCII lines and
+    # binary frames (see CompressorCameraController.FRAME_FLAG) are both understood,
+    # binary=False emulates firmware without framing support.
+
+    FRAME_FLAG          = 0x80
+    FRAME_MAX_PAYLOAD   = 0x7F
+    FRAMING_REQUEST     = "F1"
+
+    def __init__(self, latency=CONTROLLER_LATENCY, baudrate=None, binary=True):
+        self.latency        = latency
+        self.baudrate       = baudrate if baudrate is not None else _get_env("TLP_SIM_BAUDRATE", None, int)
+        self.binary         = binary
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port           = os.ttyname(self.slave)
+
+        self.time_start     = time.monotonic()
+        self.commands       = []
+        self.shutdown_delay = None
+        self.closed         = False
+
+        self.thread = Thread(target=self._run, name="ControllerEmulator", daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return "ControllerEmulator at {}".format(self.port)
+
+    def close(self):
+        self.closed = True
+        os.close(self.master)
+        os.close(self.slave)
+
+    def execute(self, cmd, param):
+
+        # returns the response values (a list) or raises an exception
+
+        if cmd == "K":
+            return []
+        elif cmd == "B":
+            # raw ADC reading and voltage
+            return [int(CONTROLLER_BATTERY / 5.0 * 1023), CONTROLLER_BATTERY]
+        elif cmd == "T":
+            return [CONTROLLER_TEMPERATURE]
+        elif cmd == "U":
+            return [int(time.monotonic() - self.time_start)]
+        elif cmd in ["D", "N"]:
+            return [0]
+        elif cmd in ["L", "Z", "R", "I"]:
+            return []
+        elif cmd == "S":
+            self.shutdown_delay = int(param) if param is not None else 0
+            log.info("simulated controller: shutdown in {}ms".format(self.shutdown_delay))
+            return []
+        else:
+            raise Exception("unknown command")
+
+    def handle(self, line):
+
+        # returns the response line for a command line
+
+        parts = line.strip().split(" ")
+        cmd = parts[0]
+        param = parts[1] if len(parts) > 1 else None
+
+        self.commands.append(line)
+
+        if cmd == "K" and param == self.FRAMING_REQUEST and self.binary:
+            return "K {}".format(self.FRAMING_REQUEST)
+
+        try:
+            values = self.execute(cmd, param)
+        except Exception as e:
+            return "E {}".format(e)
+
+        if cmd == "B":
+            return "K {} {:.2f}".format(*values)
+        elif cmd == "T":
+            return "K {:.1f}".format(*values)
+
+        return " ".join(["K"] + [str(value) for value in values])
+
+    def handle_frame(self, cmd, payload):
+
+        # returns the response frame for a command frame
+
+        param = None
+        if len(payload) > 0:
+            if cmd in ["S", "L", "Z"]:
+                param = str(int.from_bytes(payload, "little"))
+            else:
+                param = payload.decode("utf-8", errors="replace")
+
+        self.commands.append(cmd if param is None else "{} {}".format(cmd, param))
+
+        status = "K"
+        try:
+            values = self.execute(cmd, param)
+
+            if cmd == "B":
+                payload = struct.pack("<HH", values[0], round(values[1] * 1000))
+            elif cmd == "T":
+                value = round(values[0] * 10)
+                payload = value.to_bytes((value.bit_length() + 8) // 8, "little", signed=True)
+            elif len(values) > 0:
+                payload = values[0].to_bytes(max(1, (values[0].bit_length() + 7) // 8), "little")
+            else:
+                payload = b""
+        except Exception as e:
+            status = "E"
+            payload = str(e).encode("utf-8")
+
+        return self._encode_frame(status, payload)
+
+    def _encode_frame(self, status, payload):
+        frame = bytes([self.FRAME_FLAG | len(payload), ord(status)]) + payload
+        return frame + bytes([sum(frame) & 0xFF])
+
+    def _transfer(self, num_bytes):
+        # time on the line at 8N1 (10 bits per byte)
+        if self.baudrate is not None:
+            time.sleep(num_bytes * 10 / self.baudrate)
+
+    def _run(self):
+
+        data = b""
+
+        while not self.closed:
+            try:
+                chunk = os.read(self.master, 1024)
+            except OSError as e:
+                break
+
+            self._transfer(len(chunk))
+            data += chunk
+
+            while len(data) > 0:
+
+                if data[0] & self.FRAME_FLAG and self.binary:
+                    length = (data[0] & self.FRAME_MAX_PAYLOAD) + 3
+                    if len(data) < length:
+                        break
+
+                    frame, data = data[:length], data[length:]
+
+                    if sum(frame[:-1]) & 0xFF != frame[-1]:
+                        response = self._encode_frame("E", b"checksum")
+                    else:
+                        response = self.handle_frame(chr(frame[1]), frame[2:-1])
+
+                elif b"\n" in data:
+                    line, data = data.split(b"\n", 1)
+                    response = (self.handle(line.decode("utf-8", errors="replace")) + "\n").encode("utf-8")
+
+                else:
+                    break
+
+                time.sleep(self.latency)
+                self._transfer(len(response))
+                os.write(self.master, response)
+
+
+controller_emulator = None
+
+def get_controller_emulator():
+
+    global controller_emulator
+
+    if controller_emulator is None:
+        controller_emulator = ControllerEmulator()
+
+    return controller_emulator
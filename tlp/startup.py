@@ -0,0 +1,82 @@
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def get_uptime():
+
+    # seconds since the kernel started (close to power-on), None if unknown
+
+    try:
+        with open("/proc/uptime", "r") as f:
+            return float(f.read().split()[0])
+    except Exception as e:
+        return None
+
+
+class StartupTimer(object):
+
+    # Records named boot milestones relative to process start and to power-on
+    # (/proc/uptime). Create it before the expensive imports, so the time spent
+    # importing shows up in the report as well.
+
+    def __init__(self):
+        self.time_start     = time.perf_counter()
+        self.uptime_start   = get_uptime()
+        self.marks          = []
+
+    def mark(self, name):
+
+        elapsed = time.perf_counter() - self.time_start
+        self.marks.append((name, elapsed))
+
+        log.debug("startup: {} after {:.3f}s".format(name, elapsed))
+
+        return elapsed
+
+    # seconds from power-on to the milestone name (None if unknown or not reached)
+    def get_since_power_on(self, name):
+
+        if self.uptime_start is None:
+            return None
+
+        for mark_name, elapsed in self.marks:
+            if mark_name == name:
+                return self.uptime_start + elapsed
+
+        return None
+
+    def get_report(self):
+
+        report = {
+            "power_on_to_process":  self.uptime_start,
+            "marks":                []
+        }
+
+        last = 0
+        for name, elapsed in self.marks:
+            report["marks"].append({
+                "name":             name,
+                "since_start":      elapsed,
+                "since_last":       elapsed - last,
+                "since_power_on":   None if self.uptime_start is None else self.uptime_start + elapsed
+            })
+            last = elapsed
+
+        return report
+
+    def log_report(self):
+
+        report = self.get_report()
+
+        if report["power_on_to_process"] is not None:
+            log.info("startup | {:<24s} | {:7.3f}s".format("power on -> process", report["power_on_to_process"]))
+
+        for mark in report["marks"]:
+            since_power_on = ""
+            if mark["since_power_on"] is not None:
+                since_power_on = " | power on: {:7.3f}s".format(mark["since_power_on"])
+
+            log.info("startup | {:<24s} | {:7.3f}s (+{:.3f}s){}".format(
+                mark["name"], mark["since_start"], mark["since_last"], since_power_on))
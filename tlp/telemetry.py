@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import math
+import time
+import struct
+import collections
+from threading import Thread, Event, Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+# Time series of controller telemetry (battery voltage, temperature, uptime, debug
+# register), CPU load and temperature and pipeline events in a fixed-size binary ring
+# file. Samples are taken every SAMPLE_INTERVAL seconds from the ControllerClient cache
+# (the sampler never waits on the UART), events are recorded when they happen.
+#
+# File: header, then capacity records. The header holds the total number of records
+# written, the next record goes to index count % capacity. Records are written with
+# pwrite() in place, without fsync: a power loss costs at most the last few records.
+#
+# Run this file to get per-shot battery and temperature deltas: python3 telemetry.py .telemetry
+
+TELEMETRY_FILE          = ".telemetry"
+
+MAGIC                   = b"TLPT"
+VERSION                 = 1
+
+# magic, version, record size, capacity, count
+HEADER                  = struct.Struct("<4sHHIQ")
+
+# time, battery (V), temperature (C), cpu temperature (C), cpu load (0-1),
+# controller uptime (s), debug register, event, event argument (shot id)
+RECORD                  = struct.Struct("<dffffIIBI")
+
+DEFAULT_CAPACITY        = 32768     # 1.2MB, ~45h at SAMPLE_INTERVAL
+SAMPLE_INTERVAL         = 5
+
+UNKNOWN                 = 0xFFFFFFFF    # integer fields, floats are NaN
+
+CPU_TEMPERATURE_FILE    = "/sys/class/thermal/thermal_zone0/temp"
+
+# estimate of the energy drawn from the battery voltage drop (linear discharge curve)
+BATTERY_FULL            = 4.2
+BATTERY_EMPTY           = 3.3
+BATTERY_CAPACITY        = 11.1      # Wh
+
+EVENT_SAMPLE            = 0
+EVENT_BOOT              = 1
+EVENT_SHUTDOWN          = 2
+EVENT_SHOT              = 3     # trigger, argument: shot id
+EVENT_CAPTURED          = 4
+EVENT_FILTER_START      = 5
+EVENT_FILTER_DEFERRED   = 6
+EVENT_DONE              = 7
+EVENT_FAILED            = 8
+EVENT_DROPPED           = 9
+EVENT_REC_START         = 10
+EVENT_REC_STOP          = 11
+
+EVENT_NAMES = {
+    EVENT_SAMPLE:           "SAMPLE",
+    EVENT_BOOT:             "BOOT",
+    EVENT_SHUTDOWN:         "SHUTDOWN",
+    EVENT_SHOT:             "SHOT",
+    EVENT_CAPTURED:         "CAPTURED",
+    EVENT_FILTER_START:     "FILTER_START",
+    EVENT_FILTER_DEFERRED:  "FILTER_DEFERRED",
+    EVENT_DONE:             "DONE",
+    EVENT_FAILED:           "FAILED",
+    EVENT_DROPPED:          "DROPPED",
+    EVENT_REC_START:        "REC_START",
+    EVENT_REC_STOP:         "REC_STOP"
+}
+
+# a shot is over with one of these events
+SHOT_END_EVENTS         = [EVENT_DONE, EVENT_FAILED, EVENT_DROPPED]
+
+Record = collections.namedtuple("Record", [
+    "time", "battery", "temperature", "cpu_temperature", "cpu_load",
+    "uptime", "debug_register", "event", "arg"])
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except Exception as e:
+        return math.nan
+
+
+def _to_int(value):
+    try:
+        value = int(value)
+        if 0 <= value < UNKNOWN:
+            return value
+    except Exception as e:
+        pass
+
+    return UNKNOWN
+
+
+class TelemetryRecorder(object):
+
+    # Appends records to the ring file. An existing file with the same
+    # layout is continued, otherwise it is recreated.
+
+    def __init__(self, filename, capacity=DEFAULT_CAPACITY):
+        self.filename   = filename
+        self.capacity   = capacity
+        self.count      = 0
+        self.lock       = Lock()
+
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            magic, version, record_size, file_capacity, count = HEADER.unpack(os.pread(self.fd, HEADER.size, 0))
+
+            if magic != MAGIC or version != VERSION or record_size != RECORD.size or file_capacity != capacity:
+                raise Exception("layout changed")
+
+            self.count = count
+        except Exception as e:
+            log.debug("new telemetry file {}: {}".format(filename, e))
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, HEADER.size + capacity * RECORD.size)
+            self._write_header()
+
+    def __repr__(self):
+        return "TelemetryRecorder at {} [{}/{}]".format(self.filename, min(self.count, self.capacity), self.capacity)
+
+    def write(self, record):
+
+        data = RECORD.pack(*record)
+
+        with self.lock:
+            if self.fd is None:
+                return
+
+            os.pwrite(self.fd, data, HEADER.size + (self.count % self.capacity) * RECORD.size)
+            self.count += 1
+            self._write_header()
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def _write_header(self):
+        os.pwrite(self.fd, HEADER.pack(MAGIC, VERSION, RECORD.size, self.capacity, self.count), 0)
+
+
+class TelemetrySampler(object):
+
+    # Samples every interval seconds in a background thread, event() records right away.
+    # The controller (a ControllerClient) may be set later, its values are NaN/UNKNOWN until then.
+
+    def __init__(self, filename, controller=None, interval=SAMPLE_INTERVAL, capacity=DEFAULT_CAPACITY):
+        self.recorder   = TelemetryRecorder(filename, capacity=capacity)
+        self.controller = controller
+        self.interval   = interval
+
+        self.cpu_times  = None
+        self.cpu_lock   = Lock()
+
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run, name="TelemetrySampler", daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return "TelemetrySampler [{}]".format(self.recorder)
+
+    def set_controller(self, controller):
+        self.controller = controller
+
+    def event(self, event, arg=0):
+        try:
+            self.recorder.write(self._sample(event, arg))
+        except Exception as e:
+            log.warning("recording telemetry failed: {}".format(e))
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.recorder.close()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.event(EVENT_SAMPLE)
+
+    def _sample(self, event, arg):
+
+        battery = temperature = math.nan
+        uptime = debug_register = UNKNOWN
+
+        controller = self.controller
+        if controller is not None:
+            telemetry = controller.get_telemetry()
+            battery = _to_float(telemetry.get(controller.TELEMETRY_BATTERY))
+            temperature = _to_float(telemetry.get(controller.TELEMETRY_TEMPERATURE))
+            uptime = _to_int(telemetry.get(controller.TELEMETRY_UPTIME))
+            debug_register = _to_int(telemetry.get(controller.TELEMETRY_DEBUG_REGISTER))
+
+        return Record(
+            time.time(),
+            battery,
+            temperature,
+            self._get_cpu_temperature(),
+            self._get_cpu_load(),
+            uptime,
+            debug_register,
+            event,
+            _to_int(arg))
+
+    def _get_cpu_temperature(self):
+        try:
+            with open(CPU_TEMPERATURE_FILE, "r") as f:
+                return int(f.read()) / 1000
+        except Exception as e:
+            return math.nan
+
+    def _get_cpu_load(self):
+
+        # share of busy time of all cores since the previous call
+
+        try:
+            with open("/proc/stat", "r") as f:
+                values = [int(x) for x in f.readline().split()[1:]]
+        except Exception as e:
+            return math.nan
+
+        idle = values[3] + values[4] # idle, iowait
+        total = sum(values)
+
+        with self.cpu_lock:
+            previous = self.cpu_times
+            self.cpu_times = (idle, total)
+
+        if previous is None or total == previous[1]:
+            return math.nan
+
+        return 1 - (idle - previous[0]) / (total - previous[1])
+
+
+def read(filename):
+
+    # all records, oldest first
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    magic, version, record_size, capacity, count = HEADER.unpack_from(data, 0)
+
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise Exception("unknown telemetry file format: {}".format(filename))
+
+    indices = range(0, count)
+    if count > capacity:
+        indices = range(count - capacity, count)
+
+    return [Record(*RECORD.unpack_from(data, HEADER.size + (i % capacity) * RECORD.size)) for i in indices]
+
+
+def _get_value(records, field, start, end):
+
+    # last valid value at or before start, first valid value after end
+
+    before = None
+    after = None
+
+    for record in records:
+        value = getattr(record, field)
+
+        if type(value) is float and math.isnan(value):
+            continue
+
+        if record.time <= start:
+            before = value
+        elif record.time > end:
+            after = value
+            break
+
+    return before, after
+
+
+def get_shot_deltas(records):
+
+    # per shot from the trigger to its last pipeline event (captured, done, failed).
+    # Battery and temperature before the trigger and the first reading after the shot,
+    # cpu load and temperature are averaged over the samples in between.
+    # A shot id is only unique until the next boot.
+
+    shots = collections.OrderedDict()
+    boot = 0
+
+    for record in records:
+
+        if record.event == EVENT_BOOT:
+            boot += 1
+            continue
+
+        if record.event in [EVENT_SAMPLE, EVENT_SHUTDOWN, EVENT_REC_START, EVENT_REC_STOP]:
+            continue
+
+        key = (boot, record.arg)
+
+        if record.event == EVENT_SHOT:
+            shots[key] = {"id": record.arg, "start": record.time, "end": record.time, "result": None}
+        elif key in shots:
+            shots[key]["end"] = record.time
+            if record.event in SHOT_END_EVENTS or record.event == EVENT_CAPTURED:
+                shots[key]["result"] = EVENT_NAMES[record.event]
+
+    deltas = []
+
+    for shot in shots.values():
+
+        battery_start, battery_end = _get_value(records, "battery", shot["start"], shot["end"])
+        temperature_start, temperature_end = _get_value(records, "temperature", shot["start"], shot["end"])
+
+        window = [r for r in records if shot["start"] <= r.time <= shot["end"]]
+        cpu_load = [r.cpu_load for r in window if not math.isnan(r.cpu_load)]
+        cpu_temperature = [r.cpu_temperature for r in window if not math.isnan(r.cpu_temperature)]
+
+        delta = dict(shot)
+        delta["duration"] = shot["end"] - shot["start"]
+        delta["battery_delta"] = None
+        delta["energy"] = None
+        delta["temperature_delta"] = None
+        delta["cpu_load"] = sum(cpu_load) / len(cpu_load) if len(cpu_load) > 0 else None
+        delta["cpu_temperature_max"] = max(cpu_temperature) if len(cpu_temperature) > 0 else None
+
+        if battery_start is not None and battery_end is not None:
+            delta["battery_delta"] = battery_end - battery_start
+            delta["energy"] = (battery_start - battery_end) / (BATTERY_FULL - BATTERY_EMPTY) * BATTERY_CAPACITY
+
+        if temperature_start is not None and temperature_end is not None:
+            delta["temperature_delta"] = temperature_end - temperature_start
+
+        deltas.append(delta)
+
+    return deltas
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print("usage: python3 telemetry.py <telemetry file>")
+        sys.exit(1)
+
+    records = read(sys.argv[1])
+
+    if len(records) > 0:
+        print("{} records, {} to {}".format(
+            len(records),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(records[0].time)),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(records[-1].time))))
+
+    def _format(value, fmt):
+        return fmt.format(value) if value is not None else "-"
+
+    print("{:<19s} | {:>5s} | {:<8s} | {:>7s} | {:>9s} | {:>8s} | {:>7s} | {:>8s} | {:>8s}".format(
+        "time", "shot", "result", "dur", "battery", "energy", "temp", "cpu load", "cpu temp"))
+
+    for delta in get_shot_deltas(records):
+        print("{:<19s} | {:5d} | {:<8s} | {:>7s} | {:>9s} | {:>8s} | {:>7s} | {:>8s} | {:>8s}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(delta["start"])),
+            delta["id"],
+            delta["result"] or "-",
+            _format(delta["duration"], "{:.1f}s"),
+            _format(delta["battery_delta"] * 1000 if delta["battery_delta"] is not None else None, "{:+.0f}mV"),
+            _format(delta["energy"] * 1000 if delta["energy"] is not None else None, "{:.1f}mWh"),
+            _format(delta["temperature_delta"], "{:+.1f}C"),
+            _format(delta["cpu_load"], "{:.0%}"),
+            _format(delta["cpu_temperature_max"], "{:.1f}C")))
@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 
-import math
 import time
-import datetime
 import os
 import sys
 import subprocess
@@ -12,16 +10,35 @@ import traceback
 
 from concurrent.futures import ThreadPoolExecutor
 
-import RPi.GPIO as GPIO
-import picamera
-import numpy as np
-import cv2
-from PIL import Image
+# created before all other imports, the startup report covers the import time too
+from startup import StartupTimer
+boot_timer = StartupTimer()
+
+# heavy imaging libraries (numpy, cv2, PIL) are not imported here, the preview
+# does not need them. They are loaded by the background init (see TLCam)
+
+# RPi.GPIO and picamera, or their simulated counterparts (TLP_BACKEND=sim)
+import hardware
+from hardware import GPIO, picamera
 
 # from pyzbar.pyzbar import decode, ZBarSymbol
 
-from devices import CompressorCameraController
+from devices import CompressorCameraController, ControllerClient
+from allocator import FilenameAllocator, LAYOUT_FLAT, LAYOUT_DATE, LAYOUT_BLOCK
+from buffers import BufferPool
+from writer import ImageWriter
+from pipeline import ShotPipeline, SHOT_CAPTURING, SHOT_CAPTURED, SHOT_FILTERING, SHOT_DEFERRED, SHOT_DONE, SHOT_DROPPED, SHOT_FAILED
+from scheduler import FilterScheduler
+from journal import FilterJournal
+from profiles import CameraProfiles, PROFILE_FILE
+import telemetry
+from telemetry import TelemetrySampler, TELEMETRY_FILE
+from overlay import OverlayManager
+from inputs import InputHandler, EVENT_SHORT_PRESS, EVENT_LONG_PRESS, EVENT_RELEASE
 import filters
+import metrics
+
+boot_timer.mark("imports")
 
 # revA/B | BCM numbering
 PIN_BUTTON_SHUTTER      = 22 
@@ -31,17 +48,92 @@ PIN_BUTTON_CAM1         =  4
 PIN_LED1                =  6
 PIN_LED2                = 13
 
-OUTPUT_DIR              = "/media/storage"
+OUTPUT_DIR              = hardware.get_output_dir("/media/storage")
 OUTPUT_DIR_TMP          = "/home/pi/tmp"
 ASSET_DIR               = "assets"
 
+# preview overlays, loaded once at startup {name: filename in ASSET_DIR}
+OVERLAY_FILTER          = "filter"
+OVERLAY_ASSETS          = {
+    OVERLAY_FILTER:         "overlay_filter.png"
+}
+OVERLAY_LAYER           = 3
+OVERLAY_ALPHA           = 128
+
+# LAYOUT_FLAT | LAYOUT_DATE | LAYOUT_BLOCK (subdirectories of FILENAME_BLOCK_SIZE images)
+FILENAME_LAYOUT         = LAYOUT_FLAT
+FILENAME_BLOCK_SIZE     = 1000
+
+# with TLP_BACKEND=sim the emulator's port is used instead (see hardware.get_serial_port)
 SERIAL_PORT             = "/dev/ttyAMA0"
+# binary frames instead of ASCII lines, if the controller firmware supports them
+# (see CompressorCameraController.BINARY_FRAMING)
+SERIAL_BINARY_FRAMING   = False
 
 IMAGE_FORMAT            = "jpeg"
 CAPTURE_RAW             = False
 SENSOR_MODE             = 0 #3 #0
 EXPOSURE_COMPENSATION   = 0
 
+# fast still: keep the sensor at still resolution (the preview is downscaled by the
+# renderer) so a capture does not need to switch between preview and still settings.
+# Capturing via the video port skips the still port pipeline too, at the expense of
+# slightly noisier images. Run shutterlag.py to compare both paths on the device.
+# Off by default: when on, the preview runs at still resolution, with a lower frame rate
+# and more power draw and heat.
+FAST_STILL              = False
+FAST_STILL_VIDEO_PORT   = False
+
+# max number of images waiting to be encoded and written
+WRITER_QUEUE_SIZE       = 4
+
+# max number of shots waiting for or running a filter. Further shots are still
+# captured but their filter is deferred (and reloaded from disk later).
+# Below MIN_MEMORY_CAPTURE bytes available a shot is dropped, below MIN_MEMORY_FILTER
+# bytes the filter is deferred
+MAX_SHOTS_IN_FLIGHT     = 2
+MIN_MEMORY_CAPTURE      = 64  * 1024 * 1024
+MIN_MEMORY_FILTER       = 192 * 1024 * 1024
+
+# capture buffers per camera (~37MB each for the IMX477, in /dev/shm): CAPTURE_BUFFERS
+# stay allocated, more are allocated while shots are in flight and freed afterwards.
+# At most one per shot held by a filter, one for the capture in progress and one for
+# a deferred (or unfiltered) shot the writer has not encoded yet. With fewer, a press
+# while filters are running waits for a buffer and falls back to an unshared temporary one
+CAPTURE_BUFFERS         = 2
+CAPTURE_BUFFERS_WRITER  = 1
+CAPTURE_BUFFERS_MAX     = MAX_SHOTS_IN_FLIGHT + 1 + CAPTURE_BUFFERS_WRITER
+
+# filter processes (CM4: 4 cores, one is left for capturing and writing)
+FILTER_WORKERS          = 3
+
+# filter jobs are journaled in OUTPUT_DIR. Before poweroff running jobs get up to
+# FILTER_DRAIN_TIMEOUT seconds to finish, the rest is resumed FILTER_RESUME_DELAY
+# seconds after the next boot (with low priority)
+FILTER_JOURNAL          = ".filter_journal"
+FILTER_DRAIN_TIMEOUT    = 60
+FILTER_RESUME_DELAY     = 30
+
+# per-stage timing of captures and filters (rotated to METRICS_FILE.1 at METRICS_MAX_SIZE
+# bytes), aggregate with: python3 metrics.py .metrics .metrics.1. None: disabled
+METRICS_FILE            = ".metrics"
+METRICS_MAX_SIZE        = 1024 * 1024
+
+# controller telemetry, cpu load and shot events every TELEMETRY_INTERVAL seconds in
+# a ring file (TELEMETRY_FILE in OUTPUT_DIR), per-shot deltas: python3 telemetry.py .telemetry
+TELEMETRY_ENABLED       = True
+TELEMETRY_INTERVAL      = 5
+
+SHOT_EVENTS = {
+    SHOT_CAPTURING:     telemetry.EVENT_SHOT,
+    SHOT_CAPTURED:      telemetry.EVENT_CAPTURED,
+    SHOT_FILTERING:     telemetry.EVENT_FILTER_START,
+    SHOT_DEFERRED:      telemetry.EVENT_FILTER_DEFERRED,
+    SHOT_DONE:          telemetry.EVENT_DONE,
+    SHOT_DROPPED:       telemetry.EVENT_DROPPED,
+    SHOT_FAILED:        telemetry.EVENT_FAILED
+}
+
 SCAN_QR_CODES           = False
 QR_CODE_PREFIX          = "TLP::"
 DEFAULT_ACTIVE_FILTER   = filters.FILTER_BOOMERANG
@@ -50,13 +142,25 @@ DEFAULT_ACTIVE_FILTER   = filters.FILTER_BOOMERANG
 RECORDING_TIME_MAX      = 10
 IDLE_TIME_MAX           = 300 
 TRIGGER_TIMEOUT         = 10
+INIT_TIMEOUT            = 30
+CONTROLLER_TIMEOUT      = 2
+OVERLAY_DURATION        = 1
 
 # consts
 MODE_IDLE   = 0
 MODE_REC    = 30
 
+# buttons: a press is long (video) if the shutter is held this long (seconds)
+LONG_PRESS_TIME         = 0.5
+BUTTON_BOUNCETIME       = 20 # ms
+
+BUTTON_SHUTTER          = "SHUTTER"
+BUTTON_CAM0             = "CAM0"
+BUTTON_CAM1             = "CAM1"
+
 # FOR DEBUG:
 IDLE_TIME_MAX           = 600
+DEBUG_TRIGGER_ONCE      = False # trigger once after startup and exit
 
 # camera settings: PREVIEW / STILL / VIDEO
 
@@ -92,6 +196,8 @@ MODE_PREVIEW    = 0
 MODE_STILL      = 1
 MODE_VIDEO      = 2
 
+log = logging.getLogger("tlp")
+
 
 def global_except_hook(exctype, value, tb):
     
@@ -117,49 +223,28 @@ def global_except_hook(exctype, value, tb):
     # sys.__excepthook__(exctype, value, traceback)
 
 
-def _change_camera_settings(cam, mode):
-
-    camera_type = None
-
-    log.debug("change mode: {}".format(mode))
-
-    try:
-        key = str(cam.revision).upper()
-        for setting in CAMERA_SETTINGS[key][mode]:
-            setattr(cam, setting, CAMERA_SETTINGS[key][mode][setting])
-
-        camera_type = key
-        log.debug("cam {} | camera settings applied: {}".format(cam, key))
-    except picamera.exc.PiCameraValueError as e:
-        log.debug("cam {} | failing setting camera resolution for {}, attempting fallback".format(cam, key))
-
-        for key in CAMERA_SETTINGS.keys():
-            try:
-                # set to STILL resolution to check if it fails
-                cam.resolution = CAMERA_SETTINGS[key][MODE_STILL]["resolution"]
-     
-                for setting in CAMERA_SETTINGS[key][mode]:
-                    setattr(cam, setting, CAMERA_SETTINGS[key][mode][setting])
-
-                camera_type = key
-                log.debug("cam {} | camera settings applied: {}".format(cam, key))
+# direct lookup in the camera profile, no trial reconfiguration
+def _change_camera_settings(cam, profile, mode):
+    CameraProfiles.apply(cam, profile, mode)
 
-                break
-            except picamera.exc.PiCameraValueError as e:
-                log.debug("cam {} | failing setting camera resolution for {}, attempting fallback".format(cam, key))
-         
-    return camera_type
 
+# captures into a CaptureBuffer from the camera's BufferPool, 
+# returns the image view without the padding
+def _capture(cam, profile, buffer, fast_still=None):
 
-def _trigger(cam, filename):
+    if fast_still is None:
+        fast_still = FAST_STILL
 
-    camera_type = _change_camera_settings(cam, MODE_STILL)
+    # fast still: the camera is kept at still resolution all the time, 
+    # no sensor reconfiguration before and after the capture
+    if not fast_still:
+        with metrics.span("trigger.mode_switch", tag=profile.camera_num):
+            _change_camera_settings(cam, profile, MODE_STILL)
 
     # capture to file
     # self.camera.capture(os.path.join(*filename), format=IMAGE_FORMAT, bayer=CAPTURE_RAW)
 
     # capture to numpy datastructure
-    res = CAMERA_SETTINGS[camera_type][MODE_STILL]["resolution"]
 
     # beware, from the picamera docs:
     # It is also important to note that when outputting to unencoded formats, the camera rounds the 
@@ -167,19 +252,33 @@ def _trigger(cam, filename):
     # while the vertical resolution is rounded up to the nearest multiple of 16 pixels. For example, 
     # if the requested resolution is 100x100, the capture will actually contain 128x112 pixels worth of data, 
     # but pixels beyond 100x100 will be uninitialized.
-    
-    res_rounded = [res[0], res[1]]
-    res_rounded[0] = math.ceil(res_rounded[0] / 32)*32 
-    res_rounded[1] = math.ceil(res_rounded[1] / 16)*16 
+    #
+    # The padded buffer and the cropped view (rows: height, cols: width) are provided by the CaptureBuffer
+
+    with metrics.span("trigger.capture", tag=profile.camera_num):
+        cam.capture(buffer.data, "bgr", use_video_port=(fast_still and FAST_STILL_VIDEO_PORT)) #"rgb")
+
+    if not fast_still:
+        with metrics.span("trigger.mode_switch", tag=profile.camera_num):
+            _change_camera_settings(cam, profile, MODE_PREVIEW)
 
-    img = np.empty((res_rounded[1] * res_rounded[0] * 3), dtype=np.uint8)
-    cam.capture(img, "bgr") #"rgb")
+    return buffer.image
 
-    # cut off padding from rounding
-    img = img.reshape([res_rounded[1], res_rounded[0], 3])
-    img = img[:res[0], :res[1], :]
 
-    # TODO: somewhere I am mixing up rows and cols, making the image square. Where?
+def _trigger(cam, profile, buffer_pool, writer, filename):
+
+    time_start = time.perf_counter()
+
+    with metrics.span("trigger.acquire", tag=profile.camera_num):
+        buffer = buffer_pool.acquire()
+
+    try:
+        img = _capture(cam, profile, buffer)
+    except Exception as e:
+        buffer.release()
+        raise e
+
+    shutter_lag = time.perf_counter() - time_start
 
     # scan for QR codes always on the out-of-camera image
     if SCAN_QR_CODES:
@@ -194,29 +293,23 @@ def _trigger(cam, filename):
     # self.save_image(filename, img)
     # print(img.shape)
 
-    # write to file
-    cv2.imwrite(os.path.join(*filename), img)
+    # write to file (encoding and writing happens in the writer thread,
+    # spans write.encode, write.file and write.fsync)
+    with metrics.span("trigger.submit", tag=profile.camera_num):
+        writer.submit(os.path.join(*filename), img, buffer=buffer)
 
-    log.info("TRIGGER: {}".format(filename[1]))
+    log.info("TRIGGER: {} | shutter lag: {:.0f}ms".format(filename[1], shutter_lag * 1000))
 
-    _change_camera_settings(cam, MODE_PREVIEW)
+    return (filename, img, buffer)
 
-    return (filename, img)
 
+# done-callback of a _trigger future the shot has given up on (failed or timed out)
+def _release_capture(future):
 
-# captures data: [[filename0, img0], [filename1, img1]]
-def _apply_filter(filter_type, captures_data):
-    try:
-        if filter_type == filters.FILTER_BOOMERANG:
-            filename = os.path.join(captures_data[0][0][0], "filter_" + captures_data[0][0][1])
-            filters.apply_boomerang(
-                filename, 
-                [x[1] for x in captures_data]
-            )
-        else:
-            log.error("cannot apply filter, unknown filter type: {}".format(filter_type))
-    except Exception as e:
-        log.error("applying filter {} failed: {}".format(filter_type, e))
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    future.result()[2].release()
 
 
 class TLCam(object):
@@ -228,57 +321,215 @@ class TLCam(object):
         except Exception as e:
             pass
 
+        if METRICS_FILE is not None:
+            metrics.configure(os.path.join(OUTPUT_DIR, METRICS_FILE), max_size=METRICS_MAX_SIZE)
+
+        self.telemetry = None
+        if TELEMETRY_ENABLED:
+            try:
+                self.telemetry = TelemetrySampler(os.path.join(OUTPUT_DIR, TELEMETRY_FILE), interval=TELEMETRY_INTERVAL)
+                self.telemetry.event(telemetry.EVENT_BOOT)
+            except Exception as e:
+                log.error("telemetry disabled: {}".format(e))
+
         self.mode               = MODE_IDLE
-        self.camera_type        = []
+        self.camera_profile     = [None, None]
+        self.buffer_pool        = [None, None]
         self.camera             = [None, None]
         self.active_filter      = DEFAULT_ACTIVE_FILTER
         self.timer_start        = None
-        self.last_interaction   = datetime.datetime.now()
+        self.last_interaction   = time.monotonic()
         self.controller         = None
+        self.controller_future  = None
+        self.inputs             = None
+
+        self.writer             = None
+        self.journal            = None
+        self.scheduler          = None
+        self.pipeline           = None
+        self.overlays           = None
+
+        self.allocator          = FilenameAllocator(OUTPUT_DIR, layout=FILENAME_LAYOUT, block_size=FILENAME_BLOCK_SIZE)
+
+        self.camera_profiles    = CameraProfiles(os.path.join(OUTPUT_DIR, PROFILE_FILE), CAMERA_SETTINGS)
 
-        self.pool = ThreadPoolExecutor(3)
+        self.capture_pool = [ThreadPoolExecutor(1), ThreadPoolExecutor(1)]
 
         self.init_pins()
 
+        # preview first: only camera 0 is opened before the preview is started.
+        # Camera 1, capture buffers, writer and filter scheduler are initialized 
+        # in the background, trigger() waits for them. The controller is probed in
+        # the background too, it is only waited for at poweroff
+        self.init_camera(0)
+        boot_timer.mark("camera 0")
+
+        self.camera[0].start_preview()
+        boot_timer.mark("preview")
+
+        log.info("preview started")
+
+        self.init_pool = ThreadPoolExecutor(2)
+        self.init_futures = [self.init_pool.submit(self._init_background)]
+        self.init_futures[-1].add_done_callback(self._init_done)
+        self.controller_future = self.init_pool.submit(self._init_controller)
+
+
+    def init_camera(self, i):
+
         picamera_args = [
             {},
             {"led_pin": 30}
         ]
 
-        for i in range(0, 2):
-            try:
-                self.camera[i] = (picamera.PiCamera(sensor_mode=SENSOR_MODE, camera_num=i, **picamera_args[i]))
-                self.camera[i].exif_tags["IFD0.Make"] = "TLP"
-                self.camera[i].exif_tags["IFD0.Model"] += "_TLP_{}".format(i)
+        try:
+            self.camera[i] = (picamera.PiCamera(sensor_mode=SENSOR_MODE, camera_num=i, **picamera_args[i]))
+            self.camera[i].exif_tags["IFD0.Make"] = "TLP"
+            self.camera[i].exif_tags["IFD0.Model"] += "_TLP_{}".format(i)
 
-                log.debug("init camera {} // sensor: {}".format(i, self.camera[i].revision))
-            except Exception as e:
-                log.debug("init camera {} failed: {}".format(i, e))
+            log.debug("init camera {} // sensor: {}".format(i, self.camera[i].revision))
+        except Exception as e:
+            log.debug("init camera {} failed: {}".format(i, e))
+            return
 
-        for cam in self.camera:
-            if cam is None:
+        cam = self.camera[i]
+
+        cam.meter_mode = "average"
+        cam.exposure_compensation = EXPOSURE_COMPENSATION
+        # camera.iso = 400
+
+        # sensor detection happens once, the profile is reused on later boots
+        self.camera_profile[i] = self.camera_profiles.get(cam, i)
+
+        if self.camera_profile[i] is None:
+            log.error("init camera {} failed: unknown sensor {}".format(i, cam.revision))
+            cam.close()
+            self.camera[i] = None
+            return
+
+        if FAST_STILL:
+            _change_camera_settings(cam, self.camera_profile[i], MODE_STILL)
+        else:
+            _change_camera_settings(cam, self.camera_profile[i], MODE_PREVIEW)
+
+
+    def _init_background(self):
+
+        # imported once here, writer and buffers use them later without import delay
+        import numpy
+        import cv2
+
+        boot_timer.mark("imaging libraries")
+
+        self.init_camera(1)
+        boot_timer.mark("camera 1")
+
+        for i in range(0, len(self.camera)):
+            if self.camera[i] is None:
                 continue
-            
-            cam.meter_mode = "average"
-            cam.exposure_compensation = EXPOSURE_COMPENSATION
-            # camera.iso = 400
 
-            _change_camera_settings(cam, MODE_PREVIEW)
+            # shared memory: handed to the filter processes without copying
+            self.buffer_pool[i] = BufferPool(
+                self.camera_profile[i].get_resolution(MODE_STILL), 
+                count=CAPTURE_BUFFERS, 
+                max_count=CAPTURE_BUFFERS_MAX, 
+                shared=True)
 
-        self.camera[0].start_preview()
+        boot_timer.mark("capture buffers")
+
+        self.overlays = OverlayManager(self.camera[0], ASSET_DIR, OVERLAY_ASSETS, layer=OVERLAY_LAYER, alpha=OVERLAY_ALPHA)
+        boot_timer.mark("overlays")
+
+        self.writer = ImageWriter(queue_size=WRITER_QUEUE_SIZE)
+
+        # the first block of sequence numbers (a scan after a crash) is not on the trigger path
+        self.allocator.prepare()
+
+        self.journal = FilterJournal(os.path.join(OUTPUT_DIR, FILTER_JOURNAL))
+        self.scheduler = FilterScheduler(
+            workers=FILTER_WORKERS, 
+            journal=self.journal, 
+            metrics_file=os.path.join(OUTPUT_DIR, METRICS_FILE) if METRICS_FILE is not None else None)
+        self.pipeline = ShotPipeline(
+            self.scheduler, 
+            self.writer.flush, 
+            max_in_flight=MAX_SHOTS_IN_FLIGHT, 
+            min_memory_capture=MIN_MEMORY_CAPTURE, 
+            min_memory_filter=MIN_MEMORY_FILTER,
+            event_fn=self._on_shot_event)
+
+        boot_timer.mark("pipeline")
 
         log.info("camera(s) ready")
 
+        # filter jobs interrupted by the last poweroff
+        self.scheduler.resume(delay=FILTER_RESUME_DELAY)
+
+
+    def _init_controller(self):
+
         try:
-            self.controller = CompressorCameraController.find_by_portname(SERIAL_PORT)
+            # the emulator's pseudo terminal changes with every run, no last known port
+            port_file = None
+            if not hardware.is_simulated():
+                port_file = os.path.join(OUTPUT_DIR, CompressorCameraController.PORT_FILE)
+
+            # last known port first, then SERIAL_PORT and all candidates in parallel
+            controller = CompressorCameraController.discover(
+                hardware.get_serial_port(SERIAL_PORT), 
+                port_file=port_file, 
+                binary_framing=SERIAL_BINARY_FRAMING)
+
+            if controller is not None:
+                # commands and telemetry reads run in the background from now on
+                self.controller = ControllerClient(controller)
+
+                if self.telemetry is not None:
+                    self.telemetry.set_controller(self.controller)
 
-            if self.controller is not None:
                 log.info("controller found")
             else:
                 log.warning("no controller found")
         except Exception as e:
             log.error("no controller found: {}".format(e))
 
+        boot_timer.mark("controller")
+
+
+    # blocks until the controller probe is done
+    def wait_controller(self, timeout=CONTROLLER_TIMEOUT):
+
+        if self.controller_future is None:
+            return
+
+        try:
+            self.controller_future.result(timeout=timeout)
+        except Exception as e:
+            log.error("controller probe incomplete: {}".format(e))
+
+
+    # blocks until the background init is done, raises its exceptions
+    def wait_ready(self, timeout=INIT_TIMEOUT):
+
+        if self.init_futures is None:
+            return
+
+        for future in self.init_futures:
+            future.result(timeout=timeout)
+
+        self.init_futures = None
+        self.init_pool.shutdown(wait=False)
+
+
+    # boot report as soon as the background init is done, not when it is first waited for
+    def _init_done(self, future):
+
+        if future.exception() is not None:
+            log.error("background init failed: {}".format(future.exception()))
+
+        boot_timer.mark("ready")
+        boot_timer.log_report()
+
 
     def init_pins(self):
 
@@ -292,12 +543,25 @@ class TLCam(object):
         GPIO.setup(PIN_LED1,            GPIO.OUT)
         GPIO.setup(PIN_LED2,            GPIO.OUT)
 
+        # edge detection, loop() blocks until a button event arrives
+        self.inputs = InputHandler(GPIO, bouncetime=BUTTON_BOUNCETIME)
+        self.inputs.add_button(BUTTON_SHUTTER,  PIN_BUTTON_SHUTTER, active_level=0, long_press=LONG_PRESS_TIME)
+        self.inputs.add_button(BUTTON_CAM0,     PIN_BUTTON_CAM0,    active_level=0)
+        self.inputs.add_button(BUTTON_CAM1,     PIN_BUTTON_CAM1,    active_level=0)
+
 
     def trigger(self):
 
-        future_triggers = []
+        self.wait_ready()
+
         filename = self.get_filename(IMAGE_FORMAT)
 
+        shot = self.pipeline.begin(filename, self.active_filter)
+        if shot is None:
+            return
+
+        future_triggers = []
+
         for i in range(0, len(self.camera)):
             cam = self.camera[i]
             if cam is None:
@@ -306,55 +570,94 @@ class TLCam(object):
             filename_split = os.path.splitext(filename[1])
             filename_new = [filename[0], "{}_{}{}".format(filename_split[0], i, filename_split[1])]
 
-            future_triggers.append(self.pool.submit(_trigger, cam, filename_new))
+            future_triggers.append(self.capture_pool[i].submit(_trigger, cam, self.camera_profile[i], self.buffer_pool[i], self.writer, filename_new))
 
-        # wait till all trigger threads are done
+        # wait till all trigger threads are done, 
+        # encoding, writing and filtering continue in the background
         captures_data = []
-        for f in future_triggers:
-            captures_data.append(f.result(timeout=TRIGGER_TIMEOUT))
+        exception = None
+        with self.scheduler.capture():
+            for f in future_triggers:
+                try:
+                    captures_data.append(f.result(timeout=TRIGGER_TIMEOUT))
+                except Exception as e:
+                    exception = e
+                    # a capture still running releases its buffer once it is done
+                    f.add_done_callback(_release_capture)
+
+        # the images already on their way to the writer are kept, the shot is not filtered
+        if exception is not None:
+            for capture in captures_data:
+                capture[2].release()
 
-        # apply filters?
-        future_filters = []
-        if self.active_filter is not None:
-            log.info("applying filter: {}".format(self.active_filter))
-            future_filters.append(self.pool.submit(_apply_filter, self.active_filter, captures_data))
+            self.pipeline.failed(shot, exception)
+            return
 
-        log.debug("trigger done")
+        self.pipeline.captured(shot, captures_data)
 
-        # TODO:
+        log.debug("trigger done [writer queue: {} | {} | battery: {}]".format(
+            self.writer.get_queue_depth(), 
+            self.pipeline, 
+            self.controller.get_battery_status() if self.controller is not None else None))
 
-        img = Image.open(os.path.join(ASSET_DIR, "overlay_filter.png"))
-        b = img.tobytes()
-        o = self.camera[0].add_overlay(b, layer=3, alpha=128)        
-        # o = camera.add_overlay(pad.tostring(), size=img.size)
-        # o = camera.add_overlay(np.getbuffer(a), layer=3, alpha=64)
+        # the overlay layer exists already, this only changes its alpha
+        self.overlays.show(OVERLAY_FILTER, duration=OVERLAY_DURATION)
 
-        time.sleep(1)
+
+    def _on_shot_event(self, shot, state):
+
+        if self.telemetry is None:
+            return
+
+        self.telemetry.event(SHOT_EVENTS[state], shot.id)
+
+        # the next samples show the battery and temperature right after the shot
+        if state in [SHOT_DONE, SHOT_FAILED] and self.controller is not None:
+            self.controller.refresh(ControllerClient.TELEMETRY_BATTERY)
+            self.controller.refresh(ControllerClient.TELEMETRY_TEMPERATURE)
 
 
     def start_recording(self):
 
         log.info("REC start")
 
+        if self.telemetry is not None:
+            self.telemetry.event(telemetry.EVENT_REC_START)
+
+        self.wait_ready()
+
+        # video is recorded with camera 0 only
+        cam = self.camera[0]
+
+        if cam is None:
+            log.error("REC failed: camera 0 not available")
+            return
+
         self.mode = MODE_REC
 
-        self.change_camera_settings(2)
+        _change_camera_settings(cam, self.camera_profile[0], MODE_VIDEO)
 
         filename = self.get_filename("h264")
         log.debug("recording file: {}".format(filename))
-        self.camera.start_recording(os.path.join(*filename))
+        cam.start_recording(os.path.join(*filename))
 
-        self.timer_start = datetime.datetime.now()
+        self.timer_start = time.monotonic()
 
 
     def stop_recording(self):
 
         log.info("REC stop")
 
+        if self.telemetry is not None:
+            self.telemetry.event(telemetry.EVENT_REC_STOP)
+
+        cam = self.camera[0]
+
         self.mode = MODE_IDLE
-        self.camera.stop_recording()
+        cam.stop_recording()
 
-        self.change_camera_settings(0)
+        # back to the settings captures expect (see FAST_STILL)
+        _change_camera_settings(cam, self.camera_profile[0], MODE_STILL if FAST_STILL else MODE_PREVIEW)
 
         self.convert_last_video_to_gif()
 
@@ -365,11 +668,14 @@ class TLCam(object):
             log.warning("incompatible QR code recognized. Payload: {}".format(str))
             raise Exception("incompatible QR")
 
-        ret = filters.configure_filter(payload[len(QR_CODE_PREFIX):])
+        ret = filters.select_filter(payload[len(QR_CODE_PREFIX):])
 
-        if ret is not None:
+        if ret == filters.FILTER_RESET:
+            log.info("filter reset")
+            self.active_filter = None
+        elif ret is not None:
             log.info("configured filter {}".format(ret))
-            self.filter_type = ret
+            self.active_filter = ret
         else:
             log.warning("compatible but unknown QR code recognized. Payload: {}".format(str))
             raise
@@ -393,115 +699,134 @@ class TLCam(object):
 
     def loop(self):
 
-        if self.mode == MODE_IDLE:
-
+        if DEBUG_TRIGGER_ONCE:
             time.sleep(1.0)
             self.trigger()
             time.sleep(1.0)
             self.close()
             exit()
 
-            if GPIO.input(PIN_BUTTON_SHUTTER) == 0:
-                time.sleep(0.5)
+        if self.mode == MODE_IDLE:
+
+            # sleeps until a button is pressed or the idle time is over
+            event = self.inputs.get(timeout=self.last_interaction + IDLE_TIME_MAX - time.monotonic())
 
-                self.last_interaction = datetime.datetime.now()
+            if event is not None:
+                self.last_interaction = time.monotonic()
 
-                # single press: photo
-                if GPIO.input(PIN_BUTTON_SHUTTER) == 1:
-                    self.trigger()
-                
-                # long press: video
-                if GPIO.input(PIN_BUTTON_SHUTTER) == 0:
-                    self.start_recording()
+                if event.name == BUTTON_SHUTTER:
 
+                    # single press: photo
+                    if event.type == EVENT_SHORT_PRESS:
+                        self.trigger()
 
-            if GPIO.input(PIN_BUTTON_CAM0) == 0:
-                self.last_interaction = datetime.datetime.now()
+                    # long press: video
+                    if event.type == EVENT_LONG_PRESS:
+                        self.start_recording()
 
+            elif time.monotonic() - self.last_interaction > IDLE_TIME_MAX:
 
-            if GPIO.input(PIN_BUTTON_CAM1) == 0:
-                self.last_interaction = datetime.datetime.now()
+                self.wait_ready()
 
+                # let running filters finish before the controller cuts the power, deferred
+                # shots first (they are not in the scheduler yet while being resubmitted),
+                # unfinished jobs stay in the journal and are resumed on the next boot
+                drain_end = time.monotonic() + FILTER_DRAIN_TIMEOUT
+
+                if not self.pipeline.drain(timeout=FILTER_DRAIN_TIMEOUT):
+                    log.warning("{} shot(s) unfinished, resuming at next boot".format(self.pipeline.get_num_in_flight()))
+
+                if not self.scheduler.drain(timeout=max(0, drain_end - time.monotonic())):
+                    log.warning("{} filter job(s) unfinished, resuming at next boot".format(self.scheduler.get_num_pending()))
+
+                self.scheduler.close()
+
+                # write and fsync all pending images
+                self.writer.close()
+                log.debug("writer closed: {}".format(self.writer.get_stats()))
+
+                self.allocator.close()
+
+                self.wait_controller()
 
-            if (datetime.datetime.now() - self.last_interaction).total_seconds() > IDLE_TIME_MAX:
-                    
                 if self.controller is not None:
                     try:
-                        self.controller.shutdown(delay=15000)
+                        self.controller.shutdown(delay=15000).result(timeout=CONTROLLER_TIMEOUT)
                     except Exception as e:
                         log.error("poweroff failed: {}".format(e))
                 else:
                     log.error("poweroff failed: {}".format("no controller found"))
 
+                if self.telemetry is not None:
+                    self.telemetry.event(telemetry.EVENT_SHUTDOWN)
+                    self.telemetry.close()
+
                 log.debug("logging shutdown")
                 logging.shutdown()
-
-                subprocess.call(["sync"])
                     
                 # important, damage to filesystem: 
                 # wait a few sec before poweroff!
                 time.sleep(5)
 
-                subprocess.call(["poweroff"])
+                hardware.poweroff()
  
         elif self.mode == MODE_REC:
 
-            if (datetime.datetime.now() - self.timer_start).total_seconds() > RECORDING_TIME_MAX:
+            # sleeps until the shutter is released or the max recording time is over
+            event = self.inputs.get(timeout=self.timer_start + RECORDING_TIME_MAX - time.monotonic())
+
+            if event is None:
                 log.debug("recording time max exceeded")
                 self.stop_recording()
                 self.mode = MODE_IDLE
 
-            if GPIO.input(PIN_BUTTON_SHUTTER) == 1:
+            elif event.name == BUTTON_SHUTTER and event.type == EVENT_RELEASE:
                 self.stop_recording()
                 self.mode = MODE_IDLE
 
-        # sleep loop
+            else:
+                # raises encoder errors
+                self.camera[0].wait_recording(0)
 
-        if self.mode == MODE_REC:
-            self.camera.wait_recording(0.1)
-        else:
-            time.sleep(0.1)
+            self.last_interaction = time.monotonic()
 
 
     # all extensions are checked for duplicate filenames, first extension 
     # is returned as file name candidate
     def get_filename(self, extensions, prefix=None): # returns(path, filename.ext)
+        return self.allocator.allocate(extensions, prefix=prefix)
 
-        if not type(extensions) is list:
-            extensions = [extensions]
 
-        for i in range(0, len(extensions)):
-            if extensions[i] == "jpeg":
-                extensions[i] = "jpg"
+    def close(self):
 
-        for i in range(0, 100000):
+        log.info("CLOSE")
 
-            filename_base = "{:06d}.".format(i)
-            if not prefix is None:
-                filename_base = prefix + filename_base
-            duplicate_found = False
+        try:
+            self.wait_ready()
+        except Exception as e:
+            log.error("init incomplete: {}".format(e))
 
-            for extension in extensions:
+        if self.scheduler is not None:
+            self.scheduler.close()
 
-                filename = filename_base + extension
-                if os.path.exists(os.path.join(OUTPUT_DIR, filename)):
-                    duplicate_found = True
-                    break
+        if self.writer is not None:
+            self.writer.close()
 
-                filename = filename_base + "_0" + extension
-                if os.path.exists(os.path.join(OUTPUT_DIR, filename)):
-                    duplicate_found = True
-                    break
+        self.allocator.close()
 
-            if not duplicate_found:
-                return [OUTPUT_DIR, filename_base + extensions[0]]
+        if self.overlays is not None:
+            self.overlays.close()
 
-        raise Exception("no filenames left!")
+        if self.inputs is not None:
+            self.inputs.close()
 
+        self.wait_controller()
 
-    def close(self):
+        if self.controller is not None:
+            self.controller.close()
 
-        log.info("CLOSE")
+        if self.telemetry is not None:
+            self.telemetry.close()
 
         for cam in self.camera:
 
@@ -511,6 +836,10 @@ class TLCam(object):
             cam.stop_preview()
             cam.close()
 
+        for buffer_pool in self.buffer_pool:
+            if buffer_pool is not None:
+                buffer_pool.close()
+
         GPIO.cleanup()
 
 
@@ -0,0 +1,226 @@
+import os
+import time
+import queue
+from threading import Thread, Event, Lock
+import logging
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE      = 4
+DEFAULT_FSYNC_BATCH     = 8     # fsync after this many files ...
+DEFAULT_FSYNC_INTERVAL  = 5.0   # ... or this many seconds after the first unsynced write
+
+ITEM_WRITE              = 0
+ITEM_FLUSH              = 1
+ITEM_STOP               = 2
+
+
+class ImageWriter(object):
+
+    # Write-behind stage for captured images. Encoding and writing to the SD card run in a
+    # dedicated thread so the camera worker is free again as soon as the image is in memory.
+    #
+    # The queue is bounded: if the card can not keep up, submit() blocks and a warning is
+    # logged. Written files are kept open and fsynced together (every fsync_batch files,
+    # after fsync_interval seconds or on flush()) instead of syncing the whole system.
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, fsync_batch=DEFAULT_FSYNC_BATCH, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+
+        self.queue              = queue.Queue(maxsize=queue_size)
+        self.fsync_batch        = fsync_batch
+        self.fsync_interval     = fsync_interval
+
+        self.dirty_files        = []
+        self.dirty_dirs         = set()
+        self.dirty_since        = None
+
+        self.stats_lock         = Lock()
+        self.stats              = {
+            "written":              0,
+            "failed":               0,
+            "fsyncs":               0,
+            "queue_depth_max":      0,
+            "queue_full":           0,
+            "write_latency_last":   None,
+            "write_latency_max":    None,
+            "write_latency_sum":    0.0
+        }
+
+        self.thread = Thread(target=self._run, name="ImageWriter", daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return "ImageWriter [queue: {}/{}]".format(self.queue.qsize(), self.queue.maxsize)
+
+    # buffer: optional CaptureBuffer the image is a view of,
+    # retained until the image is encoded
+    def submit(self, filename, img, buffer=None, callback=None):
+
+        if buffer is not None:
+            buffer.retain()
+
+        item = (ITEM_WRITE, filename, img, buffer, callback, time.perf_counter())
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full as e:
+            log.warning("{} full, SD card can not keep up".format(self))
+
+            with self.stats_lock:
+                self.stats["queue_full"] += 1
+
+            self.queue.put(item)
+
+        with self.stats_lock:
+            self.stats["queue_depth_max"] = max(self.stats["queue_depth_max"], self.queue.qsize())
+
+    # blocks until all queued images are written and fsynced
+    def flush(self, timeout=None):
+        done = Event()
+        self.queue.put((ITEM_FLUSH, done))
+        return done.wait(timeout=timeout)
+
+    def close(self, timeout=None):
+
+        if not self.thread.is_alive():
+            return
+
+        self.flush(timeout=timeout)
+        self.queue.put((ITEM_STOP,))
+        self.thread.join(timeout=timeout)
+
+    def get_queue_depth(self):
+        return self.queue.qsize()
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+
+        stats["queue_depth"] = self.queue.qsize()
+        stats["write_latency_avg"] = None
+        if stats["written"] > 0:
+            stats["write_latency_avg"] = stats["write_latency_sum"] / stats["written"]
+
+        return stats
+
+    def _run(self):
+
+        while True:
+
+            timeout = None
+            if self.dirty_since is not None:
+                timeout = max(0, self.dirty_since + self.fsync_interval - time.monotonic())
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty as e:
+                self._fsync()
+                continue
+
+            if item[0] == ITEM_WRITE:
+                self._write(*item[1:])
+
+                if len(self.dirty_files) >= self.fsync_batch:
+                    self._fsync()
+
+            elif item[0] == ITEM_FLUSH:
+                self._fsync()
+                item[1].set()
+
+            elif item[0] == ITEM_STOP:
+                self._fsync()
+                break
+
+    def _write(self, filename, img, buffer, callback, time_submit):
+
+        import cv2
+
+        success = False
+
+        try:
+            try:
+                with metrics.span("write.encode"):
+                    ret, data = cv2.imencode(os.path.splitext(filename)[1], img)
+            finally:
+                if buffer is not None:
+                    buffer.release()
+
+            if not ret:
+                raise Exception("encoding failed")
+
+            with metrics.span("write.file"):
+                f = open(filename, "wb")
+                try:
+                    f.write(data)
+                    f.flush()
+                except Exception as e:
+                    # not handed to _fsync(), nobody else closes it
+                    f.close()
+                    raise e
+
+            self.dirty_files.append(f)
+            self.dirty_dirs.add(os.path.dirname(filename))
+            if self.dirty_since is None:
+                self.dirty_since = time.monotonic()
+
+            success = True
+
+            latency = time.perf_counter() - time_submit
+
+            with self.stats_lock:
+                self.stats["written"] += 1
+                self.stats["write_latency_last"] = latency
+                self.stats["write_latency_sum"] += latency
+                if self.stats["write_latency_max"] is None or latency > self.stats["write_latency_max"]:
+                    self.stats["write_latency_max"] = latency
+
+            log.debug("written {} in {:.0f}ms [queue: {}]".format(filename, latency * 1000, self.queue.qsize()))
+
+        except Exception as e:
+            log.error("writing {} failed: {}".format(filename, e))
+
+            with self.stats_lock:
+                self.stats["failed"] += 1
+
+        if callback is not None:
+            try:
+                callback(filename, success)
+            except Exception as e:
+                log.error("writer callback for {} failed: {}".format(filename, e))
+
+    def _fsync(self):
+
+        if len(self.dirty_files) == 0:
+            self.dirty_since = None
+            return
+
+        with metrics.span("write.fsync", tag=len(self.dirty_files)):
+            for f in self.dirty_files:
+                try:
+                    os.fsync(f.fileno())
+                except Exception as e:
+                    log.error("fsync {} failed: {}".format(f.name, e))
+                finally:
+                    f.close()
+
+            # make the new directory entries durable as well
+            for directory in self.dirty_dirs:
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except Exception as e:
+                    log.debug("fsync directory {} failed: {}".format(directory, e))
+
+        log.debug("fsynced {} file(s)".format(len(self.dirty_files)))
+
+        self.dirty_files = []
+        self.dirty_dirs = set()
+        self.dirty_since = None
+
+        with self.stats_lock:
+            self.stats["fsyncs"] += 1